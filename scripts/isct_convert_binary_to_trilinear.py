@@ -19,6 +19,7 @@ import os
 import commands
 import getopt
 import time
+import numpy as np
 import sct_utils as sct
 from msct_image import Image
 
@@ -29,7 +30,6 @@ class Param:
         self.smoothing_sigma = 5
         self.interp_factor = 1  # interpolation factor. Works fine with 1 (i.e., no interpolation required).
         self.suffix = '_trilin'  # output suffix
-        self.remove_temp_files = 1
         self.verbose = 1
 
 
@@ -40,7 +40,6 @@ def main():
     # Initialization
     fname_data = ''
     interp_factor = param.interp_factor
-    remove_temp_files = param.remove_temp_files
     verbose = param.verbose
     suffix = param.suffix
     smoothing_sigma = param.smoothing_sigma
@@ -54,7 +53,6 @@ def main():
     # Parameters for debug mode
     if param.debug:
         fname_data = path_sct + '/testing/data/errsm_23/t2/t2_manual_segmentation.nii.gz'
-        remove_temp_files = 0
         param.mask_size = 10
     else:
         # Check input parameters
@@ -70,7 +68,8 @@ def main():
             elif opt in ('-i'):
                 fname_data = arg
             elif opt in ('-r'):
-                remove_temp_files = int(arg)
+                # no temporary file is created anymore
+                sct.printv('WARNING : -r is a deprecated argument and has no effect.', 1, 'warning')
             elif opt in ('-s'):
                 smoothing_sigma = arg
             elif opt in ('-v'):
@@ -93,46 +92,28 @@ def main():
     # Extract path, file and extension
     path_data, file_data, ext_data = sct.extract_fname(fname_data)
 
-    # create temporary folder
-    print('\nCreate temporary folder...')
-    path_tmp = 'tmp.' + time.strftime("%y%m%d%H%M%S")
-    sct.run('mkdir ' + path_tmp)
-
-    from sct_convert import convert
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', param.verbose)
-    convert(fname_data, path_tmp + '/data.nii')
-
-    # go to tmp folder
-    os.chdir(path_tmp)
-
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image('data.nii').dim
+    im_data = Image(fname_data)
+    nx, ny, nz, nt, px, py, pz, pt = im_data.dim
     sct.printv('.. ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
 
-    # upsample data
-    sct.printv('\nUpsample data...', verbose)
-    sct.run('sct_resample -i data.nii -x linear -vox ' + str(nx * interp_factor) + 'x' + str(ny * interp_factor) + 'x' + str(nz * interp_factor) + ' -o data_up.nii', verbose)
-
-    # Smooth along centerline
-    sct.printv('\nSmooth along centerline...', verbose)
-    sct.run('sct_smooth_spinalcord -i data_up.nii -s data_up.nii' + ' -smooth ' + str(smoothing_sigma) + ' -r ' + str(remove_temp_files) + ' -v ' + str(verbose), verbose)
-
-    # downsample data
-    sct.printv('\nDownsample data...', verbose)
-    sct.run('sct_resample -i data_up_smooth.nii -x linear -vox ' + str(nx) + 'x' + str(ny) + 'x' + str(nz) + ' -o data_up_smooth_down.nii', verbose)
+    # Change orientation of the input image into RPI (in memory, the header is not changed)
+    orientation_input = im_data.orientation
+    im_data_rpi = Image(param=im_data.data.reshape(im_data.dim[0:3]), hdr=im_data.hdr, orientation=im_data.orientation, dim=im_data.dim)
+    im_data_rpi.change_orientation('RPI')
 
-    # come back to parent folder
-    os.chdir('..')
+    # upsample, smooth along centerline and downsample at once
+    sct.printv('\nSmooth along centerline (interp factor = ' + str(interp_factor) + ')...', verbose)
+    data_out = convert_binary_to_trilinear(im_data_rpi.data, im_data_rpi.dim[4:7], smoothing_sigma, interp_factor=interp_factor, verbose=verbose)
 
     # Generate output files
     print('\nGenerate output files...')
-    fname_out = sct.generate_output_file(path_tmp + '/data_up_smooth_down.nii', '' + file_data + suffix + ext_data)
-
-    # Delete temporary files
-    if remove_temp_files == 1:
-        print '\nRemove temporary files...'
-        sct.run('rm -rf ' + path_tmp)
+    im_out = Image(param=data_out, hdr=im_data.hdr.copy(), orientation='RPI', dim=im_data_rpi.dim, absolutepath=file_data + suffix + ext_data)
+    im_out.change_orientation(orientation_input)
+    im_out.changeType('float32')
+    im_out.save()
+    sct.printv('  File created: ' + im_out.absolutepath, verbose)
 
     # display elapsed time
     elapsed_time = time.time() - start_time
@@ -143,6 +124,41 @@ def main():
     print 'fslview ' + file_data + ' ' + file_data + suffix + ' &\n'
 
 
+# convert_binary_to_trilinear
+# ==========================================================================================
+def convert_binary_to_trilinear(data, pixdim, smoothing_sigma, interp_factor=1, margin=5, verbose=1):
+    """
+    Oversample the binary mask, smooth along centerline and downsample back to native resolution. The three steps are
+    done in memory: the straight space is sampled at the oversampled resolution directly from the native data, and
+    the smoothed straight space is sampled back at the native voxels.
+    :param data: binary segmentation (3D array in RPI orientation)
+    :param pixdim: voxel size (px, py, pz) in mm
+    :param smoothing_sigma: sigma of the smoothing Gaussian kernel (in mm)
+    :param margin: margin (in voxel) around the segmentation in the axial plane. Voxels outside are set to 0.
+    :return: partial volume segmentation
+    """
+    from sct_smooth_spinalcord import smooth_along_centerline
+
+    data = np.asarray(data, dtype=float)
+    data_out = np.zeros(data.shape)
+    x_seg, y_seg, z_seg = data.nonzero()
+    if len(x_seg) == 0:
+        sct.printv('WARNING: segmentation is empty.', verbose, 'warning')
+        return data_out
+
+    # crop around the segmentation in the axial plane to bound the size of the straight space
+    x_min, x_max = max(0, x_seg.min() - margin), min(data.shape[0], x_seg.max() + margin + 1)
+    y_min, y_max = max(0, y_seg.min() - margin), min(data.shape[1], y_seg.max() + margin + 1)
+    data_crop = data[x_min:x_max, y_min:y_max, :]
+
+    data_out[x_min:x_max, y_min:y_max, :] = smooth_along_centerline(data_crop, data_crop, pixdim, float(smoothing_sigma), interpolation_order=1, interp_factor=interp_factor, verbose=verbose)
+
+    # replace zeroed voxels by original image (issue #937)
+    ind_zero = np.where(data_out == 0)
+    data_out[ind_zero] = data[ind_zero]
+    return data_out
+
+
 # Print usage
 # ==========================================================================================
 def usage():
@@ -164,7 +180,7 @@ def usage():
         '\n' \
         'OPTIONAL ARGUMENTS\n' \
         '  -s                sigma of the smoothing Gaussian kernel (in voxel). Default=' + str(param_default.smoothing_sigma) + '\n' \
-        '  -r {0,1}          remove temporary files. Default=' + str(param_default.remove_temp_files) + '\n' \
+        '  -r {0,1}          deprecated, has no effect (no temporary file is created).\n' \
         '  -v {0,1}          verbose. Default=' + str(param_default.verbose) + '\n' \
         '  -h                help. Show this message\n' \
         '\n'\
@@ -11,6 +11,35 @@
 # About the license: see the file LICENSE.TXT
 ########################################################################################################################
 
+import os
+
+# atlas already loaded in this process, indexed by label files and their modification time. This is an in-memory cache:
+# it is shared by the calls made within one run (e.g. several functions of this module), not across runs.
+atlas_cache = {}
+
+
+def load_atlas(atlas_folder, label_file):
+    """This function takes as input the path to the folder containing an atlas and the list of the labels' file name.
+    It returns the atlas as a 4D numpy array (x, y, z, label) of float32. The last atlas loaded is kept in memory for
+    the lifetime of the process: within one run, it is loaded again only if the list of files or one of the files
+    changed. The returned array is shared with the cache and must not be modified in place."""
+
+    import nibabel
+    import numpy
+
+    fname_list = [os.path.abspath(atlas_folder + fname) for fname in label_file]
+    key = (tuple(fname_list), tuple([os.path.getmtime(fname) for fname in fname_list]))
+    if key not in atlas_cache:
+        atlas = None
+        for i_label, fname in enumerate(fname_list):
+            data = nibabel.load(fname).get_data()
+            if atlas is None:
+                atlas = numpy.zeros(data.shape + (len(fname_list),), dtype=numpy.float32)
+            atlas[..., i_label] = data
+        atlas_cache.clear()
+        atlas_cache[key] = atlas
+    return atlas_cache[key]
+
 
 def get_fractional_volume_per_label(atlas_folder, file_label, nb_RL_labels=15):
     """This function takes as input the path to the folder containing an atlas and the name of the file gathering the
@@ -21,29 +50,20 @@ def get_fractional_volume_per_label(atlas_folder, file_label, nb_RL_labels=15):
     - a 1D-numpy array containing the fractional volume of each label in the same order as the previous lists."""
 
     import sct_extract_metric
-    import nibabel
     import numpy
 
     label_id, label_name, label_file, combined_labels_ids, combined_labels_names, combined_labels_id_groups = sct_extract_metric.read_label_file(atlas_folder, file_label)
-    nb_label = len(label_file)
-
-    fract_volume_per_lab = numpy.zeros((nb_label))
 
     # compute fractional volume for each label
-    for i_label in range(0, nb_label):
-        fract_volume_per_lab[i_label] = numpy.sum(nibabel.load(atlas_folder + label_file[i_label]).get_data())
+    atlas = load_atlas(atlas_folder, label_file)
+    fract_volume_per_lab = numpy.sum(atlas.reshape(-1, atlas.shape[-1]), axis=0, dtype=numpy.float64)
 
     # gather right and left sides
     # nb_non_RL_labels = nb_label - (2*nb_RL_labels) # number of labels that are not paired side-wise
-    fract_volume_per_lab_RL_gatehered = numpy.zeros((nb_RL_labels))
-    label_name_RL_gatehered = []
-
-    for i_label in range(0, nb_RL_labels):
-        ind_ID_first_side = label_id.index(i_label)
-        ind_ID_other_side = label_id.index(i_label + nb_RL_labels)
-
-        fract_volume_per_lab_RL_gatehered[i_label] = fract_volume_per_lab[ind_ID_first_side] + fract_volume_per_lab[ind_ID_other_side]
-        label_name_RL_gatehered.append(label_name[ind_ID_first_side].replace('left', '').replace('right', '').strip())
+    ind_ID_first_side = [label_id.index(i_label) for i_label in range(0, nb_RL_labels)]
+    ind_ID_other_side = [label_id.index(i_label + nb_RL_labels) for i_label in range(0, nb_RL_labels)]
+    fract_volume_per_lab_RL_gatehered = fract_volume_per_lab[ind_ID_first_side] + fract_volume_per_lab[ind_ID_other_side]
+    label_name_RL_gatehered = [label_name[i].replace('left', '').replace('right', '').strip() for i in ind_ID_first_side]
 
     # # add labels that are not paired side-wise
     # for i_label in range(0, nb_non_RL_labels):
@@ -58,16 +78,13 @@ def get_nb_voxel_in_WM(atlas_folder, file_label):
     labels' file name of this atlas. It returns the number of voxels including at least one label."""
 
     import sct_extract_metric
-    import nibabel
     import numpy
 
     label_id, label_name, label_file, combined_labels_ids, combined_labels_names, combined_labels_id_groups = sct_extract_metric.read_label_file(atlas_folder, file_label)
-    nb_label = len(label_file)
 
     # sum of all the labels
-    sum_all_labels = nibabel.load(atlas_folder + label_file[0]).get_data()
-    for i_label in range(1, nb_label):
-        sum_all_labels = numpy.add(sum_all_labels, nibabel.load(atlas_folder + label_file[i_label]).get_data())
+    atlas = load_atlas(atlas_folder, label_file)
+    sum_all_labels = numpy.sum(atlas, axis=-1)
 
     # count the number of non-zero voxels
     nb_voxel_in_WM = numpy.count_nonzero(sum_all_labels)
@@ -16,7 +16,6 @@
 
 
 import numpy as np
-from scipy.ndimage import map_coordinates
 import math
 
 
@@ -826,6 +825,7 @@ class Image(object):
         :param interpolation_mode: 0=nearest neighbor, 1= linear, 2= 2nd-order spline, 3= 2nd-order spline, 4= 2nd-order spline, 5= 5th-order spline
         :return: intensity values at continuouspix with interpolation_mode
         """
+        from scipy.ndimage import map_coordinates
         return map_coordinates(self.data, coordi, output=np.float32, order=interpolation_mode, mode=border, cval=cval)
 
     def get_transform(self, im_ref, mode='affine'):
@@ -19,14 +19,17 @@ import sys
 import time
 
 import numpy as np
-import pandas as pd
-from sklearn import decomposition, manifold
 
 from msct_gmseg_utils import (apply_transfo, average_gm_wm, normalize_slice,
                               pre_processing, register_data)
 from msct_image import Image
 from msct_parser import Parser
-from sct_utils import printv, slash_at_the_end
+from sct_utils import lazy_import, printv, slash_at_the_end
+
+# heavy dependencies, imported on first use
+pd = lazy_import('pandas')
+decomposition = lazy_import('sklearn.decomposition')
+manifold = lazy_import('sklearn.manifold')
 
 
 def get_parser():
@@ -264,7 +264,8 @@ class Parser:
     def __init__(self, file_name):
         self.file_name = file_name
         self.options = dict()
-        self.spelling = SpellingChecker()
+        # the spelling checker is only needed to suggest options when an argument is unknown, so it is built on error
+        self.spelling = None
         self.errors = ''
         self.usage = Usage(self, file_name)
         self.check_file_exist = True
@@ -294,42 +295,13 @@ class Parser:
         # initialize results
         dictionary = dict()
 
-        # initialize the spelling checker
-        self.spelling.setWordsAsList([name for name in self.options])
-
         # checking if some file names or folder names contains spaces.
         # We suppose here that the user provides correct structure of arguments (i.e., one "-something", one "argument value", one "-somethingelse", one "another argument value", etc.)
         # We also suppose that multiple spaces can be present
         # we also check if double-quotes are present. If so, we need to concatenate the fields.
-        arguments_temp = []
-        index_next = 0
-        for index in range(0, len(arguments)):
-            if index == index_next:
-                if arguments[index][0] == '-':
-                    arguments_temp.append(arguments[index])
-                    index_next = index + 1
-                else:
-                    temp_str = arguments[index]
-                    index_temp = index
-                    if index_temp < len(arguments) - 1:
-                        if arguments[index][0] == '"':
-                            while arguments[index_temp + 1][-1] != '"':  # loop until we find a double quote. Then concatenate.
-                                temp_str += ' ' + arguments[index_temp + 1]
-                                index_temp += 1
-                                if index_temp >= len(arguments) - 1:
-                                    break
-                            temp_str += ' ' + arguments[index_temp + 1]
-                            temp_str = temp_str[1:-1]
-                        else:
-                            while arguments[index_temp + 1][0] != '-':  # check if a space is present. If so, concatenation of strings.
-                                temp_str += ' ' + arguments[index_temp + 1]
-                                index_temp += 1
-                                if index_temp >= len(arguments) - 1:
-                                    break
-                    index_next = index_temp + 1
-                    if '"' not in temp_str:
-                        arguments_temp.append(temp_str)
-        arguments = arguments_temp
+        # Arguments that are already well-formed (e.g., calls issued by other sct scripts) are kept as is.
+        if not self.is_well_formed(arguments):
+            arguments = self.concatenate_arguments(arguments)
 
         skip = False
         for index, arg in enumerate(arguments):
@@ -367,7 +339,7 @@ class Parser:
             else:
                 # if not in the list of known options, there is a syntax error in the list of arguments
                 # check if the input argument is close to a known option
-                spelling_candidates = self.spelling.correct(arg)
+                spelling_candidates = self.get_spelling_checker().correct(arg)
                 if len(spelling_candidates) != 0:
                     self.usage.error("ERROR: argument " + arg + " does not exist. Did you mean: " + ', '.join(spelling_candidates) + '?')
                 else:
@@ -386,6 +358,66 @@ class Parser:
         # return a dictionary with each option name as a key and the input as the value
         return dictionary
 
+    def is_well_formed(self, arguments):
+        """
+        Check if the arguments do not need to be concatenated, i.e. no empty argument, no double-quotes and no value
+        split over several arguments.
+        :param arguments: list of arguments
+        :return: True if the arguments can be parsed as is
+        """
+        previous_is_value = False
+        for arg in arguments:
+            if not arg or '"' in arg:
+                return False
+            is_value = arg[0] != '-'
+            if is_value and previous_is_value:
+                return False
+            previous_is_value = is_value
+        return True
+
+    def concatenate_arguments(self, arguments):
+        """
+        Concatenate the values that were split over several arguments (spaces in file names or double-quotes).
+        :param arguments: list of arguments
+        :return: list of arguments with one value per option
+        """
+        arguments_temp = []
+        index_next = 0
+        for index in range(0, len(arguments)):
+            if index == index_next:
+                if arguments[index][0] == '-':
+                    arguments_temp.append(arguments[index])
+                    index_next = index + 1
+                else:
+                    temp_str = arguments[index]
+                    index_temp = index
+                    if index_temp < len(arguments) - 1:
+                        if arguments[index][0] == '"':
+                            while arguments[index_temp + 1][-1] != '"':  # loop until we find a double quote. Then concatenate.
+                                temp_str += ' ' + arguments[index_temp + 1]
+                                index_temp += 1
+                                if index_temp >= len(arguments) - 1:
+                                    break
+                            temp_str += ' ' + arguments[index_temp + 1]
+                            temp_str = temp_str[1:-1]
+                        else:
+                            while arguments[index_temp + 1][0] != '-':  # check if a space is present. If so, concatenation of strings.
+                                temp_str += ' ' + arguments[index_temp + 1]
+                                index_temp += 1
+                                if index_temp >= len(arguments) - 1:
+                                    break
+                    index_next = index_temp + 1
+                    if '"' not in temp_str:
+                        arguments_temp.append(temp_str)
+        return arguments_temp
+
+    def get_spelling_checker(self):
+        # build the vocabulary of the spelling checker with the option names
+        if self.spelling is None:
+            self.spelling = SpellingChecker()
+            self.spelling.setWordsAsList([name for name in self.options])
+        return self.spelling
+
     def add_path_to_file(self, dictionary, path_to_add, input_file=True, output_file=False, do_not_add_path=[]):
         """
         This function add a path in front of each value in a dictionary (provided by the parser) for option that are files or folders.
@@ -449,6 +481,7 @@ class Usage:
         self.usage = ''
         self.example = ''
         self.description = ''
+        self.description_raw = ''
         self.arguments = parser.options
         #self.error = parser.errors
         self.arguments_string = ''
@@ -465,7 +498,13 @@ class Usage:
 # Version: """ + str(self.get_sct_version())
 
     def set_description(self, description):
-        self.description = '\nDESCRIPTION\n' + self.align(description, length=100, pad=0)
+        # the description is formatted in format_description(), only when the usage is generated
+        self.description_raw = description
+
+    def format_description(self):
+        if self.description_raw:
+            self.description = '\nDESCRIPTION\n' + self.align(self.description_raw, length=100, pad=0)
+        return self.description
 
     def addSection(self, section):
         self.section[len(self.arguments) + 1] = section
@@ -552,6 +591,7 @@ class Usage:
 
     def generate(self, error=None):
         # self.set_header()
+        self.format_description()
         self.set_arguments()
         self.set_usage()
         self.set_example()
@@ -740,7 +780,7 @@ class DocSourceForge:
 
     def generate(self, error=None):
         # self.set_header()
-        self.set_description(self.parser.usage.description[2 + len('description'):])
+        self.set_description(self.parser.usage.format_description()[2 + len('description'):])
         self.set_arguments()
         self.set_usage()
         self.set_example()
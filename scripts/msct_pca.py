@@ -154,12 +154,7 @@ class PCA:
 
         :return mean_im: mean image flatten (vector)
         """
-        mean_im = []
-        for row in self.dataset:
-            m = sum(row) / self.J
-            mean_im.append(m)
-        mean_im = np.array([mean_im]).T
-        return mean_im
+        return np.mean(self.dataset, axis=1).reshape(self.N, 1)
 
     # STEP 3
     # ------------------------------------------------------------------------------------------------------------------
@@ -169,11 +164,8 @@ class PCA:
 
         :return covariance_matrix:
         """
-        covariance_matrix = np.zeros((self.N, self.N))
-        for j in range(0, self.J):
-            covariance_matrix += float(1) / self.J * (self.dataset[:, j].reshape(self.N, 1) - self.mean_data_vect)\
-                .dot((self.dataset[:, j].reshape(self.N, 1) - self.mean_data_vect).T)
-        return covariance_matrix
+        centered_dataset = self.dataset - self.mean_data_vect
+        return centered_dataset.dot(centered_dataset.T) / float(self.J)
 
     # STEP 4
     # ------------------------------------------------------------------------------------------------------------------
@@ -183,23 +175,15 @@ class PCA:
 
         :return eig_pairs: sorted list of tuples (eigenvalue, eigenvector)
         """
-        eigenvalues, eigenvectors = np.linalg.eig(self.covariance_matrix)
+        # the covariance matrix is symmetric: use the symmetric solver, which returns real eigenpairs
+        eigenvalues, eigenvectors = np.linalg.eigh(self.covariance_matrix)
+        eigenvalues = np.abs(eigenvalues)
 
-        eigenvectors = eigenvectors.astype(np.float)
+        # Sort the eigenpairs from high eigenvalues to low eigenvalues, ignoring the null eigenvalues
+        ind_sorted = [i for i in np.argsort(-eigenvalues, kind='mergesort') if eigenvalues[i] > 0.0000001]
 
         # Create a list of (eigenvalue, eigenvector) tuple
-        eig_pairs = [(np.abs(eigenvalues[i]), eigenvectors[:, i]) for i in range(len(eigenvalues))
-                     if np.abs(eigenvalues[i]) > 0.0000001]
-
-        # Sort the (eigenvalue, eigenvector) tuples from high eigenvalues to low eigenvalues
-        def get_key(item):
-            """
-            indicate the key to use to sort a tuple list 9here : first element
-            :param item: tuple
-            :return item[0]: first element of tuple
-            """
-            return item[0]  # sorting by eigenvalues
-        eig_pairs = sorted(eig_pairs, key=get_key, reverse=True)
+        eig_pairs = [(eigenvalues[i], eigenvectors[:, i]) for i in ind_sorted]
         return eig_pairs
 
     # STEP 5
@@ -212,23 +196,17 @@ class PCA:
 
         :return kept_modes, kept_eigenvalues: list of the kept modes vectors and list of the kept eigenvalues
         """
-        kept_eigenvalues = []
-        s = sum([eig[0] for eig in self.eig_pairs])
+        eigenvalues = np.asarray([eig[0] for eig in self.eig_pairs])
+        s = np.sum(eigenvalues)
         sct.printv('\n ---> sum of eigenvalues : ' + str(s), self.verbose, 'normal')
-        first = 1
         start = modes_to_ignore
-        kept_modes = []
-        for eig in self.eig_pairs[start:]:
-            if first:
-                kept_modes = np.asarray(eig[1]).reshape(self.N, 1)
-                kept_eigenvalues.append(eig[0])
-                first = 0
-            else:
-                if (sum(kept_eigenvalues) + eig[0]) / s <= self.k:
-                    kept_eigenvalues.append(eig[0])
-                    kept_modes = np.hstack((kept_modes, np.asarray(eig[1]).reshape(self.N, 1)))
-                else:
-                    break
+        # the first mode is always kept, the following ones as long as the cumulated variability is below k
+        nb_kept = max(1, np.sum(np.cumsum(eigenvalues[start:]) / s <= self.k))
+        kept_eigenvalues = list(eigenvalues[start:start + nb_kept])
+        if kept_eigenvalues:
+            kept_modes = np.asarray([np.asarray(eig[1]).reshape(self.N) for eig in self.eig_pairs[start:start + nb_kept]]).T
+        else:
+            kept_modes = []
 
         sct.printv('kept eigenvalues (PCA space dimension)  : ' + str(len(kept_eigenvalues)), self.verbose, 'normal')
         return kept_modes, kept_eigenvalues
@@ -241,26 +219,24 @@ class PCA:
 
         :return dataset_coord: coordinates of the data set as a list of vectors
         """
-        dataset_coord = []
-        for column in self.dataset.T:
-            dataset_coord.append(self.project_array(column).reshape(len(self.kept_eigenval),))
-        return np.asarray(dataset_coord).T
+        return self.kept_modes.T.dot(self.dataset - self.mean_data_vect)
 
     # ------------------------------------------------------------------------------------------------------------------
     def project(self, image_list):
         """
         project a 3D image into the PCA reduced space
 
-        :param image_list: image to project
+        :param image_list: image to project (list of slices)
 
-        :return coord_projected_img: numpy array containing the coordinates of the image in the PCA reduced space
+        :return coord_projected_img: numpy array containing the coordinates of each slice in the PCA reduced space
         """
-        # check if the target is a volume or a flat image
-        coord_projected_slices = []
-        # loop across all the slice
-        for image_slice in image_list:
-            coord_projected_slices.append(self.project_array(image_slice.flatten()))
-        return np.asarray(coord_projected_slices)
+        # flatten all the slices: one row per slice
+        target = np.asarray([image_slice.flatten() for image_slice in image_list])
+        if target.ndim == 2 and target.shape[1] == self.N:
+            # project all the slices at once
+            return self.kept_modes.T.dot(target.T - self.mean_data_vect).T
+        else:
+            print "target dimension is {}, must be {}.\n".format(target.shape[1:], self.N)
 
     # ------------------------------------------------------------------------------------------------------------------
     def project_array(self, image_as_array):
@@ -20,14 +20,20 @@ import os
 import time
 import math
 from random import randint
-from skimage import measure, filters
 import shutil
-import matplotlib.pyplot as plt
 from itertools import compress
+from multiprocessing import Pool, cpu_count
 from sct_image import Image, set_orientation
 from msct_types import Centerline
 from sct_straighten_spinalcord import smooth_centerline
 
+# heavy dependencies, imported on first use
+measure = sct.lazy_import('skimage.measure')
+filters = sct.lazy_import('skimage.filters')
+plt = sct.lazy_import('matplotlib.pyplot')
+ndimage = sct.lazy_import('scipy.ndimage')
+signal = sct.lazy_import('scipy.signal')
+
 
 def find_contours(image, threshold=0.5, smooth_sigma=0.0, verbose=1):
     image_input = image
@@ -96,11 +102,10 @@ def properties2d(image, resolution=None, verbose=1):
 
         resolution_grid = 0.25
         x_grid, y_grid = np.mgrid[-size_grid:size_grid:resolution_grid, -size_grid:size_grid:resolution_grid]
-        coordinates_grid = np.array(zip(x_grid.ravel(), y_grid.ravel()))
-        coordinates_grid_image = np.array([[x0 + math.cos(orientation) * coordinates_grid[i, 0], y0 - math.sin(orientation) * coordinates_grid[i, 1]] for i in range(coordinates_grid.shape[0])])
+        coordinates_grid_image = np.array([x0 + math.cos(orientation) * x_grid.ravel(), y0 - math.sin(orientation) * y_grid.ravel()])
 
         from scipy.ndimage import map_coordinates
-        square = map_coordinates(image, coordinates_grid_image.T, output=np.float32, order=0, mode='constant', cval=0.0)
+        square = map_coordinates(image, coordinates_grid_image, output=np.float32, order=0, mode='constant', cval=0.0)
         square_image = square.reshape((len(x_grid), len(x_grid)))
 
         size_half = square_image.shape[1] / 2
@@ -140,6 +145,11 @@ def properties2d(image, resolution=None, verbose=1):
     return sc_properties
 
 
+def properties2d_star(args):
+    """Calls properties2d with a tuple of arguments, for multiprocessing"""
+    return properties2d(*args)
+
+
 def average_properties(fname_seg_images, property_list, fname_disks_images, group_images, verbose=1):
     if len(fname_seg_images) != len(fname_disks_images):
         raise ValueError('ERROR: each segmentation image must be accompagnied by a disk image')
@@ -170,7 +180,7 @@ def average_properties(fname_seg_images, property_list, fname_disks_images, grou
     for i, fname_seg in enumerate(fname_seg_images):
         sct.printv(fname_seg)
         fname_disks = fname_disks_images[i]
-        properties_along_centerline = compute_properties_along_centerline(fname_seg, property_list, fname_disks, verbose)
+        properties_along_centerline = compute_properties_along_centerline(fname_seg, property_list, fname_disks, verbose=verbose)
 
         centerline = properties_along_centerline['centerline']
 
@@ -199,7 +209,14 @@ def average_properties(fname_seg_images, property_list, fname_disks_images, grou
         plt.show()
 
 
-def compute_properties_along_centerline(fname_seg_image, property_list, fname_disks_image=None, smooth_factor=5.0, interpolation_mode=0, remove_temp_files=1, verbose=1):
+def compute_properties_along_centerline(fname_seg_image, property_list, fname_disks_image=None, smooth_factor=5.0, interpolation_mode=0, remove_temp_files=1, nb_cpu=None, nb_points_per_batch=100, verbose=1):
+    """
+    Compute spinal cord shape properties on the patches perpendicular to the centerline.
+    Patches are extracted by batches of nb_points_per_batch centerline points, and their region properties are
+    computed on nb_cpu processes (all the available cores if None).
+    """
+    if nb_cpu is None:
+        nb_cpu = cpu_count()
 
     # Check list of properties
     # If diameters is in the list, compute major and minor axis length and check orientation
@@ -270,35 +287,50 @@ def compute_properties_along_centerline(fname_seg_image, property_list, fname_di
         centerline.compute_vertebral_distribution(coord_physical)
 
     sct.printv('Computing spinal cord shape along the spinal cord...')
-    timer_properties = sct.Timer(number_of_iteration=centerline.number_of_points)
-    timer_properties.start()
-    # Extracting patches perpendicular to the spinal cord and computing spinal cord shape
-    for index in range(centerline.number_of_points):
-        value_out = -5.0
-        current_patch = centerline.extract_perpendicular_square(image, index, resolution=resolution, interpolation_mode=interpolation_mode, border='constant', cval=value_out)
+    # Extracting patches perpendicular to the spinal cord
+    value_out = -5.0
+    footprint = ndimage.generate_binary_structure(2, 1)[np.newaxis]
+    indexes_patches, patches = [], []
+    for index_start in range(0, centerline.number_of_points, nb_points_per_batch):
+        indexes = np.arange(index_start, min(index_start + nb_points_per_batch, centerline.number_of_points))
+        current_patches = centerline.extract_perpendicular_squares(image, indexes, resolution=resolution, interpolation_mode=interpolation_mode, border='constant', cval=value_out)
 
         # check for pixels close to the spinal cord segmentation that are out of the image
-        from skimage.morphology import dilation
-        patch_zero = np.copy(current_patch)
-        patch_zero[patch_zero == value_out] = 0.0
-        patch_borders = dilation(patch_zero) - patch_zero
+        patches_zero = np.where(current_patches == value_out, np.float32(0.0), current_patches)
+        patches_borders = ndimage.grey_dilation(patches_zero, footprint=footprint) - patches_zero
+        out_of_image = np.any(patches_borders + current_patches == value_out + 1.0, axis=(1, 2))
 
-        if np.count_nonzero(patch_borders + current_patch == value_out + 1.0) != 0:
-            continue
+        indexes_patches.extend(indexes[~out_of_image])
+        patches.extend(patches_zero[~out_of_image])
 
-        sc_properties = properties2d(patch_zero, [resolution, resolution])
+    # computing spinal cord shape
+    list_args = [(patch, [resolution, resolution]) for patch in patches]
+    if nb_cpu > 1 and len(list_args) > 1:
+        pool = Pool(nb_cpu)
+        try:
+            list_properties = pool.map(properties2d_star, list_args)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        list_properties = [properties2d_star(args) for args in list_args]
+
+    if indexes_patches:
+        z_slices = [coord[2] for coord in image.transfo_phys2pix(centerline.points[indexes_patches])]
+    for i, index in enumerate(indexes_patches):
+        sc_properties = list_properties[i]
         if sc_properties is not None:
             properties['incremental_length'].append(centerline.incremental_length[index])
             if fname_disks_image is not None:
                 properties['distance_from_C1'].append(centerline.dist_points[index])
                 properties['vertebral_level'].append(centerline.l_points[index])
-            properties['z_slice'].append(image.transfo_phys2pix([centerline.points[index]])[0][2])
+            properties['z_slice'].append(z_slices[i])
             for property_name in property_list_local:
                 properties[property_name].append(sc_properties[property_name])
 
-        timer_properties.add_iteration()
-    timer_properties.stop()
-
     # Adding centerline to the properties for later use
     properties['centerline'] = centerline
 
@@ -324,10 +356,10 @@ def compute_properties_along_centerline(fname_seg_image, property_list, fname_di
     # smooth the spinal cord shape with a gaussian kernel if required
     # TODO: not all properties can be smoothed
     if smooth_factor != 0.0:  # smooth_factor is in mm
-        import scipy
-        window = scipy.signal.hann(smooth_factor / np.mean(centerline.progressive_length))
+        # window length in number of centerline points (recent scipy versions require an integer)
+        window = signal.hann(max(1, int(round(smooth_factor / np.mean(centerline.progressive_length)))))
         for property_name in property_list_local:
-            properties[property_name] = scipy.signal.convolve(properties[property_name], window, mode='same') / np.sum(window)
+            properties[property_name] = signal.convolve(properties[property_name], window, mode='same') / np.sum(window)
 
     if compute_diameters:
         property_list_local.remove('major_axis_length')
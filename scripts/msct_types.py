@@ -16,10 +16,9 @@
 
 from __future__ import division
 from math import sqrt
-from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis, zeros
+from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis, zeros, column_stack
 from numpy.linalg import norm, inv
 import numpy as np
-from scipy.spatial import cKDTree
 
 
 class Point(object):
@@ -207,40 +206,62 @@ class Centerline:
             # Load centerline data from points and derivatives in parameters
             if points_x is None or points_y is None or points_z is None or deriv_x is None or deriv_y is None or deriv_z is None:
                 raise ValueError('Data must be provided to centerline to be initialized')
-            self.points = array(zip(points_x, points_y, points_z))
-            self.derivatives = array(zip(deriv_x, deriv_y, deriv_z))
+            self.points = column_stack([points_x, points_y, points_z])
+            self.derivatives = column_stack([deriv_x, deriv_y, deriv_z])
+        self.points = np.ascontiguousarray(self.points, dtype=np.float64)
+        self.derivatives = np.ascontiguousarray(self.derivatives, dtype=np.float64)
 
         self.number_of_points = len(self.points)
 
         # computation of centerline features, based on points and derivatives
         self.compute_length()
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
-
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
+        self.compute_coordinate_systems()
+        self.compute_plans_parameters()
 
         # initialization of KDTree for enabling computation of nearest points in centerline
+        from scipy.spatial import cKDTree
         self.tree_points = cKDTree(self.points)
 
         if self.compute_init_distribution:
             self.compute_vertebral_distribution(disks_levels=self.disks_levels, label_reference=self.label_reference)
 
     def compute_length(self):
-        for i in range(0, self.number_of_points - 1):
-            distance = sqrt((self.points[i][0] - self.points[i + 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i + 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i + 1][2]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-            self.incremental_length.append(self.incremental_length[-1] + distance)
-        for i in range(self.number_of_points - 1, 0, -1):
-            distance = sqrt((self.points[i][0] - self.points[i - 1][0]) ** 2 +
-                            (self.points[i][1] - self.points[i - 1][1]) ** 2 +
-                            (self.points[i][2] - self.points[i - 1][2]) ** 2)
-            self.progressive_length_inverse.append(distance)
-            self.incremental_length_inverse.append(self.incremental_length_inverse[-1] + distance)
+        """
+        This function computes the distances between consecutive points and the cumulative length along the
+        centerline, in both directions. progressive_length[i] is the distance between points i - 1 and i and
+        incremental_length[i] the length from the first point to point i (both 0 for the first point).
+        """
+        distances = norm(np.diff(self.points, axis=0), axis=1)
+        self.progressive_length = np.concatenate([[0.0], distances])
+        self.incremental_length = np.concatenate([[0.0], np.cumsum(distances)])
+        self.progressive_length_inverse = np.concatenate([[0.0], distances[::-1]])
+        self.incremental_length_inverse = np.concatenate([[0.0], np.cumsum(distances[::-1])])
+        self.length = self.incremental_length[-1]
+
+    def compute_coordinate_systems(self):
+        """
+        This function computes the coordinate reference system (X, Y, and Z axes) at all points of the centerline.
+        The Z axis is the normalized derivative (derivatives are normalized in place), the Y axis is the
+        antero-posterior axis projected on the plane and the X axis completes the system.
+        matrices[i] has the axes as columns and inverse_matrices[i] is its inverse.
+        """
+        self.derivatives /= norm(self.derivatives, axis=1)[:, np.newaxis]
+        z_prime_axes = self.derivatives
+        y_prime_axes = array([0, 1, 0]) - z_prime_axes[:, 1:2] * z_prime_axes
+        y_prime_axes /= norm(y_prime_axes, axis=1)[:, np.newaxis]
+        x_prime_axes = cross(y_prime_axes, z_prime_axes)
+        x_prime_axes /= norm(x_prime_axes, axis=1)[:, np.newaxis]
+
+        self.matrices = stack([x_prime_axes, y_prime_axes, z_prime_axes], axis=2)
+        self.inverse_matrices = inv(self.matrices)
+
+    def compute_plans_parameters(self):
+        """
+        This function computes the parameters [a, b, c, d] of the planes perpendicular to the centerline at all
+        points, corresponding to the plane equation a*x + b*y + c*z + d = 0.
+        """
+        self.offset_plans = - einsum('ij,ij->i', self.derivatives, self.points)
+        self.plans_parameters = column_stack([self.derivatives, self.offset_plans])
 
     def find_nearest_index(self, coord):
         """
@@ -276,16 +297,11 @@ class Centerline:
         :param index: int
         :return: List of parameters [a, b, c, d], corresponding to plane parametric equation a*x + b*y + c*z + d = 0
         """
-        if 0 <= index < self.number_of_points:
-            a = self.derivatives[index][0]
-            b = self.derivatives[index][1]
-            c = self.derivatives[index][2]
-            d = - (a * self.points[index][0] + b * self.points[index][1] + c * self.points[index][2])
-        else:
+        if not 0 <= index < self.number_of_points:
             raise IndexError('ERROR in msct_types.Centerline.get_plan_parameters: index (' + str(index) + ') should be '
                              'within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
 
-        return [a, b, c, d]
+        return list(self.plans_parameters[index])
 
     def get_distance_from_plane(self, coord, index, plane_params=None):
         """
@@ -297,7 +313,7 @@ class Centerline:
         from index.
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -333,19 +349,9 @@ class Centerline:
         """
         if 0 <= index < self.number_of_points:
             origin = self.points[index]
-            z_prime_axis = self.derivatives[index]
-            z_prime_axis /= norm(z_prime_axis)
-            y_axis = array([0, 1, 0])
-            y_prime_axis = (y_axis - dot(y_axis, z_prime_axis) * z_prime_axis)
-            y_prime_axis /= norm(y_prime_axis)
-            x_prime_axis = cross(y_prime_axis, z_prime_axis)
-            x_prime_axis /= norm(x_prime_axis)
-
-            matrix_base = array([[x_prime_axis[0], y_prime_axis[0], z_prime_axis[0]],
-                                 [x_prime_axis[1], y_prime_axis[1], z_prime_axis[1]],
-                                 [x_prime_axis[2], y_prime_axis[2], z_prime_axis[2]]])
-
-            inverse_matrix = inv(matrix_base)
+            matrix_base = self.matrices[index]
+            x_prime_axis, y_prime_axis, z_prime_axis = matrix_base.T
+            inverse_matrix = self.inverse_matrices[index]
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -360,7 +366,7 @@ class Centerline:
         :param plane_params:
         :return:
         """
-        if plane_params:
+        if plane_params is not None:
             [a, b, c, d] = plane_params
         else:
             [a, b, c, d] = self.plans_parameters[index]
@@ -380,8 +386,7 @@ class Centerline:
         :return:
         """
         if 0 <= index < self.number_of_points:
-            origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix = self.coordinate_system[index]
-            return inverse_matrix.dot(coord - origin)
+            return self.inverse_matrices[index].dot(coord - self.points[index])
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -423,10 +428,7 @@ class Centerline:
         if not is_C2_here and C1 is not None and C3 is not None:
             disks_levels.append([(C1[0] + C3[0]) / 2.0, (C1[1] + C3[1]) / 2.0, (C1[2] + C3[2]) / 2.0, 2])
 
-        labels_points = [0] * self.number_of_points
         self.l_points = [0] * self.number_of_points
-        self.dist_points = [0] * self.number_of_points
-        self.dist_points_rel = [0] * self.number_of_points
         self.index_disk, index_disk_inv = {}, []
 
         # extracting each level based on position and computing its nearest point along the centerline
@@ -436,7 +438,6 @@ class Centerline:
                 coord_level = [level[0], level[1], level[2]]
                 disk = self.regions_labels[str(int(level[3]))]
                 nearest_index = self.find_nearest_index(coord_level)
-                labels_points[nearest_index] = disk + '-0.0'
                 self.index_disk[disk] = nearest_index
                 index_disk_inv.append([nearest_index, disk])
 
@@ -462,9 +463,8 @@ class Centerline:
         index_disk_inv.append([0, 'bottom'])
         index_disk_inv = sorted(index_disk_inv, key=itemgetter(0))
 
-        progress_length = zeros(self.number_of_points)
-        for i in range(self.number_of_points - 1):
-            progress_length[i + 1] = progress_length[i] + self.progressive_length[i]
+        # progress_length[i] is the sum of progressive_length[:i]
+        progress_length = np.concatenate([[0.0], np.cumsum(self.progressive_length[:-1])])
 
         self.label_reference = label_reference
         if self.label_reference not in self.index_disk:
@@ -476,52 +476,74 @@ class Centerline:
                     upper = self.labels_regions[l]
             self.label_reference = label_reference
 
+        position_reference = progress_length[self.index_disk[self.label_reference]]
         self.distance_from_C1label = {}
         for disk in self.index_disk:
-            self.distance_from_C1label[disk] = progress_length[self.index_disk[self.label_reference]] - progress_length[self.index_disk[disk]]
+            self.distance_from_C1label[disk] = position_reference - progress_length[self.index_disk[disk]]
 
         for i in range(1, len(index_disk_inv)):
-            for j in range(index_disk_inv[i - 1][0], index_disk_inv[i][0]):
-                self.l_points[j] = index_disk_inv[i][1]
+            self.l_points[index_disk_inv[i - 1][0]:index_disk_inv[i][0]] = [index_disk_inv[i][1]] * (index_disk_inv[i][0] - index_disk_inv[i - 1][0])
 
-        for i in range(self.number_of_points):
-            self.dist_points[i] = progress_length[self.index_disk[self.label_reference]] - progress_length[i]
+        # distance of each point from the reference label, decreasing along the centerline
+        self.dist_points = position_reference - progress_length
 
-        for i in range(self.number_of_points):
-            current_label = self.l_points[i]
+        # relative position of each point in its vertebral level, computed for all the points of a level at once
+        self.dist_points_rel = zeros(self.number_of_points)
+        array_l_points = array(self.l_points, dtype=object)
+        for label in set(self.l_points):
+            in_level = array_l_points == label
+            dist_points = self.dist_points[in_level]
+            current_label = label
 
             if current_label == 0:
                 if 'PMG' in self.index_disk:
-                    self.dist_points_rel[i] = self.dist_points[i] - self.dist_points[self.index_disk['PMG']]
+                    self.dist_points_rel[in_level] = dist_points - self.dist_points[self.index_disk['PMG']]
                     continue
                 else:
                     current_label = 'PMG'
 
             if self.list_labels.index(self.labels_regions[current_label]) < self.list_labels.index(self.first_label):
                 reference_level_position = self.dist_points[self.index_disk[self.regions_labels[str(self.first_label)]]]
-                self.dist_points_rel[i] = self.dist_points[i] - reference_level_position
+                self.dist_points_rel[in_level] = dist_points - reference_level_position
 
             elif self.list_labels.index(self.labels_regions[current_label]) >= self.list_labels.index(self.last_label):
                 reference_level_position = self.dist_points[self.index_disk[self.regions_labels[str(self.last_label)]]]
-                self.dist_points_rel[i] = self.dist_points[i] - reference_level_position
+                self.dist_points_rel[in_level] = dist_points - reference_level_position
 
             else:
-                index_current_label = self.list_labels.index(self.labels_regions[self.l_points[i]])
+                index_current_label = self.list_labels.index(self.labels_regions[label])
 
                 if self.list_labels.index(self.first_label) <= index_current_label < self.list_labels.index(self.last_label):
                     next_label = self.regions_labels[str(self.list_labels[index_current_label + 1])]
 
                     if current_label in ['PMJ', 'PMG']:
                         if next_label in self.index_disk:
-                            self.dist_points_rel[i] = - (self.dist_points[i] - self.dist_points[self.index_disk[next_label]]) / abs(self.dist_points[self.index_disk[next_label]] - self.dist_points[self.index_disk[current_label]])
+                            self.dist_points_rel[in_level] = - (dist_points - self.dist_points[self.index_disk[next_label]]) / abs(self.dist_points[self.index_disk[next_label]] - self.dist_points[self.index_disk[current_label]])
                         else:
-                            self.dist_points_rel[i] = (self.average_vert_length[current_label] - self.dist_points[i] + self.dist_points[self.index_disk[current_label]]) / self.average_vert_length[current_label]
+                            self.dist_points_rel[in_level] = (self.average_vert_length[current_label] - dist_points + self.dist_points[self.index_disk[current_label]]) / self.average_vert_length[current_label]
                     else:
-                        next_label = self.regions_labels[str(self.list_labels[self.list_labels.index(self.labels_regions[self.l_points[i]]) + 1])]
                         if next_label in self.index_disk:
-                            self.dist_points_rel[i] = (self.dist_points[i] - self.dist_points[self.index_disk[current_label]]) / abs(self.dist_points[self.index_disk[next_label]] - self.dist_points[self.index_disk[current_label]])
+                            self.dist_points_rel[in_level] = (dist_points - self.dist_points[self.index_disk[current_label]]) / abs(self.dist_points[self.index_disk[next_label]] - self.dist_points[self.index_disk[current_label]])
                         else:
-                            self.dist_points_rel[i] = (self.dist_points[i] - self.dist_points[self.index_disk[current_label]]) / self.average_vert_length[current_label]
+                            self.dist_points_rel[in_level] = (dist_points - self.dist_points[self.index_disk[current_label]]) / self.average_vert_length[current_label]
+
+    def get_closest_to_distance(self, distance):
+        """
+        This function returns the index of the point whose distance from the reference label (dist_points) is the
+        closest to distance. dist_points decreases along the centerline, so the search is a binary search.
+        Ties are resolved toward the lowest index.
+        Args:
+            distance: float, in mm
+
+        Returns:
+            index
+        """
+        ascending = - self.dist_points
+        index = np.searchsorted(ascending, - distance)
+        if index == self.number_of_points or (index > 0 and abs(self.dist_points[index - 1] - distance) <= abs(self.dist_points[index] - distance)):
+            index -= 1
+        # first point of a series of points at the same position
+        return np.searchsorted(ascending, ascending[index])
 
     def get_closest_to_relative_position(self, vertebral_level, relative_position, mode='levels'):
         """
@@ -544,7 +566,7 @@ class Centerline:
             result = indexes_vert[idx]
 
         elif mode == 'length':
-            result = np.argmin(np.abs(np.array(self.dist_points) - relative_position))
+            result = self.get_closest_to_distance(relative_position)
         else:
             raise ValueError("Mode must be either 'levels' or 'length'.")
 
@@ -559,9 +581,9 @@ class Centerline:
                     position_reference_backup = backup_centerline.dist_points[backup_centerline.index_disk[backup_centerline.regions_labels[str(self.first_label)]]]
                     position_reference_self = self.dist_points[self.index_disk[self.regions_labels[str(self.first_label)]]]
                     relative_position_from_reference_backup = backup_centerline.dist_points[backup_index] - position_reference_backup
-                    result = np.argmin(np.abs(np.array(self.dist_points) - position_reference_self - relative_position_from_reference_backup))
+                    result = self.get_closest_to_distance(position_reference_self + relative_position_from_reference_backup)
                 else:
-                    result = np.argmin(np.abs(np.array(self.dist_points) - relative_position))
+                    result = self.get_closest_to_distance(relative_position)
             else:
                 vertebral_number = self.labels_regions[vertebral_level]
                 if self.potential_list_labels.index(vertebral_number) < self.list_labels.index(self.first_label):
@@ -569,19 +591,19 @@ class Centerline:
                         position_reference_backup = backup_centerline.dist_points[backup_centerline.index_disk[backup_centerline.regions_labels[str(self.first_label)]]]
                         position_reference_self = self.dist_points[self.index_disk[self.regions_labels[str(self.first_label)]]]
                         relative_position_from_reference_backup = backup_centerline.dist_points[backup_index] - position_reference_backup
-                        result = np.argmin(np.abs(np.array(self.dist_points) - position_reference_self - relative_position_from_reference_backup))
+                        result = self.get_closest_to_distance(position_reference_self + relative_position_from_reference_backup)
                     else:
                         reference_level_position = self.dist_points[self.index_disk[self.regions_labels[str(self.first_label)]]]
-                        result = np.argmin(np.abs(np.array(self.dist_points) - reference_level_position - relative_position))
+                        result = self.get_closest_to_distance(reference_level_position + relative_position)
                 elif self.potential_list_labels.index(vertebral_number) >= self.list_labels.index(self.last_label):
                     if backup_centerline is not None:
                         position_reference_backup = backup_centerline.dist_points[backup_centerline.index_disk[backup_centerline.regions_labels[str(self.last_label)]]]
                         position_reference_self = self.dist_points[self.index_disk[self.regions_labels[str(self.last_label)]]]
                         relative_position_from_reference_backup = backup_centerline.dist_points[backup_index] - position_reference_backup
-                        result = np.argmin(np.abs(np.array(self.dist_points) - position_reference_self - relative_position_from_reference_backup))
+                        result = self.get_closest_to_distance(position_reference_self + relative_position_from_reference_backup)
                     else:
                         reference_level_position = self.dist_points[self.index_disk[self.regions_labels[str(self.last_label)]]]
-                        result = np.argmin(np.abs(np.array(self.dist_points) - reference_level_position - relative_position))
+                        result = self.get_closest_to_distance(reference_level_position + relative_position)
                 else:
                     result = self.get_closest_to_relative_position(vertebral_level=vertebral_level, relative_position=relative_position)
 
@@ -595,12 +617,28 @@ class Centerline:
         return result
 
     def extract_perpendicular_square(self, image, index, size=20, resolution=0.5, interpolation_mode=0, border='constant', cval=0.0):
-        x_grid, y_grid, z_grid = np.mgrid[-size:size:resolution, -size:size:resolution, 0:1]
-        coordinates_grid = np.array(zip(x_grid.ravel(), y_grid.ravel(), z_grid.ravel()))
-        coordinates_phys = self.get_inverse_plans_coordinates(coordinates_grid, np.array([index] * len(coordinates_grid)))
-        coordinates_im = np.array(image.transfo_phys2continuouspix(coordinates_phys))
-        square = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border, cval=cval)
-        return square.reshape((len(x_grid), len(x_grid)))
+        return self.extract_perpendicular_squares(image, [index], size=size, resolution=resolution, interpolation_mode=interpolation_mode, border=border, cval=cval)[0]
+
+    def extract_perpendicular_squares(self, image, indexes, size=20, resolution=0.5, interpolation_mode=0, border='constant', cval=0.0):
+        """
+        This function extracts the square patches lying in the planes perpendicular to the centerline at several
+        indexes, with a single interpolation of the image.
+        :param image: Image
+        :param indexes: list of int
+        :param size: half size of the squares, in mm
+        :param resolution: resolution of the squares, in mm
+        :return: array of size (len(indexes), 2 * size / resolution, 2 * size / resolution)
+        """
+        x_grid, y_grid = np.mgrid[-size:size:resolution, -size:size:resolution]
+        coordinates_grid = array([x_grid.ravel(), y_grid.ravel(), zeros(x_grid.size)])
+        indexes = array(indexes, dtype=int)
+        # physical coordinates of the grid in each plane, (index, point, axis)
+        coordinates_phys = einsum('kij,jm->kmi', self.matrices[indexes], coordinates_grid) + self.points[indexes][:, np.newaxis, :]
+        # continuous pixel coordinates, (axis, index, point)
+        m_p2f = image.hdr.get_sform()
+        coordinates_im = einsum('ij,kmj->ikm', inv(m_p2f[0:3, 0:3]), coordinates_phys - m_p2f[0:3, 3])
+        squares = image.get_values(coordinates_im.reshape(3, -1), interpolation_mode=interpolation_mode, border=border, cval=cval)
+        return squares.reshape((len(indexes),) + x_grid.shape)
 
     def save_centerline(self, image=None, fname_output='centerline.sct'):
         if image is not None:
@@ -628,13 +666,9 @@ class Centerline:
 
     def average_coordinates_over_slices(self, image):
         # extracting points information for each coordinates
-        P_x = np.array([point[0] for point in self.points])
-        P_y = np.array([point[1] for point in self.points])
-        P_z = np.array([point[2] for point in self.points])
+        P_x, P_y, P_z = self.points.T
         P_z_vox = np.array([coord[2] for coord in image.transfo_phys2pix(self.points)])
-        P_x_d = np.array([deriv[0] for deriv in self.derivatives])
-        P_y_d = np.array([deriv[1] for deriv in self.derivatives])
-        P_z_d = np.array([deriv[2] for deriv in self.derivatives])
+        P_x_d, P_y_d, P_z_d = self.derivatives.T
 
         P_z_vox = np.array([int(np.round(P_z_vox[i])) for i in range(0, len(P_z_vox))])
         # not perfect but works (if "enough" points), in order to deal with missing z slices
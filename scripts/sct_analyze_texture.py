@@ -14,7 +14,6 @@ import sys
 import numpy as np
 import itertools
 from math import radians
-from skimage.feature import greycomatrix, greycoprops
 
 from msct_image import Image
 from msct_parser import Parser
@@ -226,29 +225,20 @@ class ExtractGLCM:
         timer.start()
 
         for im_z, seg_z, zz in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'], range(len(self.dct_im_seg['im']))):
-            for xx in range(im_z.shape[0]):
-                for yy in range(im_z.shape[1]):
-                    if not seg_z[xx, yy]:
-                        continue
-                    if xx < offset or yy < offset:
-                        continue
-                    if xx > (im_z.shape[0] - offset - 1) or yy > (im_z.shape[1] - offset - 1):
-                        continue  # to check if the whole glcm_window is in the axial_slice
-                    if False in np.unique(seg_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]):
-                        continue  # to check if the whole glcm_window is in the mask of the axial_slice
-
-                    glcm_window = im_z[xx - offset: xx + offset + 1, yy - offset: yy + offset + 1]
-                    glcm_window = glcm_window.astype(np.uint8)
-
-                    dct_glcm = {}
-                    for a in self.param_glcm.angle.split(','):  # compute the GLCM for self.param_glcm.distance and for each self.param_glcm.angle
-                        dct_glcm[a] = greycomatrix(glcm_window,
-                                                   [self.param_glcm.distance], [radians(int(a))],
-                                                   symmetric=self.param_glcm.symmetric,
-                                                   normed=self.param_glcm.normed)
-
-                    for m in self.metric_lst:  # compute the GLCM property (m.split('_')[0]) of the voxel xx,yy,zz
-                        dct_metric[m].data[xx, yy, zz] = greycoprops(dct_glcm[m.split('_')[2]], m.split('_')[0])[0][0]
+            # all the glcm_windows of the axial slice, indexed by the position of their top-left corner
+            windows = extract_windows(im_z.astype(np.uint8), 2 * offset + 1)
+            # voxels whose whole glcm_window is in the axial_slice and in the mask of the axial_slice
+            xx, yy = (extract_windows(seg_z != 0, 2 * offset + 1).all(axis=(2, 3))).nonzero()
+            if len(xx):
+                glcm_windows = windows[xx, yy]
+                xx, yy = xx + offset, yy + offset
+                for a in self.param_glcm.angle.split(','):  # compute the GLCM properties for self.param_glcm.distance and for each self.param_glcm.angle
+                    dct_prop = glcm_properties(glcm_windows, self.param_glcm.distance, radians(int(a)),
+                                               [m.split('_')[0] for m in self.metric_lst if m.split('_')[2] == a],
+                                               symmetric=self.param_glcm.symmetric)
+                    for m in self.metric_lst:  # GLCM property (m.split('_')[0]) of the voxels xx,yy,zz
+                        if m.split('_')[2] == a:
+                            dct_metric[m].data[xx, yy, zz] = dct_prop[m.split('_')[0]]
 
             timer.add_iteration()
 
@@ -269,6 +259,78 @@ class ExtractGLCM:
             im.save()
 
 
+def extract_windows(data, size):
+    """
+    Sliding-window view of a 2D array, without copy.
+    :param data: 2D array
+    :param size: width of the square windows
+    :return: 4D array of shape (nx - size + 1, ny - size + 1, size, size), where [x, y] is the window whose top-left
+    corner is data[x, y]
+    """
+    shape = (max(0, data.shape[0] - size + 1), max(0, data.shape[1] - size + 1), size, size)
+    return np.lib.stride_tricks.as_strided(data, shape=shape, strides=data.strides * 2, writeable=False)
+
+
+def glcm_properties(windows, distance, angle, properties, symmetric=True, levels=256):
+    """
+    Compute GLCM texture properties for a batch of windows, for one offset.
+    Output is the same as skimage greycoprops(greycomatrix(window, [distance], [angle], levels, symmetric, normed=True),
+    prop) applied to each window, but the co-occurrence matrices are never built explicitly: the properties are derived
+    from the grey level pairs (i, j) of each window, which are the non-zero entries of its GLCM.
+    :param windows: 3D uint8 array (nb_windows, size, size)
+    :param distance: offset distance, in pixel
+    :param angle: offset angle, in radians
+    :param properties: list of GLCM properties (contrast, dissimilarity, homogeneity, energy, correlation, ASM)
+    :return: dict {property: 1D array (nb_windows)}
+    """
+    # offset of the neighbor pixel, as in skimage (round half away from zero)
+    offset_row, offset_col = [int(np.sign(x) * np.floor(abs(x) + 0.5)) for x in [np.sin(angle) * distance, np.cos(angle) * distance]]
+    nb_windows, rows, cols = windows.shape
+    start_row, end_row = max(0, -offset_row), min(rows, rows - offset_row)
+    start_col, end_col = max(0, -offset_col), min(cols, cols - offset_col)
+
+    # grey level pairs (reference pixel, neighbor pixel) of each window
+    nb_pairs = (end_row - start_row) * (end_col - start_col)
+    I = windows[:, start_row:end_row, start_col:end_col].reshape(nb_windows, nb_pairs).astype(np.int64)
+    J = windows[:, start_row + offset_row:end_row + offset_row, start_col + offset_col:end_col + offset_col].reshape(nb_windows, nb_pairs).astype(np.int64)
+    if symmetric:
+        I, J = np.hstack((I, J)), np.hstack((J, I))
+    # weight of each pair in the normalized GLCM
+    weight = 1. / I.shape[1]
+
+    dct_prop = {}
+    for prop in properties:
+        if prop == 'contrast':
+            dct_prop[prop] = weight * np.sum((I - J) ** 2, axis=1)
+        elif prop == 'dissimilarity':
+            dct_prop[prop] = weight * np.sum(np.abs(I - J), axis=1)
+        elif prop == 'homogeneity':
+            dct_prop[prop] = weight * np.sum(1. / (1. + (I - J) ** 2), axis=1)
+        elif prop in ['ASM', 'energy']:
+            # sum of the squared GLCM entries: count the occurrences of each pair in each window
+            codes = np.sort(I * levels + J, axis=1)
+            new_code = np.ones(codes.shape, dtype=bool)
+            new_code[:, 1:] = codes[:, 1:] != codes[:, :-1]
+            count = np.bincount(np.cumsum(new_code.ravel()) - 1)
+            asm = np.bincount(np.repeat(np.arange(nb_windows), new_code.sum(axis=1)), weights=(weight * count) ** 2, minlength=nb_windows)
+            dct_prop[prop] = asm if prop == 'ASM' else np.sqrt(asm)
+        elif prop == 'correlation':
+            diff_i = I - weight * np.sum(I, axis=1)[:, np.newaxis]
+            diff_j = J - weight * np.sum(J, axis=1)[:, np.newaxis]
+            std_i = np.sqrt(weight * np.sum(diff_i ** 2, axis=1))
+            std_j = np.sqrt(weight * np.sum(diff_j ** 2, axis=1))
+            cov = weight * np.sum(diff_i * diff_j, axis=1)
+            # handle the special case of standard deviations near zero
+            mask_0 = (std_i < 1e-15) | (std_j < 1e-15)
+            result = np.ones(nb_windows)
+            result[~mask_0] = cov[~mask_0] / (std_i[~mask_0] * std_j[~mask_0])
+            dct_prop[prop] = result
+        else:
+            raise ValueError('%s is an invalid property' % (prop))
+
+    return dct_prop
+
+
 class Param:
     def __init__(self):
         self.fname_im = None
@@ -19,7 +19,7 @@
 import sys
 import getopt
 import os
-from numpy import asarray, sqrt
+from numpy import array, asarray, sqrt, dot, zeros, prod, newaxis
 import nibabel
 from sct_utils import printv
 from msct_parser import Parser
@@ -77,29 +77,28 @@ def main():
     return weighted_average
 
 
-def average_within_mask(fname_src, fname_mask, tmask='', zmask='', verbose=1):
+def average_within_mask(fname_src, fname_mask, tmask='', zmask='', verbose=1, nb_voxels_per_chunk=50000000):
     """
     Average data within mask
-    :param fname_src:
+    :param fname_src: 3D or 4D image. 4D images are read by chunks of volumes (memory mapped if not compressed).
     :param fname_mask:
     :param tmask:
     :param zmask:
     :param verbose:
-    :return: [mean, std]
+    :param nb_voxels_per_chunk: maximum number of voxels read at once from a 4D image
+    :return: [mean, std]. For 4D images, mean and std are arrays with one value per volume.
     """
     # Quantify image within mask
     header_src = nibabel.load(fname_src)
     header_mask = nibabel.load(fname_mask)
 
-    data_src = header_src.get_data()
-    #data_mask = header_mask.get_data()[:,:,:,int(tmask)]
-
     # check if mask is 4D
     if tmask == '':
         data_mask = header_mask.get_data()
     else:
-        assert len(header_mask.get_data().shape) == 4, 'ERROR: mask is not 4D, cannot use option -nvol.'
-        data_mask = header_mask.get_data()[:, :, :, tmask]
+        assert len(header_mask.shape) == 4, 'ERROR: mask is not 4D, cannot use option -nvol.'
+        data_mask = header_mask.dataobj[:, :, :, tmask]
+    data_mask = array(data_mask, dtype=float)
 
     # if user specified zmin and zmax, put rest of slices to 0
     if zmask != '':
@@ -108,33 +107,34 @@ def average_within_mask(fname_src, fname_mask, tmask='', zmask='', verbose=1):
 
     # find indices of non-zero elements the mask
     ind_nonzero = data_mask.nonzero()
+    weight = data_mask[ind_nonzero]
+    n = len(weight)
+
+    # get values in the image, for all volumes, by chunks of volumes
+    shape_src = header_src.shape
+    if len(shape_src) == 3:
+        data = asarray(header_src.dataobj)[ind_nonzero][:, newaxis]
+    else:
+        nt = shape_src[3]
+        nb_volumes_per_chunk = max(1, nb_voxels_per_chunk / int(prod(shape_src[:3])))
+        data = zeros((n, nt))
+        for t_start in range(0, nt, nb_volumes_per_chunk):
+            t_end = min(t_start + nb_volumes_per_chunk, nt)
+            data[:, t_start:t_end] = asarray(header_src.dataobj[..., t_start:t_end])[ind_nonzero]
 
-    # perform a weighted average for all nonzero indices from the mask
-    data = []
-    weight = []
-    for i in range(0, len(ind_nonzero[0][:])):
-        # retrieve coordinates from mask
-        x, y, z = ind_nonzero[0][i], ind_nonzero[1][i], ind_nonzero[2][i]
-        # get values in mask
-        weight.append(data_mask[x, y, z])
-        # get value in the image
-        data.append(data_src[x, y, z])
-    # compute weighted average
-    data = asarray(data)
-    weight = asarray(weight)
-    n = len(data)
     # compute weighted_average
-    weighted_average = sum(data * weight) / sum(weight)
+    weighted_average = dot(weight, data) / sum(weight)
     # compute weighted STD
-    weighted_std = sqrt(sum(weight * (data - weighted_average)**2) / ((n / (n - 1)) * sum(weight)))
+    weighted_std = sqrt(dot(weight, (data - weighted_average)**2) / ((n / (n - 1)) * sum(weight)))
+
+    if len(shape_src) == 3:
+        weighted_average, weighted_std = weighted_average[0], weighted_std[0]
 
     # print result
     printv('\n' + str(weighted_average) + ' +/- ' + str(weighted_std), verbose)
 
     return weighted_average, weighted_std
 
-    # Display created files
-
 
 def get_parser():
     # Initialize the parser
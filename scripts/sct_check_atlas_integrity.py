@@ -25,6 +25,7 @@ import sct_utils as sct
 from msct_parser import Parser
 import nibabel as nib
 import numpy as np
+from isct_get_fractional_volume import load_atlas
 
 
 # DEFAULT PARAMETERS
@@ -38,6 +39,7 @@ class Param:
         self.threshold_GM = 0.25
         self.fname_seg = ''
         self.fname_GM = ''
+        self.nb_voxels_block = 2 ** 25  # number of values (voxels x tracts) copied at once when summing the tracts
 
 # constants
 ALMOST_ZERO = 0.0000001
@@ -77,9 +79,7 @@ def main():
 
     # Load atlas
     sct.printv('\nLoad atlas...', param.verbose)
-    atlas = np.empty([nb_tracts_total], dtype=object)  # labels(nb_labels_total, x, y, z)
-    for i_atlas in range(0, nb_tracts_total):
-        atlas[i_atlas] = nib.load(path_atlas + atlas_file[i_atlas]).get_data()
+    atlas = load_atlas(path_atlas, atlas_file)  # labels(x, y, z, nb_labels_total)
 
     # Check integrity
     sct.printv('\nCheck atlas integrity...', param.verbose)
@@ -144,34 +144,24 @@ def read_label_file(path_info_label):
 #=======================================================================================================================
 def check_integrity(atlas, atlas_id, atlas_name, method='wath'):
 
-    nb_tracts = len(atlas)  # number of tracts
+    # stack tracts along the 4th dimension
+    if not isinstance(atlas, np.ndarray) or atlas.dtype == object:
+        atlas = np.stack(list(atlas), axis=-1)
+    nb_tracts = atlas.shape[-1]  # number of tracts
 
     # Get dimensions of the atlas
     sct.printv('\nGet dimensions of atlas...', param.verbose)
-    nx_atlas, ny_atlas, nz_atlas = atlas[0].shape
+    nx_atlas, ny_atlas, nz_atlas = atlas.shape[:3]
     sct.printv('.. ' + str(nx_atlas) + ' x ' + str(ny_atlas) + ' x ' + str(nz_atlas) + ' x ' + str(nb_tracts), param.verbose)
 
-    # if user asks for binary regions, binarize atlas
-    if method == 'bin':
-        for i in range(0, nb_tracts):
-            atlas[i][atlas[i] < param.threshold_atlas] = 0
-            atlas[i][atlas[i] >= param.threshold_atlas] = 1
-
-    # if user asks for thresholded weighted-average, threshold atlas
-    if method == 'wath':
-        for i in range(0, nb_tracts):
-            atlas[i][atlas[i] < param.threshold_atlas] = 0
+    sum_tract = sum_tracts(atlas, method)
+    sum_tract_positive = sum_tracts(atlas, method, positive_only=True)
 
     # Does all the tracts are present?
-    tracts_are_present = True
     sct.printv('\nDoes all the tracts are present in the atlas?', param.verbose)
-    sum_tract = []
-    for i_atlas in range(0, nb_tracts):
-        sum_tract.append(np.sum(atlas[i_atlas]))
-        if sum_tract[i_atlas] < ALMOST_ZERO:
-            sct.printv('The tract #' + str(atlas_id[i_atlas]) + atlas_name[i_atlas] + ' is non-existent', param.verbose)
-            tracts_are_present = False
-    if tracts_are_present:
+    for i_atlas in np.where(sum_tract < ALMOST_ZERO)[0]:
+        sct.printv('The tract #' + str(atlas_id[i_atlas]) + atlas_name[i_atlas] + ' is non-existent', param.verbose)
+    if not (sum_tract < ALMOST_ZERO).any():
         sct.printv('All the tracts are present.', param.verbose)
 
     # Does any tract gets out the spinal cord?
@@ -187,26 +177,17 @@ def check_integrity(atlas, atlas_id, atlas_name, method='wath'):
             print '\nERROR: Segmentation image and the atlas DO NOT HAVE SAME DIMENSIONS.'
             sys.exit(2)
 
-        tracts_are_inside_SC = True
-        total_outside = 0
-        total_sum_tracts = 0
         sct.printv('\nDoes any tract gets out the spinal cord?', param.verbose)
-        ind_seg_outside_cord = segmentation <= ALMOST_ZERO
-        for i_atlas in range(0, nb_tracts):
-            ind_atlas_positive = atlas[i_atlas] >= ALMOST_ZERO
-            sum_tract_outside_SC = np.sum(atlas[i_atlas][ind_atlas_positive & ind_seg_outside_cord])
-            sum_tract = np.sum(atlas[i_atlas][ind_atlas_positive])
-            if sum_tract_outside_SC > ALMOST_ZERO:
-                percentage_out = float(sum_tract_outside_SC / sum_tract)
-                sct.printv('The tract #' + str(atlas_id[i_atlas]) + atlas_name[i_atlas] + ' gets out the spinal cord of ' + str(round(percentage_out * 100, 2)) + '%', param.verbose)
-                tracts_are_inside_SC = False
-                total_outside += sum_tract_outside_SC
-            total_sum_tracts += sum_tract
-        if tracts_are_inside_SC:
+        sum_tract_outside_SC = sum_tracts(atlas, method, mask=segmentation <= ALMOST_ZERO, positive_only=True)
+        ind_tracts_outside = np.where(sum_tract_outside_SC > ALMOST_ZERO)[0]
+        for i_atlas in ind_tracts_outside:
+            percentage_out = float(sum_tract_outside_SC[i_atlas] / sum_tract_positive[i_atlas])
+            sct.printv('The tract #' + str(atlas_id[i_atlas]) + atlas_name[i_atlas] + ' gets out the spinal cord of ' + str(round(percentage_out * 100, 2)) + '%', param.verbose)
+        if len(ind_tracts_outside) == 0:
             sct.printv('All the tracts are inside the spinal cord.', param.verbose)
             sct.printv('\nTotal percentage of present tracts outside the spinal cord: 0%', param.verbose)
         else:
-            total_percentage_out = float(total_outside / total_sum_tracts)
+            total_percentage_out = float(np.sum(sum_tract_outside_SC[ind_tracts_outside]) / np.sum(sum_tract_positive))
             sct.printv('\nTotal percentage of present tracts outside the spinal cord: ' + str(round(total_percentage_out * 100, 2)) + '%', param.verbose)
 
     # Does any tract overlaps the spinal cord gray matter?
@@ -222,29 +203,54 @@ def check_integrity(atlas, atlas_id, atlas_name, method='wath'):
             print '\nERROR: Gray matter image and the atlas DO NOT HAVE SAME DIMENSIONS.'
             sys.exit(2)
 
-        tracts_overlap_GM = False
-        total_overlaps = 0
-        total_sum_tracts = 0
         sct.printv('\nDoes any tract overlaps the spinal cord gray matter?', param.verbose)
-        ind_GM = graymatter >= param.threshold_GM
-        for i_atlas in range(0, nb_tracts):
-            ind_atlas_positive = atlas[i_atlas] >= ALMOST_ZERO
-            sum_tract_overlap_GM = np.sum(atlas[i_atlas][ind_atlas_positive & ind_GM])
-            sum_tract = np.sum(atlas[i_atlas])
-            if sum_tract_overlap_GM > ALMOST_ZERO:
-                percentage_overlap = float(sum_tract_overlap_GM / sum_tract)
-                sct.printv('The tract #' + str(atlas_id[i_atlas]) + atlas_name[i_atlas] + ' overlaps the spinal cord gray matter of ' + str(round(percentage_overlap * 100, 2)) + '%', param.verbose)
-                tracts_overlap_GM = True
-                total_overlaps += sum_tract_overlap_GM
-            total_sum_tracts += sum_tract
-        if not tracts_overlap_GM:
+        sum_tract_overlap_GM = sum_tracts(atlas, method, mask=graymatter >= param.threshold_GM, positive_only=True)
+        ind_tracts_overlap = np.where(sum_tract_overlap_GM > ALMOST_ZERO)[0]
+        for i_atlas in ind_tracts_overlap:
+            percentage_overlap = float(sum_tract_overlap_GM[i_atlas] / sum_tract[i_atlas])
+            sct.printv('The tract #' + str(atlas_id[i_atlas]) + atlas_name[i_atlas] + ' overlaps the spinal cord gray matter of ' + str(round(percentage_overlap * 100, 2)) + '%', param.verbose)
+        if len(ind_tracts_overlap) == 0:
             sct.printv('No tract overlaps the spinal cord gray matter.', param.verbose)
             sct.printv('\nTotal percentage of present tracts overlapping gray matter: 0%', param.verbose)
         else:
-            total_percentage_overlap = float(total_overlaps / total_sum_tracts)
+            total_percentage_overlap = float(np.sum(sum_tract_overlap_GM[ind_tracts_overlap]) / np.sum(sum_tract))
             sct.printv('\nTotal percentage of present tracts overlapping gray matter: ' + str(round(total_percentage_overlap * 100, 2)) + '%', param.verbose)
 
 
+#=======================================================================================================================
+# Sum each tract of the atlas
+#=======================================================================================================================
+def sum_tracts(atlas, method, mask=None, positive_only=False):
+    """
+    Sum each tract of the atlas, after binarization ('bin') or thresholding ('wath') of the atlas. Tracts are processed by
+    blocks, so that only one block is copied at a time: the atlas, which can be shared with the cache of load_atlas, is
+    not modified.
+    :param atlas: 4D numpy array (x, y, z, tract)
+    :param method: 'wath', 'bin' or 'wa'
+    :param mask: 3D boolean array. If given, only the voxels within the mask are summed.
+    :param positive_only: if True, values lower than ALMOST_ZERO are not summed
+    :return: 1D numpy array (tract) of float64
+    """
+    nb_tracts = atlas.shape[-1]
+    nb_tracts_block = max(1, param.nb_voxels_block // int(np.prod(atlas.shape[:3])))
+    sum_tract = np.zeros(nb_tracts)
+    for i_start in range(0, nb_tracts, nb_tracts_block):
+        atlas_block = atlas[..., i_start:i_start + nb_tracts_block]
+        # copy the block as atlas_block(voxel, tract)
+        if mask is None:
+            atlas_block = np.array(atlas_block).reshape(-1, atlas_block.shape[-1])
+        else:
+            atlas_block = atlas_block[mask]
+        if method == 'bin':
+            atlas_block = (atlas_block >= param.threshold_atlas).astype(atlas_block.dtype)
+        elif method == 'wath':
+            atlas_block[atlas_block < param.threshold_atlas] = 0
+        if positive_only:
+            atlas_block[atlas_block < ALMOST_ZERO] = 0
+        sum_tract[i_start:i_start + nb_tracts_block] = np.sum(atlas_block, axis=0, dtype=np.float64)
+    return sum_tract
+
+
 # ==========================================================================================
 def get_parser():
     # Initialize the parser
@@ -14,6 +14,7 @@ import sys
 import time
 import os
 import numpy as np
+from scipy.ndimage import distance_transform_edt
 import sct_utils as sct
 from msct_image import Image, get_dimension
 from sct_image import set_orientation
@@ -57,87 +58,62 @@ class Thinning:
             self.thinned_image = Image(param=thinned_data, absolutepath=self.image.path + self.image.file_name + '_thinned' + self.image.ext, hdr=self.image.hdr)
 
     # ------------------------------------------------------------------------------------------------------------------
-    def get_neighbours(self, x, y, image):
+    def get_neighbours(self, image):
         """
-        Return 8-neighbours of image point P1(x,y), in a clockwise order
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param x:
-        :param y:
+        Return 8-neighbours of all the image points P1(x,y), in a clockwise order
+        As in the original point-wise implementation, the index x-1 (resp. y-1) wraps around for x=0 (resp. y=0)
         :param image:
-        :return:
+        :return: list of 8 arrays of the same shape as image: P2,P3,P4,P5,P6,P7,P8,P9
         """
-        # now = time.time()
-        x_1, y_1, x1, y1 = x - 1, y - 1, x + 1, y + 1
-        neighbours = [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],     # P2,P3,P4,P5
-                      image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]    # P6,P7,P8,P9
-        # t = time.time() - now
-        # print 't neighbours: ', t
-        return neighbours
+        def shifted(dx, dy):
+            # value at [x, y] is image[x + dx, y + dy]
+            return np.roll(np.roll(image, -dx, axis=0), -dy, axis=1)
+        return [shifted(-1, 0), shifted(-1, 1), shifted(0, 1), shifted(1, 1),     # P2,P3,P4,P5
+                shifted(1, 0), shifted(1, -1), shifted(0, -1), shifted(-1, -1)]   # P6,P7,P8,P9
 
     # ------------------------------------------------------------------------------------------------------------------
     def transitions(self, neighbours):
         """
-        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param neighbours:
+        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence, for all the image points
+        :param neighbours: list of 8 arrays, as returned by get_neighbours
         :return:
         """
-        # now = time.time()
         n = neighbours + neighbours[0:1]      # P2, P3, ... , P8, P9, P2
-        s = np.sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
-        # t = time.time() - now
-        # print 't transitions sum: ', t
-        return s
+        return np.sum([(n1 == 0) & (n2 == 1) for n1, n2 in zip(n, n[1:])], axis=0)  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
 
     # ------------------------------------------------------------------------------------------------------------------
     def zhang_suen(self, image):
         """
         the Zhang-Suen Thinning Algorithm
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
+        adapted from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
+        Each sub-iteration evaluates the conditions on all the points at once, then removes the selected points.
         :param image:
         :return:
         """
-        # now = time.time()
         image_thinned = image.copy()  # deepcopy to protect the original image
-        changing1 = changing2 = 1  # the points to be removed (set as 0)
-        while changing1 or changing2:  # iterates until no further changes occur in the image
-            # Step 1
-            changing1 = []
-            max = len(image_thinned) - 1
-            pass_list = [1, max]
-            # rows, columns = image_thinned.shape  # x for rows, y for columns
-
-            # for x in range(1, rows - 1):         # No. of  rows
-            # for y in range(1, columns - 1):  # No. of columns
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0: Point P1 in the object regions
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and    # Condition 1: 2<= N(P1) <= 6
-                        P2 * P4 * P6 == 0 and    # Condition 3
-                        P4 * P6 * P8 == 0 and   # Condition 4
-                        self.transitions(n) == 1):    # Condition 2: S(P1)=1
-                        changing1.append((x, y))
-            for x, y in changing1:
-                image_thinned[x][y] = 0
-            # Step 2
-            changing2 = []
-
-            # for x in range(1, rows - 1):
-            # for y in range(1, columns - 1):
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and       # Condition 1
-                        P2 * P4 * P8 == 0 and       # Condition 3
-                        P2 * P6 * P8 == 0 and  # Condition 4
-                        self.transitions(n) == 1):    # Condition 2
-                        changing2.append((x, y))
-            for x, y in changing2:
-                image_thinned[x][y] = 0
-        # t = time.time() - now
-        # print 't thinning: ', t
+        # points that are never removed (rows and columns 1 and max)
+        max = len(image_thinned) - 1
+        pass_list = [1, max]
+        mask_pass = np.zeros(image_thinned.shape, dtype=bool)
+        mask_pass[[i for i in pass_list if i < image_thinned.shape[0]], :] = True
+        mask_pass[:, [i for i in pass_list if i < image_thinned.shape[1]]] = True
+
+        changing = True
+        while changing:  # iterates until no further changes occur in the image
+            changing = False
+            for step in [1, 2]:
+                P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(image_thinned)
+                sum_n = np.sum(n, axis=0)
+                if step == 1:
+                    cond_3, cond_4 = P2 * P4 * P6 == 0, P4 * P6 * P8 == 0  # Conditions 3 and 4 of step 1
+                else:
+                    cond_3, cond_4 = P2 * P4 * P8 == 0, P2 * P6 * P8 == 0  # Conditions 3 and 4 of step 2
+                changing_step = ((image_thinned > 0) & ~mask_pass &  # Condition 0: Point P1 in the object regions
+                                 (2 <= sum_n) & (sum_n <= 6) &       # Condition 1: 2<= N(P1) <= 6
+                                 cond_3 & cond_4 &
+                                 (self.transitions(n) == 1))         # Condition 2: S(P1)=1
+                image_thinned[changing_step] = 0
+                changing = changing or changing_step.any()
         return image_thinned
 
 
@@ -168,23 +144,15 @@ class HausdorffDistance:
 
     # ------------------------------------------------------------------------------------------------------------------
     def relative_hausdorff_dist(self, dat1, dat2, v=1):
+        """
+        Distance from each non-zero point of dat1 to the nearest non-zero point of dat2, using an exact Euclidean
+        distance transform of dat2
+        :return: array of the same shape as dat1, with the distances at the non-zero points of dat1 and 0 elsewhere
+        """
         h = np.zeros(dat1.shape)
-        nz_coord_1 = non_zero_coord(dat1)
-        nz_coord_2 = non_zero_coord(dat2)
-        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0 :
-            for x1, y1 in nz_coord_1:
-                # for x1 in range(dat1.shape[0]):
-                # for y1 in range(dat1.shape[1]):
-                # if dat1[x1, y1] == 1:
-                d_p1_dat2 = []
-                p1 = np.asarray([x1, y1])
-                for x2, y2 in nz_coord_2:
-                    # for x2 in range(dat2.shape[0]):
-                    # for y2 in range(dat2.shape[1]):
-                    # if dat2[x2, y2] == 1:
-                    p2 = np.asarray([x2, y2])
-                    d_p1_dat2.append(np.linalg.norm(p1 - p2))  # Euclidean distance between p1 and p2
-                h[x1, y1] = min(d_p1_dat2)
+        if np.any(dat1) and np.any(dat2):
+            dist_to_dat2 = distance_transform_edt(dat2 == 0)
+            h[dat1 > 0] = dist_to_dat2[dat1 > 0]
         else:
             sct.printv('Warning: an image is empty', v, 'warning')
         return h
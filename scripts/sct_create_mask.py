@@ -20,14 +20,9 @@ import commands
 import time
 
 import numpy
-import nibabel
-from scipy import ndimage
 
 import sct_utils as sct
-from sct_image import get_orientation
-from sct_convert import convert
 from msct_image import Image
-from sct_image import copy_header, concat_data
 from msct_parser import Parser
 
 
@@ -45,7 +40,6 @@ class Param:
         self.even = 0
         self.file_prefix = 'mask_'  # output prefix
         self.verbose = 1
-        self.remove_tmp_files = 1
         self.offset = '0,0'
 param = Param()
 param_default = Param()
@@ -67,7 +61,6 @@ def main(args=None):
         param.process = 'point,' + path_sct_data + '/mt/mt1_point.nii.gz'  # 'centerline,/Users/julien/data/temp/sct_example_data/t2/t2_centerlinerpi.nii.gz'  #coord,68x69'
         param.shape = 'cylinder'
         param.size = '20'
-        param.remove_tmp_files = 1
         param.verbose = 1
     else:
         # Check input parameters
@@ -86,8 +79,6 @@ def main(args=None):
             param.shape = arguments['-f']
         if '-o' in arguments:
             param.fname_out = arguments['-o']
-        if '-r' in arguments:
-            param.remove_tmp_files = int(arguments['-r'])
         if '-v' in arguments:
             param.verbose = int(arguments['-v'])
 
@@ -98,7 +89,6 @@ def main(args=None):
 # create_mask
 #=======================================================================================================================
 def create_mask():
-    fsloutput = 'export FSLOUTPUTTYPE=NIFTI; '  # for faster processing, all outputs are in NIFTI
 
     # parse argument for method
     method_type = param.process[0]
@@ -107,7 +97,7 @@ def create_mask():
         method_val = param.process[1]
 
     # check existence of input files
-    if method_type == 'centerline':
+    if method_type in ['centerline', 'point']:
         sct.check_file_exist(method_val, param.verbose)
 
     # Extract path/file/extension
@@ -117,162 +107,69 @@ def create_mask():
     if param.fname_out == '':
         param.fname_out = param.file_prefix + file_data + ext_data
 
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', param.verbose)
-    path_tmp = sct.tmp_create(param.verbose)
-    # )sct.slash_at_the_end('tmp.'+time.strftime("%y%m%d%H%M%S"), 1)
-    # sct.run('mkdir '+path_tmp, param.verbose)
-
     sct.printv('\nCheck orientation...', param.verbose)
-    orientation_input = get_orientation(Image(param.fname_data))
+    im_data = Image(param.fname_data)
+    orientation_input = im_data.orientation
     sct.printv('.. ' + orientation_input, param.verbose)
-    reorient_coordinates = False
-
-    # copy input data to tmp folder
-    convert(param.fname_data, path_tmp + 'data.nii')
-    if method_type == 'centerline':
-        convert(method_val, path_tmp + 'centerline.nii.gz')
-    if method_type == 'point':
-        convert(method_val, path_tmp + 'point.nii.gz')
-
-    # go to tmp folder
-    os.chdir(path_tmp)
 
-    # reorient to RPI
+    # reorient to RPI (in memory, the header is copied back from the input at the end)
     sct.printv('\nReorient to RPI...', param.verbose)
-    # if not orientation_input == 'RPI':
-    sct.run('sct_image -i data.nii -o data_RPI.nii -setorient RPI -v 0', verbose=False)
-    if method_type == 'centerline':
-        sct.run('sct_image -i centerline.nii.gz -o centerline_RPI.nii.gz -setorient RPI -v 0', verbose=False)
-    if method_type == 'point':
-        sct.run('sct_image -i point.nii.gz -o point_RPI.nii.gz -setorient RPI -v 0', verbose=False)
-    #
-    # if method_type == 'centerline':
-    #     orientation_centerline = get_orientation_3d(method_val, filename=True)
-    #     if not orientation_centerline == 'RPI':
-    #         sct.run('sct_image -i ' + method_val + ' -o ' + path_tmp + 'centerline.nii.gz' + ' -setorient RPI -v 0', verbose=False)
-    #     else:
-    #         convert(method_val, path_tmp+'centerline.nii.gz')
+    # in case user input 4d data
+    if im_data.dim[3] != 1:
+        sct.printv('WARNING in ' + os.path.basename(__file__) + ': Input image is 4d but output mask will 3D.', param.verbose, 'warning')
+    data_rpi, dim_rpi = load_data_rpi(im_data)
 
     # Get dimensions of data
     sct.printv('\nGet dimensions of data...', param.verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image('data_RPI.nii').dim
-    sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), param.verbose)
-    # in case user input 4d data
-    if nt != 1:
-        sct.printv('WARNING in ' + os.path.basename(__file__) + ': Input image is 4d but output mask will 3D.', param.verbose, 'warning')
-        # extract first volume to have 3d reference
-        nii = Image('data_RPI.nii')
-        data3d = nii.data[:, :, :, 0]
-        nii.data = data3d
-        nii.save()
+    nx, ny, nz = data_rpi.shape
+    px, py = dim_rpi[4], dim_rpi[5]
+    sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(im_data.dim[3]), param.verbose)
 
     if method_type == 'coord':
         # parse to get coordinate
         coord = map(int, method_val.split('x'))
 
     if method_type == 'point':
-        # get file name
-        fname_point = method_val
-        # extract coordinate of point
+        # extract coordinate of point (lowest label along z)
         sct.printv('\nExtract coordinate of point...', param.verbose)
-        # TODO: change this way to remove dependence to sct.run. ProcessLabels.display_voxel returns list of coordinates
-        status, output = sct.run('sct_label_utils -i point_RPI.nii.gz -display', param.verbose)
-        # parse to get coordinate
-        coord = output[output.find('Position=') + 10:-17].split(',')
+        data_point, _ = load_data_rpi(Image(method_val))
+        x_point, y_point, z_point = data_point.nonzero()
+        if len(z_point) == 0:
+            sct.printv('ERROR in ' + os.path.basename(__file__) + ': Point image is empty.', 1, 'error')
+        ind_point = numpy.argmin(z_point)
+        coord = x_point[ind_point], y_point[ind_point]
 
     if method_type == 'center':
         # set coordinate at center of FOV
         coord = round(float(nx) / 2), round(float(ny) / 2)
 
     if method_type == 'centerline':
-        # get name of centerline from user argument
-        fname_centerline = 'centerline_RPI.nii.gz'
+        # get center of mass of the centerline on each slice
+        sct.printv('\nGet center of mass of the centerline...', param.verbose)
+        data_centerline, _ = load_data_rpi(Image(method_val))
+        cx, cy, z_not_null = center_of_mass_per_slice(data_centerline)
     else:
-        # generate volume with line along Z at coordinates 'coord'
-        sct.printv('\nCreate line...', param.verbose)
-        fname_centerline = create_line('data_RPI.nii', coord, nz)
+        # line along Z at coordinates 'coord'
+        cx = numpy.ones(nz) * int(coord[0])
+        cy = numpy.ones(nz) * int(coord[1])
+        z_not_null = numpy.ones(nz, dtype=bool)
 
     # create mask
     sct.printv('\nCreate mask...', param.verbose)
-    centerline = nibabel.load(fname_centerline)  # open centerline
-    hdr = centerline.get_header()  # get header
-    hdr.set_data_dtype('uint8')  # set imagetype to uint8
-    spacing = hdr.structarr['pixdim']
-    data_centerline = centerline.get_data()  # get centerline
-    # if data is 2D, reshape with empty third dimension
-    if len(data_centerline.shape) == 2:
-        data_centerline_shape = list(data_centerline.shape)
-        data_centerline_shape.append(1)
-        data_centerline = data_centerline.reshape(data_centerline_shape)
-    z_centerline_not_null = [iz for iz in range(0, nz, 1) if data_centerline[:, :, iz].any()]
-    # get center of mass of the centerline
-    cx = [0] * nz
-    cy = [0] * nz
-    for iz in range(0, nz, 1):
-        if iz in z_centerline_not_null:
-            cx[iz], cy[iz] = ndimage.measurements.center_of_mass(numpy.array(data_centerline[:, :, iz]))
-    # create 2d masks
-    file_mask = 'data_mask'
-    for iz in range(nz):
-        if iz not in z_centerline_not_null:
-            # write an empty nifty volume
-            img = nibabel.Nifti1Image(data_centerline[:, :, iz], None, hdr)
-            nibabel.save(img, (file_mask + str(iz) + '.nii'))
-        else:
-            center = numpy.array([cx[iz], cy[iz]])
-            mask2d = create_mask2d(center, param.shape, param.size, nx, ny, even=param.even, spacing=spacing)
-            # Write NIFTI volumes
-            img = nibabel.Nifti1Image(mask2d, None, hdr)
-            nibabel.save(img, (file_mask + str(iz) + '.nii'))
-    # merge along Z
-    # cmd = 'fslmerge -z mask '
-
-    # CHANGE THAT CAN IMPACT SPEED:
-    # related to issue #755, we cannot open more than 256 files at one time.
-    # to solve this issue, we do not open more than 100 files
-    '''
-    im_list = []
-    im_temp = []
-    for iz in range(nz_not_null):
-        if iz != 0 and iz % 100 == 0:
-            im_temp.append(concat_data(im_list, 2))
-            im_list = [Image(file_mask + str(iz) + '.nii')]
-        else:
-            im_list.append(Image(file_mask+str(iz)+'.nii'))
-
-    if im_temp:
-        im_temp.append(concat_data(im_list, 2))
-        im_out = concat_data(im_temp, 2, no_expand=True)
-    else:
-        im_out = concat_data(im_list, 2)
-    '''
-    fname_list = [file_mask + str(iz) + '.nii' for iz in range(nz)]
-    im_out = concat_data(fname_list, dim=2)
-    im_out.setFileName('mask_RPI.nii.gz')
-    im_out.save()
-
-    # reorient if necessary
-    # if not orientation_input == 'RPI':
-    sct.run('sct_image -i mask_RPI.nii.gz -o mask.nii.gz -setorient ' + orientation_input, param.verbose)
-
-    # copy header input --> mask
-    im_dat = Image('data.nii')
-    im_mask = Image('mask.nii.gz')
-    im_mask = copy_header(im_dat, im_mask)
-    im_mask.save()
+    data_mask = create_mask3d(cx, cy, z_not_null, param.shape, param.size, nx, ny, spacing=[0, px, py])
 
-    # come back to parent folder
-    os.chdir('..')
+    # reorient to input orientation and copy header input --> mask
+    im_mask = Image(param=data_mask, hdr=im_data.hdr.copy(), orientation='RPI', dim=dim_rpi, absolutepath=param.fname_out)
+    im_mask.change_orientation(orientation_input)
+    if param.shape == 'gaussian':
+        im_mask.changeType('float32')
+    else:
+        im_mask.changeType('uint8')
 
     # Generate output files
     sct.printv('\nGenerate output files...', param.verbose)
-    sct.generate_output_file(path_tmp + 'mask.nii.gz', param.fname_out)
-
-    # Remove temporary files
-    if param.remove_tmp_files == 1:
-        sct.printv('\nRemove temporary files...', param.verbose)
-        sct.run('rm -rf ' + path_tmp, param.verbose, error_exit='warning')
+    im_mask.save()
+    sct.printv('  File created: ' + param.fname_out, param.verbose)
 
     # to view results
     sct.printv('\nDone! To view results, type:', param.verbose)
@@ -280,68 +177,93 @@ def create_mask():
     print
 
 
-# create_line
+# load_data_rpi
+# ==========================================================================================
+def load_data_rpi(im):
+    """
+    Get the first 3D volume of an image, reoriented to RPI in memory (the header is not changed).
+    :param im: Image
+    :return: data (nx, ny, nz) in RPI, dim in RPI
+    """
+    im_rpi = Image(param=im.data, hdr=im.hdr, orientation=im.orientation, dim=im.dim)
+    nx, ny, nz = im.dim[0:3]
+    if im_rpi.data.ndim == 4:
+        im_rpi.data = im_rpi.data[:, :, :, 0]
+    im_rpi.data = im_rpi.data.reshape(nx, ny, nz)
+    im_rpi.change_orientation('RPI')
+    return im_rpi.data, im_rpi.dim
+
+
+# center_of_mass_per_slice
 # ==========================================================================================
-def create_line(fname, coord, nz):
+def center_of_mass_per_slice(data):
+    """
+    Compute the center of mass of each axial slice of a 3D volume.
+    :param data: 3D array (nx, ny, nz)
+    :return: cx, cy: coordinates of the center of mass along z (0 on empty slices), z_not_null: boolean array along z
+    """
+    data = numpy.asarray(data, dtype=float)
+    nx, ny, nz = data.shape
+    z_not_null = (data != 0).any(axis=(0, 1))
+    sum_slice = data.sum(axis=(0, 1))
+    sum_slice[~z_not_null] = 1
+    cx = numpy.dot(numpy.arange(nx), data.sum(axis=1)) / sum_slice
+    cy = numpy.dot(numpy.arange(ny), data.sum(axis=0)) / sum_slice
+    cx[~z_not_null] = 0
+    cy[~z_not_null] = 0
+    return cx, cy, z_not_null
+
+
+# create_mask3d
+# ==========================================================================================
+def create_mask3d(cx, cy, z_not_null, shape, size, nx, ny, spacing=None):
+    """
+    Create a 3D mask by broadcasting the 2D profile (box, cylinder or gaussian) centered on (cx, cy) over all slices.
+    :param cx, cy: center of the mask along z (arrays of size nz)
+    :param z_not_null: boolean array of size nz. Slices where it is False are left empty.
+    :return: mask (nx, ny, nz)
+    """
+    offset = param.offset.split(',')
+    offset[0] = int(offset[0])
+    offset[1] = int(offset[1])
 
-    # duplicate volume (assumes input file is nifti)
-    sct.run('cp ' + fname + ' line.nii', param.verbose)
+    radius = get_radius(size, spacing)
 
-    # set all voxels to zero
-    sct.run('sct_maths -i line.nii -mul 0 -o line.nii', param.verbose)
+    # initialize 3d grid
+    xx = numpy.arange(nx).reshape(nx, 1, 1)
+    yy = numpy.arange(ny).reshape(1, ny, 1)
+    xc = numpy.asarray(cx, dtype=float).reshape(1, 1, -1)
+    yc = numpy.asarray(cy, dtype=float).reshape(1, 1, -1)
 
-    cmd = 'sct_label_utils -i line.nii -o line.nii -create-add '
-    for iz in range(nz):
-        if iz == nz - 1:
-            cmd += str(int(coord[0])) + ',' + str(int(coord[1])) + ',' + str(iz) + ',1'
-        else:
-            cmd += str(int(coord[0])) + ',' + str(int(coord[1])) + ',' + str(iz) + ',1:'
+    if shape == 'box':
+        x_min, x_max = numpy.maximum(numpy.trunc(xc - radius), 0), numpy.trunc(xc + radius)
+        y_min, y_max = numpy.maximum(numpy.trunc(yc - radius), 0), numpy.trunc(yc + radius)
+        mask = ((xx >= x_min) & (xx <= x_max) & (yy >= y_min) & (yy <= y_max)) * 1
+
+    elif shape == 'cylinder':
+        mask = ((xx + offset[0] - xc)**2 + (yy + offset[1] - yc)**2 <= radius**2) * 1
 
-    sct.run(cmd, param.verbose)
+    elif shape == 'gaussian':
+        sigma = float(radius)
+        mask = numpy.exp(-(((xx + offset[0] - xc)**2) / (2 * (sigma**2)) + ((yy + offset[1] - yc)**2) / (2 * (sigma**2))))
 
-    return 'line.nii'
+    return mask * z_not_null.reshape(1, 1, -1)
 
 
-# create_mask2d
+# get_radius
 # ==========================================================================================
-def create_mask2d(center, shape, size, nx, ny, even=0, spacing=None):
+def get_radius(size, spacing=None):
     # extract offset d = 2r+1 --> r=ceil((d-1)/2.0)
     # s=11 -> r=5
     # s=10 -> r=5
-    offset = param.offset.split(',')
-    offset[0] = int(offset[0])
-    offset[1] = int(offset[1])
-
-    # initialize 2d grid
-    xx, yy = numpy.mgrid[:nx, :ny]
-    mask2d = numpy.zeros((nx, ny))
-    xc = center[0]
-    yc = center[1]
     if 'mm' in size:
-        from numpy import ceil
         size = int(size[:-2])
         mean_spacing_xy = (spacing[1] + spacing[2]) / 2.0
         length = round(float(size) / mean_spacing_xy)
-        radius = ceil((int(length) - 1) / 2.0)
+        radius = numpy.ceil((int(length) - 1) / 2.0)
     else:
-        from numpy import ceil
-        radius = ceil((int(size) - 1) / 2.0)
-
-    if shape == 'box':
-        mask2d[int(xc - radius):int(xc + radius) + 1, int(yc - radius):int(yc + radius) + 1] = 1
-
-    elif shape == 'cylinder':
-        mask2d = ((xx + offset[0] - xc)**2 + (yy + offset[1] - yc)**2 <= radius**2) * 1
-
-    elif shape == 'gaussian':
-        sigma = float(radius)
-        mask2d = numpy.exp(-(((xx + offset[0] - xc)**2) / (2 * (sigma**2)) + ((yy + offset[1] - yc)**2) / (2 * (sigma**2))))
-
-    # import matplotlib.pyplot as plt
-    # plt.imshow(mask2d)
-    # plt.show()
-
-    return mask2d
+        radius = numpy.ceil((int(size) - 1) / 2.0)
+    return radius
 
 
 def get_parser():
@@ -396,10 +318,10 @@ def get_parser():
                       example=['data.nii'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
-                      description='Remove temporary files.',
+                      description='Remove temporary files. No temporary file is created anymore: this option has no effect.',
                       mandatory=False,
-                      default_value='1',
-                      example=['0', '1'])
+                      example=['0', '1'],
+                      deprecated=True)
     parser.add_option(name="-v",
                       type_value='multiple_choice',
                       description="verbose: 0 = nothing, 1 = classic, 2 = expended",
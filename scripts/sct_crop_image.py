@@ -17,11 +17,12 @@ import time
 
 from msct_parser import Parser
 import os
-import scipy
-import nibabel
 import sct_utils as sct
 from msct_image import Image
 
+misc = sct.lazy_import('scipy.misc')
+nibabel = sct.lazy_import('nibabel')
+
 
 class LineBuilder:
     def __init__(self, line):
@@ -211,7 +212,7 @@ class ImageCropper(object):
         sct.printv('\nGet image of medial slab...', verbose)
         image_array = nibabel.load('data_rpi.nii').get_data()
         nx, ny, nz = image_array.shape
-        scipy.misc.imsave('image.jpg', image_array[math.floor(nx / 2), :, :])
+        misc.imsave('image.jpg', image_array[math.floor(nx / 2), :, :])
 
         # Display the image
         sct.printv('\nDisplay image and get cropping region...', verbose)
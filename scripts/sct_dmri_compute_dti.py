@@ -11,6 +11,9 @@
 #########################################################################################
 
 import sys
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
 
 from msct_parser import Parser
 from sct_utils import printv
@@ -19,6 +22,8 @@ from sct_utils import printv
 class Param:
     def __init__(self):
         self.verbose = 1
+        self.nb_cpu = cpu_count()  # number of processes fitting the tensor in parallel
+        self.nb_voxels_per_chunk = 10000  # number of voxels fitted at once by a process
 
 
 # PARSER
@@ -67,6 +72,18 @@ def get_parser():
                       description='Output prefix.',
                       mandatory=False,
                       default_value='dti_')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used to fit the tensor. 0: use all the available cores.",
+                      mandatory=False,
+                      default_value='0',
+                      example='4')
+    parser.add_option(name="-chunk",
+                      type_value="int",
+                      description="Number of voxels fitted at once by each process. Reduce it to lower the memory usage.",
+                      mandatory=False,
+                      default_value=param.nb_voxels_per_chunk,
+                      example='10000')
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose. 0: nothing. 1: basic. 2: extended.""",
@@ -97,6 +114,14 @@ def main(args = None):
     if "-m" in arguments:
         file_mask = arguments['-m']
     param.verbose = int(arguments['-v'])
+    param.nb_cpu = int(arguments['-cpu-nb'])
+    if param.nb_cpu < 0:
+        printv('ERROR: -cpu-nb must be positive, or 0 to use all available CPUs.', 1, 'error')
+    if param.nb_cpu == 0:
+        param.nb_cpu = cpu_count()
+    param.nb_voxels_per_chunk = int(arguments['-chunk'])
+    if param.nb_voxels_per_chunk < 1:
+        printv('ERROR: -chunk must be at least 1.', 1, 'error')
 
     # compute DTI
     if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
@@ -108,6 +133,9 @@ def main(args = None):
 def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
     """
     Compute DTI.
+    The tensor is fitted on the voxels of the mask (all voxels if no mask) by chunks of
+    param.nb_voxels_per_chunk voxels, distributed on param.nb_cpu processes. The scalar maps of each chunk
+    are written into the output volumes as soon as it is fitted.
     :param fname_in: input 4d file.
     :param bvals: bvals txt file
     :param bvecs: bvecs txt file
@@ -124,60 +152,94 @@ def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
     # open bvecs/bvals
     from dipy.io import read_bvals_bvecs
     bvals, bvecs = read_bvals_bvecs(fname_bvals, fname_bvecs)
-    from dipy.core.gradients import gradient_table
-    gtab = gradient_table(bvals, bvecs)
 
-    # mask and crop the data. This is a quick way to avoid calculating Tensors on the background of the image.
+    # mask the data. This is a quick way to avoid calculating Tensors on the background of the image.
     if not file_mask == '':
         printv('Open mask file...', param.verbose)
         # open mask file
         nii_mask = Image(file_mask)
-        mask = nii_mask.data
+        mask = nii_mask.data > 0
+    else:
+        mask = np.ones(data.shape[:3], dtype=bool)
+    index_voxels = np.flatnonzero(mask)
 
-    # fit tensor model
-    printv('Computing tensor using "' + method + '" method...', param.verbose)
-    import dipy.reconst.dti as dti
-    if method == 'standard':
-        tenmodel = dti.TensorModel(gtab)
-        if file_mask == '':
-            tenfit = tenmodel.fit(data)
-        else:
-            tenfit = tenmodel.fit(data, mask)
-    elif method == 'restore':
+    # noise level for RESTORE is estimated on the whole volume
+    sigma = None
+    if method == 'restore':
         import dipy.denoise.noise_estimate as ne
         sigma = ne.estimate_sigma(data)
-        dti_restore = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
-        if file_mask == '':
-            tenfit = dti_restore.fit(data)
-        else:
-            tenfit = dti_restore.fit(data, mask)
-
-    # Compute metrics
-    printv('Computing metrics...', param.verbose)
-    # FA
-    from dipy.reconst.dti import fractional_anisotropy
-    nii.data = fractional_anisotropy(tenfit.evals)
-    nii.setFileName(prefix + 'FA.nii.gz')
-    nii.save('float32')
-    # MD
-    from dipy.reconst.dti import mean_diffusivity
-    nii.data = mean_diffusivity(tenfit.evals)
-    nii.setFileName(prefix + 'MD.nii.gz')
-    nii.save('float32')
-    # RD
-    from dipy.reconst.dti import radial_diffusivity
-    nii.data = radial_diffusivity(tenfit.evals)
-    nii.setFileName(prefix + 'RD.nii.gz')
-    nii.save('float32')
-    # AD
-    from dipy.reconst.dti import axial_diffusivity
-    nii.data = axial_diffusivity(tenfit.evals)
-    nii.setFileName(prefix + 'AD.nii.gz')
-    nii.save('float32')
+
+    # fit tensor model
+    printv('Computing tensor using "' + method + '" method on ' + str(len(index_voxels)) + ' voxels (' + str(param.nb_cpu) + ' CPUs)...', param.verbose)
+    list_chunks = [index_voxels[i:i + param.nb_voxels_per_chunk] for i in range(0, len(index_voxels), param.nb_voxels_per_chunk)]
+    # signals are gathered for one chunk per process at a time, so only the chunks being fitted are copied in memory
+    nb_chunks_per_batch = param.nb_cpu
+    list_batches = [list_chunks[i:i + nb_chunks_per_batch] for i in range(0, len(list_chunks), nb_chunks_per_batch)]
+
+    # FA, MD, RD and AD maps
+    metrics = np.zeros((4, mask.size), dtype=np.float32)
+    if param.nb_cpu > 1 and len(list_chunks) > 1:
+        pool = Pool(param.nb_cpu, initializer=init_tensor_model, initargs=(bvals, bvecs, method, sigma))
+        try:
+            for batch in list_batches:
+                signals = [data[np.unravel_index(index_chunk, mask.shape)] for index_chunk in batch]
+                for index_chunk, metrics_chunk in zip(batch, pool.map(fit_tensor, signals)):
+                    metrics[:, index_chunk] = metrics_chunk
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        init_tensor_model(bvals, bvecs, method, sigma)
+        for index_chunk in list_chunks:
+            metrics[:, index_chunk] = fit_tensor(data[np.unravel_index(index_chunk, mask.shape)])
+
+    # Write metrics
+    printv('Writing metrics...', param.verbose)
+    for metric, name in zip(metrics, ['FA', 'MD', 'RD', 'AD']):
+        nii.data = metric.reshape(mask.shape)
+        nii.setFileName(prefix + name + '.nii.gz')
+        nii.save('float32')
 
     return True
 
 
+# Tensor model of the current process, set by init_tensor_model()
+tensor_model = None
+
+
+def init_tensor_model(bvals, bvecs, method, sigma=None):
+    """
+    Build the tensor model used by fit_tensor() in the current process.
+    :param bvals: array of b-values
+    :param bvecs: (n, 3) array of b-vectors
+    :param method: 'standard' or 'restore'
+    :param sigma: noise standard deviation, needed by RESTORE
+    """
+    global tensor_model
+    from dipy.core.gradients import gradient_table
+    import dipy.reconst.dti as dti
+    gtab = gradient_table(bvals, bvecs)
+    if method == 'restore':
+        tensor_model = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
+    else:
+        tensor_model = dti.TensorModel(gtab)
+
+
+def fit_tensor(signal):
+    """
+    Fit the tensor on a chunk of voxels and compute its scalar maps.
+    :param signal: (nb_voxels, nb_volumes) diffusion signal
+    :return: (4, nb_voxels) float32 array of FA, MD, RD and AD
+    """
+    from dipy.reconst.dti import fractional_anisotropy, mean_diffusivity, radial_diffusivity, axial_diffusivity
+    evals = tensor_model.fit(signal).evals
+    return np.array([fractional_anisotropy(evals), mean_diffusivity(evals), radial_diffusivity(evals),
+                     axial_diffusivity(evals)], dtype=np.float32)
+
+
 # # Get bvecs
 # # ==========================================================================================
 # def get_bvecs(fname):
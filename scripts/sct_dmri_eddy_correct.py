@@ -21,6 +21,7 @@ import commands
 import getopt
 import time
 import numpy as np
+from multiprocessing import Pool, cpu_count
 from msct_image import Image
 import sct_utils as sct
 # get path of the toolbox
@@ -45,6 +46,7 @@ class Param:
         self.merge_back                = 1
         self.verbose                   = 0
         self.plot_graph                = 0
+        self.nb_cpu                    = cpu_count()              # number of flirt registrations run in parallel
 
 
 #=======================================================================================================================
@@ -55,7 +57,7 @@ def main():
 
     # Check input parameters
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hi:c:b:g:m:o:p:r:s:v:')
+        opts, args = getopt.getopt(sys.argv[1:], 'hi:c:b:g:m:n:o:p:r:s:v:')
     except getopt.GetoptError:
         usage()
     if not opts:
@@ -73,6 +75,8 @@ def main():
             param.plot_graph = int(arg)
         elif opt in ('-m'):
             param.mat_eddy = arg
+        elif opt in ('-n'):
+            param.nb_cpu = int(arg)
         elif opt in ('-o'):
             param.output_path = arg
         elif opt in ('-p'):
@@ -161,16 +165,11 @@ def eddy_correct(param):
     nx, ny, nz, nt, px, py, pz, pt = Image(fname_data).dim
     sct.printv('.. ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
 
-    # split along T dimension
-    sct.printv('\nSplit along T dimension...', verbose)
-    from sct_image import split_data
-    im_to_split = Image(fname_data_new + '.nii')
-    im_split_list = split_data(im_to_split, 3)
-    for im in im_split_list:
-        im.save()
-
-    # cmd = fsloutput + 'fslsplit ' + fname_data_new + ' ' + file_data + '_T'
-    # status, output = sct.run(cmd,verbose)
+    # load data
+    im_data = Image(fname_data_new + '.nii')
+    data = im_data.data
+    # FSL coordinates are flipped along x for images in neurological convention
+    flip_x = np.linalg.det(im_data.hdr.get_best_affine()[:3, :3]) > 0
 
     # Slice-wise or Volume based method
     if param.slicewise:
@@ -224,139 +223,82 @@ def eddy_correct(param):
     # =========================================================================
     #	Find transformation
     # =========================================================================
+    # each pair of opposite gradient directions and each slice is an independent registration
+    sct.printv('\nWrite volumes to register...', verbose)
+    list_registration = []
     for iN in range(nb_oppositeGradients):
         i_plus = opposite_gradients_iT[iN]
         i_minus = opposite_gradients_jT[iN]
-
-        sct.printv(('\nFinding affine transformation between volumes #' + str(i_plus) + ' and #' + str(i_minus) + ' (' + str(iN) + '/' + str(nb_oppositeGradients) + ')'), verbose)
-        sct.printv('------------------------------------------------------------------------------------\n', verbose)
-
-        # Slicewise correction
-        if param.slicewise:
-            sct.printv('\nSplit volumes across Z...', verbose)
-            fname_plus = file_data + '_T' + str(i_plus).zfill(4)
-            fname_plus_Z = file_data + '_T' + str(i_plus).zfill(4) + '_Z'
-            im_plus = Image(fname_plus + '.nii')
-            im_plus_split_list = split_data(im_plus, 2)
-            for im_p in im_plus_split_list:
-                im_p.save()
-            # cmd = fsloutput + 'fslsplit ' + fname_plus + ' ' + fname_plus_Z + ' -z'
-            # status, output = sct.run(cmd,verbose)
-
-            fname_minus = file_data + '_T' + str(i_minus).zfill(4)
-            fname_minus_Z = file_data + '_T' + str(i_minus).zfill(4) + '_Z'
-            im_minus = Image(fname_minus + '.nii')
-            im_minus_split_list = split_data(im_minus, 2)
-            for im_m in im_minus_split_list:
-                im_m.save()            # cmd = fsloutput + 'fslsplit ' + fname_minus + ' ' + fname_minus_Z + ' -z'
-            # status, output = sct.run(cmd,verbose)
-
-        # loop across Z
         for iZ in range(nb_loops):
             fname_plus = file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ]
-
             fname_minus = file_data + '_T' + str(i_minus).zfill(4) + file_suffix[iZ]
-            # Find transformation on opposite gradient directions
-            sct.printv('\nFind transformation for each pair of opposite gradient directions...', verbose)
-            fname_plus_corr = file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ] + '_corr_'
+            z_range = slice(iZ, iZ + 1) if param.slicewise else slice(None)
+            for i_file, fname in [(i_plus, fname_plus), (i_minus, fname_minus)]:
+                Image(param=data[:, :, z_range, i_file], hdr=im_data.hdr.copy(), absolutepath=fname + '.nii').save()
             omat = 'mat_' + file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ] + '.txt'
-            cmd = fsloutput + 'flirt -in ' + fname_plus + ' -ref ' + fname_minus + ' -paddingsize 3 -schedule ' + schedule_file + ' -verbose 2 -omat ' + omat + ' -cost ' + cost_function + ' -forcescaling'
-            status, output = sct.run(cmd, verbose)
-
-            file =  open(omat)
-            Matrix = np.loadtxt(file)
-            file.close()
-            M = Matrix[0:4, 0:4]
-            sct.printv(('.. Transformation matrix:\n' + str(M)), verbose)
-            sct.printv(('.. Output matrix file: ' + omat), verbose)
-
-            # Divide affine transformation by two
-            sct.printv('\nDivide affine transformation by two...', verbose)
-            A = (M - np.identity(4)) / 2
-            Mplus = np.identity(4) + A
-            omat_plus = mat_eddy + 'mat.T' + str(i_plus) + '_Z' + str(iZ) + '.txt'
-            file =  open(omat_plus, 'w')
-            np.savetxt(omat_plus, Mplus, fmt='%.6e', delimiter='  ', newline='\n', header='', footer='', comments='#')
-            file.close()
-            sct.printv(('.. Output matrix file (plus): ' + omat_plus), verbose)
-
-            Mminus = np.identity(4) - A
-            omat_minus = mat_eddy + 'mat.T' + str(i_minus) + '_Z' + str(iZ) + '.txt'
-            file =  open(omat_minus, 'w')
-            np.savetxt(omat_minus, Mminus, fmt='%.6e', delimiter='  ', newline='\n', header='', footer='', comments='#')
-            file.close()
-            sct.printv(('.. Output matrix file (minus): ' + omat_minus), verbose)
-
-    # =========================================================================
-    #	Apply affine transformation
-    # =========================================================================
+            list_registration.append((fname_plus, fname_minus, omat, schedule_file, cost_function, verbose))
 
-    sct.printv('\nApply affine transformation matrix', verbose)
-    sct.printv('------------------------------------------------------------------------------------\n', verbose)
+    sct.printv('\nFind transformation for each pair of opposite gradient directions (' + str(len(list_registration)) + ' registrations on ' + str(param.nb_cpu) + ' CPUs)...', verbose)
+    try:
+        if param.nb_cpu > 1:
+            pool = Pool(param.nb_cpu)
+            try:
+                list_matrix = pool.map(register_opposite_gradients, list_registration)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            list_matrix = [register_opposite_gradients(registration) for registration in list_registration]
+    except RuntimeError as e:
+        sct.printv(str(e), 1, 'error')
 
+    # Divide affine transformation by two
+    sct.printv('\nDivide affine transformation by two...', verbose)
+    list_transfo = []  # list of tuple (volume index, slice index, matrix)
     for iN in range(nb_oppositeGradients):
-        for iFile in range(2):
-            if iFile == 0:
-                i_file = opposite_gradients_iT[iN]
-            else:
-                i_file = opposite_gradients_jT[iN]
-
-            for iZ in range(nb_loops):
-                fname = file_data + '_T' + str(i_file).zfill(4) + file_suffix[iZ]
-                fname_corr = fname + '_corr_' + '__div2'
-                omat = mat_eddy + 'mat.T' + str(i_file) + '_Z' + str(iZ) + '.txt'
-                cmd = fsloutput + 'flirt -in ' + fname + ' -ref ' + fname + ' -out ' + fname_corr + ' -init ' + omat + ' -applyxfm -paddingsize 3 -interp ' + param.interp
-                status, output = sct.run(cmd, verbose)
+        i_plus = opposite_gradients_iT[iN]
+        i_minus = opposite_gradients_jT[iN]
+        for iZ in range(nb_loops):
+            M = list_matrix[iN * nb_loops + iZ]
+            sct.printv(('.. Transformation matrix (#' + str(i_plus) + ', #' + str(i_minus) + file_suffix[iZ] + '):\n' + str(M)), verbose)
+            A = (M - np.identity(4)) / 2
+            for i_file, M_div2 in [(i_plus, np.identity(4) + A), (i_minus, np.identity(4) - A)]:
+                omat_div2 = mat_eddy + 'mat.T' + str(i_file) + '_Z' + str(iZ) + '.txt'
+                np.savetxt(omat_div2, M_div2, fmt='%.6e', delimiter='  ', newline='\n', header='', footer='', comments='#')
+                sct.printv(('.. Output matrix file: ' + omat_div2), verbose)
+                list_transfo.append((i_file, iZ, M_div2))
 
     # =========================================================================
-    #	Merge back across Z
+    #	Apply affine transformation
     # =========================================================================
-
-    sct.printv('\nMerge across Z', verbose)
+    sct.printv('\nApply affine transformation matrix', verbose)
     sct.printv('------------------------------------------------------------------------------------\n', verbose)
 
-    for iN in range(nb_oppositeGradients):
-        i_plus = opposite_gradients_iT[iN]
-        fname_plus_corr = file_data + '_T' + str(i_plus).zfill(4) + '_corr_' + '__div2'
-        cmd = fsloutput + 'fslmerge -z ' + fname_plus_corr
-
-        for iZ in range(nz):
-            fname_plus_Z_corr = file_data + '_T' + str(i_plus).zfill(4) + file_suffix[iZ] + '_corr_' + '__div2'
-            cmd = cmd + ' ' + fname_plus_Z_corr
-        status, output = sct.run(cmd, verbose)
-
-        i_minus = opposite_gradients_jT[iN]
-        fname_minus_corr = file_data + '_T' + str(i_minus).zfill(4) + '_corr_' + '__div2'
-        cmd = fsloutput + 'fslmerge -z ' + fname_minus_corr
-
-        for iZ in range(nz):
-            fname_minus_Z_corr = file_data + '_T' + str(i_minus).zfill(4) + file_suffix[iZ] + '_corr_' + '__div2'
-            cmd = cmd + ' ' + fname_minus_Z_corr
-        status, output = sct.run(cmd, verbose)
+    # corrected volumes are assembled in memory, b=0 (and unpaired) volumes are kept as is
+    data_corr = data.astype(np.float32)
+    for i_file, iZ, M_div2 in list_transfo:
+        z_range = slice(iZ, iZ + 1) if param.slicewise else slice(None)
+        data_corr[:, :, z_range, i_file] = apply_flirt_matrix(data[:, :, z_range, i_file], M_div2, im_data.dim[4:7], flip_x, param.interp)
 
     # =========================================================================
-    #	Merge files back
+    #	Write corrected data
     # =========================================================================
-    sct.printv('\nMerge back across T...', verbose)
+    sct.printv('\nWrite corrected data...', verbose)
     sct.printv('------------------------------------------------------------------------------------\n', verbose)
 
     fname_data_corr = param.output_path + file_data + '_eddy'
-    cmd = fsloutput + 'fslmerge -t ' + fname_data_corr
-    path_tmp = os.getcwd()
-    for iT in range(nt):
-        if os.path.isfile((path_tmp + '/' + file_data + '_T' + str(iT).zfill(4) + '_corr_' + '__div2.nii')):
-            fname_data_corr_3d = file_data + '_T' + str(iT).zfill(4) + '_corr_' + '__div2'
-        elif iT in index_b0:
-            fname_data_corr_3d = file_data + '_T' + str(iT).zfill(4)
-
-        cmd = cmd + ' ' + fname_data_corr_3d
-    status, output = sct.run(cmd, verbose)
+    im_data_corr = Image(param=data_corr, hdr=im_data.hdr.copy(), absolutepath=fname_data_corr + '.nii')
+    im_data_corr.changeType('float32')
+    im_data_corr.save()
 
     # Swap back X-Y dimensions
     if param.swapXY == 1:
         fname_data_final = fname_data
         sct.printv('\nSwap back X-Y dimensions', verbose)
-        cmd = fsloutput_temp + 'fslswapdim ' + fname_data_corr + ' -y -x -z ' + fname_data_final
+        cmd = fsloutput + 'fslswapdim ' + fname_data_corr + ' -y -x -z ' + fname_data_final
         status, output = sct.run(cmd, verbose)
     else:
         fname_data_final = fname_data_corr
@@ -368,6 +310,49 @@ def eddy_correct(param):
     sct.printv('===================================================\n\n\n', verbose)
 
 
+#=======================================================================================================================
+# Register a pair of opposite gradient directions
+#=======================================================================================================================
+def register_opposite_gradients(registration):
+    """
+    Find the affine transformation between two volumes (or slices) acquired with opposite gradient directions, using
+    FSL flirt. Run in a separate process when registrations are parallelized.
+    :param registration: tuple (fname_plus, fname_minus, omat, schedule_file, cost_function, verbose)
+    :return: 4x4 transformation matrix (FSL convention)
+    """
+    fname_plus, fname_minus, omat, schedule_file, cost_function, verbose = registration
+    cmd = fsloutput + 'flirt -in ' + fname_plus + ' -ref ' + fname_minus + ' -paddingsize 3 -schedule ' + schedule_file + ' -verbose 2 -omat ' + omat + ' -cost ' + cost_function + ' -forcescaling'
+    # do not exit from a worker process (sys.exit() would hang the pool): raise an exception, which reaches the parent
+    status, output = sct.run(cmd, verbose, error_exit='warning')
+    if status:
+        raise RuntimeError('flirt failed on ' + fname_plus + ':\n' + output)
+    return np.loadtxt(omat)[0:4, 0:4]
+
+
+#=======================================================================================================================
+# Apply a FLIRT transformation in memory
+#=======================================================================================================================
+def apply_flirt_matrix(data, mat, pixdim, flip_x, interp='trilinear'):
+    """
+    Resample data with a FLIRT affine matrix, the reference space being the input space (same as flirt -applyxfm with
+    -ref = -in). Values outside the field of view are extrapolated from the edges.
+    :param data: 3D numpy array
+    :param mat: 4x4 FLIRT matrix, which maps input to reference FSL coordinates (voxel indices scaled by voxel size)
+    :param pixdim: voxel size (px, py, pz)
+    :param flip_x: True if the image is stored in neurological convention, in which case FSL flips the x axis
+    :param interp: trilinear | nearestneighbour | spline | sinc (spline and sinc both use cubic spline interpolation)
+    :return: resampled 3D numpy array
+    """
+    from scipy.ndimage import affine_transform
+    order = {'nearestneighbour': 0, 'trilinear': 1, 'spline': 3, 'sinc': 3}[interp]
+    vox2fsl = np.diag(list(pixdim[:3]) + [1.0])
+    if flip_x:
+        vox2fsl = vox2fsl.dot(np.array([[-1.0, 0, 0, data.shape[0] - 1], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]]))
+    # for each voxel of the output, coordinates in the input
+    out2in = np.linalg.inv(vox2fsl).dot(np.linalg.inv(mat)).dot(vox2fsl)
+    return affine_transform(data.astype(np.float64), out2in[:3, :3], offset=out2in[:3, 3], order=order, mode='nearest')
+
+
 #=======================================================================================================================
 # usage
 #=======================================================================================================================
@@ -390,8 +375,9 @@ def usage():
         '  -o           Specify Output path.\n' \
         '  -s           Set value to 0 for volume based correction. Default value is 1 i.e slicewise correction\n' \
         '  -m           matrix folder \n' \
+        '  -n           Number of flirt registrations run in parallel. Default is the number of CPU cores.\n' \
         '  -c           Cost function FLIRT - mutualinfo | woods | corratio | normcorr | normmi | leastsquares. Default is <normcorr>..\n' \
-        '  -p           Interpolation - Default is trilinear. Additional options: nearestneighbour,sinc,spline.\n' \
+        '  -p           Interpolation - Default is trilinear. Additional options: nearestneighbour,sinc,spline (sinc and spline both use cubic spline).\n' \
         '  -g {0,1}     Set value to 1 for plotting graphs. Default value is 0 \n' \
         '  -r           Set value to 0 for not deleting temp files. Default value is 1 \n' \
         '  -v {0,1}     Set verbose=1 for printing text. Default value is 0 \n' \
@@ -14,14 +14,12 @@
 
 
 import sys
-import math
 import time
 
 import os
-import commands
+import numpy as np
 import sct_utils as sct
 from msct_image import Image
-from sct_image import split_data
 from msct_parser import Parser
 
 
@@ -29,14 +27,13 @@ class Param:
     def __init__(self):
         self.debug = 0
         self.average = 0
-        self.remove_tmp_files = 1
         self.verbose = 1
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold.
 
 
 # MAIN
 # ==========================================================================================
-def main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose, remove_tmp_files):
+def main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose):
 
     # Initialization
     start_time = time.time()
@@ -57,93 +54,38 @@ def main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose, remov
     # Extract path, file and extension
     path_data, file_data, ext_data = sct.extract_fname(fname_data)
 
-    # # get output folder
-    # if path_out == '':
-    #     path_out = ''
-
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', verbose)
-    path_tmp = sct.slash_at_the_end('tmp.' + time.strftime("%y%m%d%H%M%S"), 1)
-    sct.run('mkdir ' + path_tmp, verbose)
-
-    # copy files into tmp folder and convert to nifti
-    sct.printv('\nCopy files into temporary folder...', verbose)
-    ext = '.nii'
-    dmri_name = 'dmri'
+    # output names
     b0_name = 'b0'
     b0_mean_name = b0_name + '_mean'
     dwi_name = 'dwi'
     dwi_mean_name = dwi_name + '_mean'
 
-    from sct_convert import convert
-    if not convert(fname_data, path_tmp + dmri_name + ext):
-        sct.printv('ERROR in convert.', 1, 'error')
-    sct.run('cp ' + fname_bvecs + ' ' + path_tmp + 'bvecs', verbose)
-
-    # go to tmp folder
-    os.chdir(path_tmp)
-
     # Get size of data
-    im_dmri = Image(dmri_name + ext)
+    im_dmri = Image(fname_data)
     sct.printv('\nGet dimensions data...', verbose)
     nx, ny, nz, nt, px, py, pz, pt = im_dmri.dim
     sct.printv('.. ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
 
     # Identify b=0 and DWI images
-    print fname_bvals
     index_b0, index_dwi, nb_b0, nb_dwi = identify_b0(fname_bvecs, fname_bvals, param.bval_min, verbose)
 
-    # Split into T dimension
-    sct.printv('\nSplit along T dimension...', verbose)
-    im_dmri_split_list = split_data(im_dmri, 3)
-    for im_d in im_dmri_split_list:
-        im_d.save()
-
-    # Merge b=0 images
-    sct.printv('\nMerge b=0...', verbose)
-    cmd = 'sct_image -concat t -o ' + b0_name + ext + ' -i '
-    for it in range(nb_b0):
-        cmd = cmd + dmri_name + '_T' + str(index_b0[it]).zfill(4) + ext + ','
-    cmd = cmd[:-1]  # remove ',' at the end of the string
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue
-    status, output = sct.run(cmd, param.verbose)
-
-    # Average b=0 images
-    if average:
-        sct.printv('\nAverage b=0...', verbose)
-        sct.run('sct_maths -i ' + b0_name + ext + ' -o ' + b0_mean_name + ext + ' -mean t', verbose)
-
-    # Merge DWI
-    cmd = 'sct_image -concat t -o ' + dwi_name + ext + ' -i '
-    for it in range(nb_dwi):
-        cmd = cmd + dmri_name + '_T' + str(index_dwi[it]).zfill(4) + ext + ','
-    cmd = cmd[:-1]  # remove ',' at the end of the string
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue
-    status, output = sct.run(cmd, param.verbose)
-
-    # Average DWI images
-    if average:
-        sct.printv('\nAverage DWI...', verbose)
-        sct.run('sct_maths -i ' + dwi_name + ext + ' -o ' + dwi_mean_name + ext + ' -mean t', verbose)
-        # if not average_data_across_dimension('dwi.nii', 'dwi_mean.nii', 3):
-        #     sct.printv('ERROR in average_data_across_dimension', 1, 'error')
-        # sct.run(fsloutput + 'fslmaths dwi -Tmean dwi_mean', verbose)
-
-    # come back to parent folder
-    os.chdir('..')
+    # Select b=0 and DWI volumes
+    sct.printv('\nSelect b=0 and DWI volumes...', verbose)
+    data_dmri = im_dmri.data.reshape(nx, ny, nz, nt)
+    data_b0 = data_dmri[:, :, :, index_b0]
+    data_dwi = data_dmri[:, :, :, index_dwi]
 
     # Generate output files
     sct.printv('\nGenerate output files...', verbose)
-    sct.generate_output_file(path_tmp + b0_name + ext, path_out + b0_name + ext_data, verbose)
-    sct.generate_output_file(path_tmp + dwi_name + ext, path_out + dwi_name + ext_data, verbose)
-    if average:
-        sct.generate_output_file(path_tmp + b0_mean_name + ext, path_out + b0_mean_name + ext_data, verbose)
-        sct.generate_output_file(path_tmp + dwi_mean_name + ext, path_out + dwi_mean_name + ext_data, verbose)
-
-    # Remove temporary files
-    if remove_tmp_files == 1:
-        sct.printv('\nRemove temporary files...', verbose)
-        sct.run('rm -rf ' + path_tmp, verbose)
+    list_output = [(data_b0, b0_name, ''), (data_dwi, dwi_name, '')]
+    if int(average):
+        sct.printv('\nAverage b=0 and DWI...', verbose)
+        list_output += [(np.mean(data_b0, axis=3), b0_mean_name, 'float32'),
+                        (np.mean(data_dwi, axis=3), dwi_mean_name, 'float32')]
+    for data_out, name_out, type_out in list_output:
+        im_out = Image(param=data_out, hdr=im_dmri.hdr.copy(), absolutepath=path_out + name_out + ext_data)
+        im_out.save(type=type_out)
+        sct.printv('  File created: ' + im_out.absolutepath, verbose)
 
     # display elapsed time
     elapsed_time = time.time() - start_time
@@ -151,7 +93,7 @@ def main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose, remov
 
     # to view results
     sct.printv('\nTo view results, type: ', verbose)
-    if average:
+    if int(average):
         sct.printv('fslview b0 b0_mean dwi dwi_mean &\n', verbose)
     else:
         sct.printv('fslview b0 dwi &\n', verbose)
@@ -164,35 +106,21 @@ def identify_b0(fname_bvecs, fname_bvals, bval_min, verbose):
 
     # Identify b=0 and DWI images
     sct.printv('\nIdentify b=0 and DWI images...', verbose)
-    index_b0 = []
-    index_dwi = []
 
     # if bval is not provided
     if not fname_bvals:
         # Open bvecs file
-        #sct.printv('\nOpen bvecs file...', verbose)
-        bvecs = []
-        with open(fname_bvecs) as f:
-            for line in f:
-                bvecs_new = map(float, line.split())
-                bvecs.append(bvecs_new)
+        bvecs = np.loadtxt(fname_bvecs, ndmin=2)
 
         # Check if bvecs file is nx3
-        if not len(bvecs[0][:]) == 3:
+        if not bvecs.shape[1] == 3:
             sct.printv('  WARNING: bvecs file is 3xn instead of nx3. Consider using sct_dmri_transpose_bvecs.', verbose, 'warning')
             sct.printv('  Transpose bvecs...', verbose)
             # transpose bvecs
-            bvecs = zip(*bvecs)
-
-        # get number of lines
-        nt = len(bvecs)
+            bvecs = bvecs.T
 
         # identify b=0 and dwi
-        for it in xrange(0, nt):
-            if math.sqrt(math.fsum([i**2 for i in bvecs[it]])) < 0.01:
-                index_b0.append(it)
-            else:
-                index_dwi.append(it)
+        is_b0 = np.linalg.norm(bvecs, axis=1) < 0.01
 
     # if bval is provided
     else:
@@ -201,16 +129,11 @@ def identify_b0(fname_bvecs, fname_bvals, bval_min, verbose):
         from dipy.io import read_bvals_bvecs
         bvals, bvecs = read_bvals_bvecs(fname_bvals, fname_bvecs)
 
-        # get number of lines
-        nt = len(bvals)
-
         # Identify b=0 and DWI images
-        sct.printv('\nIdentify b=0 and DWI images...', verbose)
-        for it in xrange(0, nt):
-            if bvals[it] < bval_min:
-                index_b0.append(it)
-            else:
-                index_dwi.append(it)
+        is_b0 = np.asarray(bvals) < bval_min
+
+    index_b0 = np.where(is_b0)[0].tolist()
+    index_dwi = np.where(~is_b0)[0].tolist()
 
     # check if no b=0 images were detected
     if index_b0 == []:
@@ -250,7 +173,7 @@ OPTIONAL ARGUMENTS
   -m <bvals>       bvals file. Used to identify low b-values (in case different from 0).
   -o <output>      output folder. Default = local folder.
   -v {0,1}         verbose. Default=""" + str(param_default.verbose) + """
-  -r {0,1}         remove temporary files. Default=""" + str(param_default.remove_tmp_files) + """
+  -r {0,1}         deprecated, has no effect (no temporary file is created).
   -h               help. Show this message
 
 EXAMPLE
@@ -324,10 +247,10 @@ def get_parser():
                       default_value=str(param_default.verbose))
     parser.add_option(name='-r',
                       type_value='multiple_choice',
-                      description='remove temporary files.',
+                      description='Remove temporary files. No temporary file is created anymore: this option has no effect.',
                       mandatory=False,
                       example=['0', '1'],
-                      default_value=str(param_default.remove_tmp_files))
+                      deprecated=True)
 
     return parser
 
@@ -348,7 +271,6 @@ if __name__ == "__main__":
     path_out = ''
     average = param.average
     verbose = param.verbose
-    remove_tmp_files = param.remove_tmp_files
 
     if '-bval' in arguments:
         fname_bvals = arguments['-bval']
@@ -360,7 +282,5 @@ if __name__ == "__main__":
         path_out = arguments['-ofolder']
     if '-v' in arguments:
         verbose = int(arguments['-v'])
-    if '-r' in arguments:
-        remove_tmp_files = int(arguments['-r'])
 
-    main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose, remove_tmp_files)
+    main(fname_data, fname_bvecs, fname_bvals, path_out, average, verbose)
@@ -59,8 +59,8 @@ def get_parser():
     parser.usage.set_description("""This program extracts metrics (e.g., DTI or MTR) within labels. Labels could be a single file or a folder generated with 'sct_warp_template' and containing multiple label files and a label description file (info_label.txt). The labels should be in the same space coordinates as the input image.""")
     # Mandatory arguments
     parser.add_option(name='-i',
-                      type_value='image_nifti',
-                      description='File to extract metrics from.',
+                      type_value=[[','], 'image_nifti'],
+                      description='File to extract metrics from. Several metric files (e.g., FA, MD and MTR) can be separated with ",": labels are then set up once for all the metrics, and one output file is generated per metric, suffixed with the name of the metric file.',
                       mandatory=True,
                       example='FA.nii.gz')
     # Optional arguments
@@ -207,7 +207,12 @@ To compute average MTR in a region defined by a single label file (could be bina
 
 
 def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, fname_output, labels_user, overwrite, fname_normalizing_label, normalization_method, label_to_fix, adv_param_user, fname_output_metric_map, fname_mask_weight):
-    """Main."""
+    """Main.
+    fname_data is the file name of the metric, or a list of file names to extract several metrics at once."""
+
+    if isinstance(fname_data, str):
+        fname_data = [fname_data]
+    nb_metrics = len(fname_data)
 
     # Initialization
     fname_vertebral_labeling = ''
@@ -215,10 +220,10 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     warning_vert_levels = None  # variable used to warn the user in case the vertebral levels he asked don't correspond exactly to the vertebral levels available in the metric data
     verbose = param_default.verbose
     adv_param = param_default.adv_param
-    normalizing_label = []
+    normalizing_label = None
     fixed_label = []
     label_to_fix_fract_vol = None
-    im_weight = None
+    data_weight = None
 
     # check if path_label is a file instead of a folder
     if os.path.isfile(path_label):
@@ -262,7 +267,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
 
     # print parameters
     print '\nChecked parameters:'
-    print '  data ...................... ' + fname_data
+    print '  data ...................... ' + ', '.join(fname_data)
     print '  path to label ............. ' + path_label
     print '  label ..................... ' + labels_user
     print '  method .................... ' + method
@@ -292,85 +297,71 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     # Load data
     # Check if the orientation of the data is RPI
     sct.printv('\nLoad metric image...', verbose)
-    input_im = Image(fname_data)
-    orientation_data = input_im.orientation
+    list_input_im = [Image(fname) for fname in fname_data]
+    orientation_data = list_input_im[0].orientation
+    change_orientation = orientation_data != 'RPI'
 
-    if orientation_data != 'RPI':
+    if change_orientation:
         # If orientation is not RPI, change to RPI and load data
         # metric
         sct.printv('\nChange metric image orientation into RPI and load it...', verbose)
-        input_im.change_orientation(orientation='RPI')
-        # labels
+        for input_im in list_input_im:
+            input_im.change_orientation(orientation='RPI')
         sct.printv('\nChange labels orientation into RPI and load them...', verbose)
-        labels = np.empty([nb_labels], dtype=object)
-        for i_label in range(nb_labels):
-            im_label = Image(path_label + indiv_labels_files[i_label])
-            im_label.change_orientation(orientation='RPI')
-            labels[i_label] = im_label.data
-        # if the "normalization" option is wanted,
-        if fname_normalizing_label:
-            normalizing_label = np.empty([1], dtype=object)  # choose this kind of structure so as to keep easily the compatibility with the rest of the code (dimensions: (1, x, y, z))
-            im_normalizing_label = Image(fname_normalizing_label)
-            im_normalizing_label.change_orientation(orientation='RPI')
-            normalizing_label[0] = im_normalizing_label.data
-        # if vertebral levels were selected,
-        if vertebral_levels:
-            im_vertebral_labeling = Image(fname_vertebral_labeling)
-            im_vertebral_labeling.change_orientation(orientation='RPI')
-            data_vertebral_labeling = im_vertebral_labeling.data
-        # if flag "-mask-weighted" is specified
-        if fname_mask_weight:
-            im_weight = Image(fname_mask_weight)
-            im_weight.change_orientation(orientation='RPI')
     else:
-        # Load labels
         sct.printv('\nLoad labels...', verbose)
-        labels = np.empty([nb_labels], dtype=object)
-        for i_label in range(0, nb_labels):
-            labels[i_label] = Image(path_label + indiv_labels_files[i_label]).data
-        # if the "normalization" option is wanted,
-        if fname_normalizing_label:
-            normalizing_label = np.empty([1], dtype=object)  # choose this kind of structure so as to keep easily the compatibility with the rest of the code (dimensions: (1, x, y, z))
-            normalizing_label[0] = Image(fname_normalizing_label).data  # load the data of the normalizing label
-        # if vertebral levels were selected,
-        if vertebral_levels:
-            data_vertebral_labeling = Image(fname_vertebral_labeling).data
-        if fname_mask_weight:
-            im_weight = Image(fname_mask_weight)
-    data = input_im.data
+    # if the "normalization" option is wanted,
+    mask_xy = None
+    if fname_normalizing_label:
+        normalizing_label = load_image(fname_normalizing_label, change_orientation)
+        mask_xy = np.any(normalizing_label, axis=2)
+    # labels are stacked into labels(x, y, z, nb_labels), restricted to the bounding box of the labels (and of the
+    # normalizing label) in the (x, y) plane
+    labels, bbox, (nx, ny, nz) = load_labels(path_label, indiv_labels_files, change_orientation, mask_xy)
+    if fname_normalizing_label:
+        normalizing_label = normalizing_label[bbox]
+    # if vertebral levels were selected,
+    if vertebral_levels:
+        im_vertebral_labeling = Image(fname_vertebral_labeling)
+        if change_orientation:
+            im_vertebral_labeling.change_orientation(orientation='RPI')
+        data_vertebral_labeling = im_vertebral_labeling.data
+    # if flag "-mask-weighted" is specified
+    if fname_mask_weight:
+        data_weight = load_image(fname_mask_weight, change_orientation)[bbox]
     sct.printv('  OK!', verbose)
 
-    # Change metric data type into floats for future manipulations (normalization)
-    data = np.float64(data)
-    data[np.isneginf(data)] = 0.0
-    data[data < 0.0] = 0.0
-    data[np.isnan(data)] = 0.0
-    data[np.isposinf(data)] = np.nanmax(data)
-
-    # Get dimensions of data and labels
-    nx, ny, nz = data.shape
-    nx_atlas, ny_atlas, nz_atlas = labels[0].shape
-
-    # Check dimensions consistency between atlas and data
-    if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
-        print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
-        sys.exit(2)
+    # Stack metrics into data(x, y, z, nb_metrics), restricted to the bounding box
+    data = np.empty(labels.shape[:3] + (nb_metrics,))
+    for i_metric, input_im in enumerate(list_input_im):
+        # Check dimensions consistency between atlas and data
+        if input_im.data.shape != (nx, ny, nz):
+            print '\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.'
+            sys.exit(2)
+
+        # Change metric data type into floats for future manipulations (normalization)
+        data_metric = np.float64(input_im.data[bbox])
+        data_metric[np.isneginf(data_metric)] = 0.0
+        data_metric[data_metric < 0.0] = 0.0
+        data_metric[np.isnan(data_metric)] = 0.0
+        data_metric[np.isposinf(data_metric)] = np.nanmax(data_metric)
+        data[..., i_metric] = data_metric
 
     # Update the flag "slices_of_interest" according to the vertebral levels selected by user (if it's the case)
     if vertebral_levels:
-        slices_of_interest, actual_vert_levels, warning_vert_levels = get_slices_matching_with_vertebral_levels(data, vertebral_levels, data_vertebral_labeling, verbose)
+        slices_of_interest, actual_vert_levels, warning_vert_levels = get_slices_matching_with_vertebral_levels(list_input_im[0].data, vertebral_levels, data_vertebral_labeling, verbose)
 
     # select slice of interest by cropping data and labels
     if slices_of_interest:
         data, slices_list = remove_slices(data, slices_of_interest)
-        for i_label in range(0, nb_labels):
-            labels[i_label], slices_list = remove_slices(labels[i_label], slices_of_interest)
+        labels, slices_list = remove_slices(labels, slices_of_interest)
         if fname_normalizing_label:  # if the "normalization" option was selected,
-            normalizing_label[0], slices_list = remove_slices(normalizing_label[0], slices_of_interest)
+            normalizing_label, slices_list = remove_slices(normalizing_label, slices_of_interest)
         if fname_mask_weight:  # if the flag -mask-weighted was specified,
-            im_weight.data, slices_list = remove_slices(im_weight.data, slices_of_interest)
+            data_weight, slices_list = remove_slices(data_weight, slices_of_interest)
     else:
         slices_list = np.arange(nz).tolist()
+    labels = np.ascontiguousarray(labels)
 
     # parse clusters used for a priori (map method)
     clusters_all_labels = parse_label_ID_groups(ml_clusters)
@@ -380,15 +371,36 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     if label_to_fix:
         data, labels, indiv_labels_ids, indiv_labels_names, clusters_all_labels, combined_labels_groups_all_IDs, labels_id_user, label_to_fix_name, label_to_fix_fract_vol = fix_label_value(label_to_fix, data, labels, indiv_labels_ids, indiv_labels_names, clusters_all_labels, combined_labels_groups_all_IDs, labels_id_user)
 
-    # Extract metric in the labels specified by the file info_label.txt from the atlas folder given in input
-    # individual labels
-    indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight)
-    # combined labels
-    combined_labels_value = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    combined_labels_std = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    combined_labels_fract_vol = np.zeros(len(combined_labels_groups_all_IDs), dtype=float)
-    for i_combined_labels in range(0, len(combined_labels_groups_all_IDs)):
-        combined_labels_value[i_combined_labels], combined_labels_std[i_combined_labels], combined_labels_fract_vol[i_combined_labels] = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, im_weight=im_weight, combined_labels_id_group=combined_labels_groups_all_IDs[i_combined_labels])
+    # Extract metric in the labels specified by the file info_label.txt from the atlas folder given in input, for the
+    # individual labels and the combined labels. All the metrics are estimated at once (one column per metric).
+    indiv_labels_value_all, indiv_labels_std_all, indiv_labels_fract_vol, combined_labels_value_all, combined_labels_std_all, combined_labels_fract_vol = extract_metric(method, data, labels, indiv_labels_ids, clusters_all_labels, adv_param, normalizing_label, normalization_method, data_weight, combined_labels_groups_all_IDs)
+
+    if label_to_fix:
+        fixed_label = [label_to_fix[0], label_to_fix_name, label_to_fix[1]]
+
+    for i_metric in range(nb_metrics):
+        indiv_labels_value, indiv_labels_std = indiv_labels_value_all[:, i_metric], indiv_labels_std_all[:, i_metric]
+        combined_labels_value, combined_labels_std = combined_labels_value_all[:, i_metric], combined_labels_std_all[:, i_metric]
+
+        # one output file per metric, suffixed with the name of the metric file
+        fname_output_metric, fname_output_metric_map_metric = fname_output, fname_output_metric_map
+        if nb_metrics > 1:
+            suffix = '_' + sct.extract_fname(fname_data[i_metric])[1]
+            path_output, file_output, ext_output = sct.extract_fname(fname_output)
+            fname_output_metric = path_output + file_output + suffix + ext_output
+            if fname_output_metric_map:
+                fname_output_metric_map_metric = sct.add_suffix(fname_output_metric_map, suffix)
+            sct.printv('\nMetric: ' + fname_data[i_metric], 1)
+
+        display_and_save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output_metric, fname_data[i_metric], method, overwrite, fname_normalizing_label, actual_vert_levels, warning_vert_levels, fixed_label)
+
+        # output a metric value map
+        if fname_output_metric_map:
+            data_metric_map = generate_metric_value_map(fname_output_metric_map_metric, list_input_im[i_metric], labels, indiv_labels_value, bbox, slices_list, label_to_fix, label_to_fix_fract_vol)
+
+
+def display_and_save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert_levels=None, warning_vert_levels=None, fixed_label=None):
+    """Display the results of one metric and save them in the output type selected by user."""
 
     # display results
     sct.printv('\nResults:\nID, label name [total fractional volume of the label in number of voxels]:    metric value +/- metric STDEV within label', 1)
@@ -399,8 +411,7 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
         elif i_label_user > max(indiv_labels_ids):
             index = combined_labels_ids.index(i_label_user)
             sct.printv(str(combined_labels_ids[index]) + ', ' + str(combined_labels_names[index]) + ' [' + str(round(combined_labels_fract_vol[index], 2)) + ']:    ' + str(combined_labels_value[index]) + ' +/- ' + str(combined_labels_std[index]), 1, 'info')
-    if label_to_fix:
-        fixed_label = [label_to_fix[0], label_to_fix_name, label_to_fix[1]]
+    if fixed_label:
         sct.printv('\n*' + fixed_label[0] + ', ' + fixed_label[1] + ': ' + fixed_label[2] + ' (value fixed by user)', 1, 'info')
 
     # section = ''
@@ -425,75 +436,167 @@ def main(fname_data, path_label, method, slices_of_interest, vertebral_levels, f
     # save results in the selected output file type
     save_metrics(labels_id_user, indiv_labels_ids, combined_labels_ids, indiv_labels_names, combined_labels_names, slices_of_interest, indiv_labels_value, indiv_labels_std, indiv_labels_fract_vol, combined_labels_value, combined_labels_std, combined_labels_fract_vol, fname_output, fname_data, method, overwrite, fname_normalizing_label, actual_vert_levels, warning_vert_levels, fixed_label)
 
-    # output a metric value map
-    if fname_output_metric_map:
-        data_metric_map = generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_labels_value, slices_list, label_to_fix, label_to_fix_fract_vol)
-
-
-def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', adv_param='', normalizing_label=[], normalization_method='', im_weight='', combined_labels_id_group='', verbose=0):
-    """Extract metric in the labels specified by the file info_label.txt in the atlas folder."""
-
-    # Initialization to default values
-    clustered_labels, matching_cluster_labels = [], []
 
-    nb_labels_total = len(indiv_labels_ids)
+def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels=[], adv_param=[], normalizing_label=None, normalization_method='', data_weight=None, combined_labels_id_groups=[], verbose=0):
+    """Extract metric in the labels specified by the file info_label.txt in the atlas folder.
+    The voxels of the labels are gathered once into a data vector and a label matrix, from which the individual and the
+    combined labels are estimated.
+    :data: (nx,ny,nz) numpy array, or (nx,ny,nz,nb_metrics) to estimate several metrics at once
+    :labels: (nx,ny,nz,nb_labels) numpy array. Thresholded in place for methods 'bin' and 'wath'.
+    :normalizing_label: (nx,ny,nz) numpy array, or None
+    :data_weight: (nx,ny,nz) numpy array to weight voxels (flag -mask-weighted), or None
+    :combined_labels_id_groups: list of lists of label IDs
+    :return: metric value, STD and fractional volume in the individual labels, then in the combined labels. Metric values
+    and STD have one column per metric if data has several metrics.
+    """
 
-    # check consistency of label input parameter (* LOI=Labels of Interest)
-    list_ids_LOI = check_labels(indiv_labels_ids, combined_labels_id_group)  # If 'labels_of_interest' is empty, then label_id_user' contains the index of all labels in the file info_label.txt
+    # if user asks for binary regions or thresholded weighted-average, threshold atlas
+    threshold_labels(labels, method)
 
-    if method == 'map':
-        # get clustered labels
-        clustered_labels, matching_cluster_labels = get_clustered_labels(clusters_labels, labels, indiv_labels_ids, list_ids_LOI, combined_labels_id_group, verbose)
-
-    # if user wants to get unique value across labels, then combine all labels together
-    if combined_labels_id_group:
-        sum_combined_labels = np.sum(labels[list_ids_LOI])  # sum the labels selected by user
-        if method == 'ml' or method == 'map':  # in case the maximum likelihood and the average across different labels are wanted
-            # merge labels
-            labels_tmp = np.empty([nb_labels_total - len(list_ids_LOI) + 1], dtype=object)
-            labels = np.delete(labels, list_ids_LOI)  # remove the labels selected by user
-            labels_tmp[0] = sum_combined_labels  # put the sum of the labels selected by user in first position of the tmp variable
-            for i_label in range(1, len(labels_tmp)):
-                labels_tmp[i_label] = labels[i_label - 1]  # fill the temporary array with the values of the non-selected labels
-            labels = labels_tmp  # replace the initial labels value by the updated ones (with the summed labels)
-            del labels_tmp  # delete the temporary labels
-
-        else:  # in other cases than the maximum likelihood, we can remove other labels (not needed for estimation)
-            labels = np.empty(1, dtype=object)
-            labels[0] = sum_combined_labels  # we create a new label array that includes only the summed labels
-
-    if normalizing_label:  # if the "normalization" option is wanted
+    if normalizing_label is not None:  # if the "normalization" option is wanted
         sct.printv('\nExtract normalization values...', verbose)
+        threshold_labels(normalizing_label, method)
         if normalization_method == 'sbs':  # case: the user wants to normalize slice-by-slice
-            for z in range(0, data.shape[-1]):
-                normalizing_label_slice = np.empty([1], dtype=object)  # in order to keep compatibility with the function
-                # 'extract_metric_within_tract', define a new array for the slice z of the normalizing labels
-                normalizing_label_slice[0] = normalizing_label[0][..., z]
-                metric_normalizing_label = estimate_metric_within_tract(data[..., z], normalizing_label_slice, method, 0)
+            for z in range(0, data.shape[2]):
                 # estimate the metric mean in the normalizing label for the slice z
-                if metric_normalizing_label[0][0] != 0:
-                    data[..., z] = data[..., z] / metric_normalizing_label[0][0]  # divide all the slice z by this value
+                ind_positive_z = normalizing_label[:, :, z] > ALMOST_ZERO
+                metric_normalizing_label = estimate_metric_within_tract(data[:, :, z][ind_positive_z], normalizing_label[:, :, z][ind_positive_z][:, np.newaxis], method, 0)
+                # divide all the slice z by this value (for each metric, if this value is not null)
+                metric_normalizing_label = np.asarray(metric_normalizing_label[0][0])
+                data[:, :, z] = data[:, :, z] / np.where(metric_normalizing_label != 0, metric_normalizing_label, 1)
 
         elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
-            metric_norm_label, metric_std_norm_label = estimate_metric_within_tract(data, normalizing_label, method, param_default.verbose)  # mean and std are lists
+            ind_positive_norm = normalizing_label > ALMOST_ZERO
+            metric_norm_label, metric_std_norm_label = estimate_metric_within_tract(data[ind_positive_norm], normalizing_label[ind_positive_norm][:, np.newaxis], method, param_default.verbose)
+
+    #  Select non-zero values in the union of all labels, shared by all the estimations
+    ind_positive = np.sum(labels, axis=-1) > ALMOST_ZERO
+    data1d = data[ind_positive]
+    labels2d = np.asarray(labels[ind_positive], dtype=float)  # [nb_vox x nb_labels]
+    data_weight_1d = data_weight[ind_positive] if data_weight is not None else None
+    sct.printv('  Number of non-null voxels: ' + str(len(data1d)), verbose=verbose)
+
+    # extract metrics within the individual labels (empty group) then within each combined label
+    metric_in_labels, metric_std_in_labels, fract_vol_per_label = [], [], []
+    for combined_labels_id_group in [[]] + list(combined_labels_id_groups):
+
+        # check consistency of label input parameter (* LOI=Labels of Interest)
+        list_ids_LOI = check_labels(indiv_labels_ids, combined_labels_id_group)  # If 'labels_of_interest' is empty, then label_id_user' contains the index of all labels in the file info_label.txt
+
+        clustered_labels, matching_cluster_labels = None, []
+        if method == 'map':
+            # get clustered labels
+            clustered_labels, matching_cluster_labels = get_clustered_labels(clusters_labels, labels2d, indiv_labels_ids, list_ids_LOI, combined_labels_id_group, verbose)
+
+        # if user wants to get unique value across labels, then combine all labels together
+        if combined_labels_id_group:
+            sum_combined_labels = np.sum(labels2d[:, list_ids_LOI], axis=1)  # sum the labels selected by user
+            if method == 'ml' or method == 'map':  # in case the maximum likelihood and the average across different labels are wanted
+                # merge labels: put the sum of the labels selected by user in first position, followed by the non-selected labels
+                labels2d_group = np.column_stack((sum_combined_labels, np.delete(labels2d, list_ids_LOI, axis=1)))
+            else:  # in other cases than the maximum likelihood, we can remove other labels (not needed for estimation)
+                labels2d_group = threshold_labels(sum_combined_labels[:, np.newaxis], method)
+            nb_labels_group = 1
+        else:
+            labels2d_group = labels2d
+            nb_labels_group = labels2d.shape[1]
+
+        # extract metrics within labels
+        sct.printv('\nEstimate metric within labels...', verbose)
+        metric_mean, metric_std = estimate_metric_within_tract(data1d, labels2d_group, method, verbose, clustered_labels, matching_cluster_labels, adv_param, data_weight_1d)  # mean and std are arrays
+
+        if normalizing_label is not None and normalization_method == 'whole':  # case: user wants to normalize after estimations in the whole labels
+            metric_mean, metric_std = np.divide(metric_mean, metric_norm_label), np.divide(metric_std, metric_std_norm_label)
+
+        metric_in_labels.append(metric_mean[:nb_labels_group])
+        metric_std_in_labels.append(metric_std[:nb_labels_group])
+        # compute fractional volume for each label
+        fract_vol_per_label.append(np.sum(labels2d_group[:, :nb_labels_group], axis=0))
 
-    # extract metrics within labels
-    sct.printv('\nEstimate metric within labels...', verbose)
-    metric_in_labels, metric_std_in_labels = estimate_metric_within_tract(data, labels, method, verbose, clustered_labels, matching_cluster_labels, adv_param, im_weight)  # mean and std are lists
+    # individual labels first, then combined labels
+    no_combined_labels = np.zeros((0,) + data.shape[3:])
+    return metric_in_labels[0], metric_std_in_labels[0], fract_vol_per_label[0], \
+        np.concatenate([no_combined_labels] + metric_in_labels[1:]), np.concatenate([no_combined_labels] + metric_std_in_labels[1:]), np.concatenate([np.zeros(0)] + fract_vol_per_label[1:])
 
-    if normalizing_label and normalization_method == 'whole':  # case: user wants to normalize after estimations in the whole labels
-        metric_in_labels, metric_std_in_labels = np.divide(metric_in_labels, metric_norm_label), np.divide(metric_std_in_labels, metric_std_norm_label)
 
-    if combined_labels_id_group:
-        metric_in_labels = np.asarray([metric_in_labels[0]])
-        metric_std_in_labels = np.asarray([metric_std_in_labels[0]])
+def load_image(fname, change_orientation=False):
+    """Load an image (e.g. normalizing label or weighting mask) as a numpy array.
+    :fname: file name of the image
+    :change_orientation: if True, change the orientation of the image into RPI
+    :return: numpy array
+    """
+
+    im = Image(fname)
+    if change_orientation:
+        im.change_orientation(orientation='RPI')
+    return im.data
+
+
+def load_labels(path_label, labels_files, change_orientation=False, mask_xy=None):
+    """Load the label files into one contiguous 4D array, restricted to the bounding box of the labels in the (x, y)
+    plane. Each label is cropped to its own bounding box once loaded, so that only one label is held in full size at a
+    time and the stack is allocated at the size of the bounding box.
+    :path_label: folder of the label files (empty string if file names are absolute)
+    :labels_files: list of the label file names
+    :change_orientation: if True, change the orientation of the labels into RPI
+    :mask_xy: 2D boolean array (nx, ny) of pixels to include in the bounding box in addition to the labels (optional)
+    :return: labels(x,y,nz,nb_labels) numpy array restricted to the bounding box, bounding box (tuple of slices along x
+    and y), dimensions (nx, ny, nz) of the label images
+    """
+
+    list_labels_cropped = []  # list of tuples (bounding box of the label, cropped label)
+    for file_label in labels_files:
+        im_label = Image(path_label + file_label)
+        if change_orientation:
+            im_label.change_orientation(orientation='RPI')
+        mask_xy_label = np.any(im_label.data, axis=2)
+        if not mask_xy_label.any():
+            list_labels_cropped.append(None)
+            continue
+        bbox_label = get_bounding_box(mask_xy_label)
+        list_labels_cropped.append((bbox_label, np.array(im_label.data[bbox_label])))
+        mask_xy = mask_xy_label if mask_xy is None else mask_xy | mask_xy_label
+    nx, ny, nz = im_label.data.shape
+    dtype = np.promote_types(im_label.data.dtype, np.float32)
+
+    # gather labels into the bounding box of all labels
+    if mask_xy is None:
+        mask_xy = np.zeros((nx, ny), dtype=bool)
+    bbox = get_bounding_box(mask_xy)
+    x_start, y_start = bbox[0].start or 0, bbox[1].start or 0
+    labels = np.zeros((len(range(nx)[bbox[0]]), len(range(ny)[bbox[1]]), nz, len(labels_files)), dtype=dtype)
+    for i_label, label_cropped in enumerate(list_labels_cropped):
+        if label_cropped is not None:
+            bbox_label, data_label = label_cropped
+            labels[bbox_label[0].start - x_start:bbox_label[0].stop - x_start, bbox_label[1].start - y_start:bbox_label[1].stop - y_start, :, i_label] = data_label
+
+    return labels, bbox, (nx, ny, nz)
+
+
+def get_bounding_box(mask_xy):
+    """Return the bounding box of the non-null pixels of a 2D mask, as a tuple of slices along x and y. If the mask is
+    empty, the bounding box is the whole plane."""
 
-    # compute fractional volume for each label
-    fract_vol_per_label = np.zeros(metric_in_labels.size, dtype=float)
-    for i_label in range(0, metric_in_labels.size):
-        fract_vol_per_label[i_label] = np.sum(labels[i_label])
+    ind_x, ind_y = np.where(np.any(mask_xy, axis=1))[0], np.where(np.any(mask_xy, axis=0))[0]
+    if ind_x.size == 0:
+        return slice(None), slice(None)
 
-    return metric_in_labels, metric_std_in_labels, fract_vol_per_label
+    return slice(ind_x[0], ind_x[-1] + 1), slice(ind_y[0], ind_y[-1] + 1)
+
+
+def threshold_labels(labels, method):
+    """Threshold labels in place: binarize them for method 'bin' and remove values below 0.5 for method 'wath'."""
+
+    # if user asks for binary regions, binarize atlas
+    if method == 'bin':
+        labels[labels < 0.5] = 0
+        labels[labels >= 0.5] = 1
+
+    # if user asks for thresholded weighted-average, threshold atlas
+    if method == 'wath':
+        labels[labels < 0.5] = 0
+
+    return labels
 
 
 def read_label_file(path_info_label, file_info_label):
@@ -690,7 +793,7 @@ def remove_slices(data_to_crop, slices_of_interest):
         slices_list = [i for i in range(slices_range[0], slices_range[1] + 1)]
 
     # Remove slices that are not wanted (+1 is to include the last selected slice as Python "includes -1"
-    data_cropped = data_to_crop[..., slices_list]
+    data_cropped = data_to_crop[:, :, slices_list]
 
     return data_cropped, slices_list
 
@@ -968,50 +1071,30 @@ def check_labels(indiv_labels_ids, selected_labels):
     return list_ids_of_labels_of_interest
 
 
-def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels=[], matching_cluster_labels=[], adv_param=[], im_weight=None):
+def estimate_metric_within_tract(data1d, labels2d, method, verbose, clustered_labels=None, matching_cluster_labels=[], adv_param=[], data_weight_1d=None):
     """Extract metric within labels.
-    :data: (nx,ny,nz) numpy array
-    :labels: nlabel tuple of (nx,ny,nz) array
+    :data1d: (nb_vox) numpy array, or (nb_vox,nb_metrics) to estimate several metrics at once (one right-hand side per
+    metric)
+    :labels2d: (nb_vox,nb_labels) numpy array
+    :clustered_labels: (nb_vox,nb_clusters) numpy array, used for a priori (map method)
+    :data_weight_1d: (nb_vox) numpy array to weight voxels, or None
+    :return: mean and std of the metric in each label, (nb_labels) or (nb_labels,nb_metrics) numpy arrays
     """
 
-    nb_labels = len(labels)  # number of labels
-
-    # if user asks for binary regions, binarize atlas
-    if method == 'bin':
-        for i in range(0, nb_labels):
-            labels[i][labels[i] < 0.5] = 0
-            labels[i][labels[i] >= 0.5] = 1
+    nb_vox, nb_labels = labels2d.shape
+    shape_metric = data1d.shape[1:]
+    data2d = data1d.reshape(nb_vox, -1)  # [nb_vox x nb_metrics]
+    nb_metrics = data2d.shape[1]
 
-    # if user asks for thresholded weighted-average, threshold atlas
-    if method == 'wath':
-        for i in range(0, nb_labels):
-            labels[i][labels[i] < 0.5] = 0
-
-    #  Select non-zero values in the union of all labels
-    labels_sum = np.sum(labels)
-    ind_positive_labels = labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
-    # ind_positive_data = data > -9999999999  # data > 0
-    ind_positive = ind_positive_labels  # & ind_positive_data
-    data1d = data[ind_positive]
-    nb_vox = len(data1d)
-    labels2d = np.empty([nb_labels, nb_vox], dtype=float)
-    for i in range(0, nb_labels):
-        labels2d[i] = labels[i][ind_positive]
-
-    if method == 'map' or 'ml':
-        # if specified (flag -mask-weighted), define a matrix to weight voxels. If not, this matrix is set to identity.
-        if im_weight:
-            data_weight_1d = im_weight.data[ind_positive]
-        else:
+    if method == 'map' or method == 'ml':
+        # if specified (flag -mask-weighted), define the weights of the voxels. If not, they are set to one (diagonal
+        # of the weighting matrix W, which is applied by multiplying each row)
+        if data_weight_1d is None:
             data_weight_1d = np.ones(nb_vox)
-        W = np.diag(data_weight_1d)  # weight matrix
-
-    # Display number of non-zero values
-    sct.printv('  Number of non-null voxels: ' + str(nb_vox), verbose=verbose)
 
     # initialization
-    metric_mean = np.empty([nb_labels], dtype=object)
-    metric_std = np.empty([nb_labels], dtype=object)
+    metric_mean = np.zeros([nb_labels, nb_metrics])
+    metric_std = np.zeros([nb_labels, nb_metrics])  # need to assign a value for writing output file
 
     # Estimation with maximum a posteriori (map)
     if method == 'map':
@@ -1021,35 +1104,26 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
 
         sct.printv('Maximum likelihood estimation within the selected clusters to get a priori for the MAP estimation...', verbose=verbose)
 
-        nb_clusters = len(clustered_labels)
+        nb_clusters = clustered_labels.shape[1]
 
         #  Select non-zero values in the union of the clustered labels
-        clustered_labels_sum = np.sum(clustered_labels)
-        ind_positive_clustered_labels = clustered_labels_sum > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
+        ind_positive_clustered_labels = np.sum(clustered_labels, axis=1) > ALMOST_ZERO  # labels_sum > ALMOST_ZERO
 
         # define the problem to apply the maximum likelihood to clustered labels
-        y_apriori = data[ind_positive_clustered_labels]  # [nb_vox x 1]
+        y_apriori = data2d[ind_positive_clustered_labels]  # [nb_vox x nb_metrics]
 
         # create matrix X to use ML and estimate beta_0
-        x_apriori = np.zeros([len(y_apriori), nb_clusters])
-        for i_cluster in range(nb_clusters):
-            x_apriori[:, i_cluster] = clustered_labels[i_cluster][ind_positive_clustered_labels]
-
-        # remove unused voxels from the weighting matrix W
-        if im_weight:
-            data_weight_1d_apriori = im_weight.data[ind_positive_clustered_labels]
-        else:
-            data_weight_1d_apriori = np.ones(np.sum(ind_positive_clustered_labels))
-        W_apriori = np.diag(data_weight_1d_apriori)  # weight matrix
+        x_apriori = clustered_labels[ind_positive_clustered_labels]
 
-        # apply the weighting matrix
-        y_apriori = np.dot(W_apriori, y_apriori)
-        x_apriori = np.dot(W_apriori, x_apriori)
+        # apply the weighting matrix (remove unused voxels from it)
+        data_weight_1d_apriori = data_weight_1d[ind_positive_clustered_labels]
+        y_apriori = data_weight_1d_apriori[:, np.newaxis] * y_apriori
+        x_apriori = data_weight_1d_apriori[:, np.newaxis] * x_apriori
 
         # estimate values using ML for each cluster
         beta = np.dot(np.linalg.pinv(np.dot(x_apriori.T, x_apriori)), np.dot(x_apriori.T, y_apriori))  # beta = (Xt . X)-1 . Xt . y
         # display results
-        sct.printv('  Estimated beta0 per cluster: ' + str(beta), verbose=verbose)
+        sct.printv('  Estimated beta0 per cluster: ' + str(beta.reshape((nb_clusters,) + shape_metric)), verbose=verbose)
 
         # MAP estimations within the selected labels
         # ------------------------------------------
@@ -1059,10 +1133,10 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         var_noise = int(adv_param[1]) ^ 2  # variance of the noise (assumed Gaussian)
 
         # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
+        y = data_weight_1d[:, np.newaxis] * data2d  # [nb_vox x nb_metrics]
+        x = data_weight_1d[:, np.newaxis] * labels2d  # [nb_vox x nb_labels]
         # construct beta0
-        beta0 = np.zeros(nb_labels)
+        beta0 = np.zeros([nb_labels, nb_metrics])
         for i_cluster in range(nb_clusters):
             beta0[np.where(np.asarray(matching_cluster_labels) == i_cluster)[0]] = beta[i_cluster]
         # construct covariance matrix (variance between tracts). For simplicity, we set it to be the identity.
@@ -1070,53 +1144,42 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         A = np.linalg.pinv(np.dot(x.T, x) + np.linalg.pinv(Rlabel) * var_noise / var_label)
         B = x.T
         C = y - np.dot(x, beta0)
-        beta = beta0 + np.dot(A, np.dot(B, C))
-        for i_label in range(0, nb_labels):
-            metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
-
-    # clear memory
-    del data, labels
+        metric_mean = beta0 + np.dot(A, np.dot(B, C))
 
     # Estimation with maximum likelihood
     if method == 'ml':
         # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
-        beta = np.dot(np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y))  # beta = (Xt . X)-1 . Xt . y
+        y = data_weight_1d[:, np.newaxis] * data2d  # [nb_vox x nb_metrics]
+        x = data_weight_1d[:, np.newaxis] * labels2d  # [nb_vox x nb_labels]
+        metric_mean = np.dot(np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y))  # beta = (Xt . X)-1 . Xt . y
         #beta, residuals, rank, singular_value = np.linalg.lstsq(np.dot(x.T, x), np.dot(x.T, y), rcond=-1)
         #beta, residuals, rank, singular_value = np.linalg.lstsq(x, y)
         # print beta, residuals, rank, singular_value
-        for i_label in range(0, nb_labels):
-            metric_mean[i_label] = beta[i_label]
-            metric_std[i_label] = 0  # need to assign a value for writing output file
 
     # Estimation with weighted average (also works for binary)
     if method == 'wa' or method == 'bin' or method == 'wath' or method == 'max':
-        for i_label in range(0, nb_labels):
-            # check if all labels are equal to zero
-            if sum(labels2d[i_label, :]) == 0:
-                print 'WARNING: labels #' + str(i_label) + ' contains only null voxels. Mean and std are set to 0.'
-                metric_mean[i_label] = 0
-                metric_std[i_label] = 0
-            else:
-                # estimate the weighted average
-                metric_mean[i_label] = sum(data1d * labels2d[i_label, :]) / sum(labels2d[i_label, :])
-                # estimate the biased weighted standard deviation
-                metric_std[i_label] = np.sqrt(
-                    sum(labels2d[i_label, :] * (data1d - metric_mean[i_label]) ** 2) / sum(labels2d[i_label, :]))
+        sum_labels = np.sum(labels2d, axis=0)
+        # check if all labels are equal to zero
+        for i_label in np.where(sum_labels == 0)[0]:
+            print 'WARNING: labels #' + str(i_label) + ' contains only null voxels. Mean and std are set to 0.'
+        ind_labels = sum_labels != 0
+        # estimate the weighted average
+        metric_mean[ind_labels] = np.dot(labels2d[:, ind_labels].T, data2d) / sum_labels[ind_labels, np.newaxis]
+        # estimate the biased weighted standard deviation
+        for i_metric in range(nb_metrics):
+            metric_std[ind_labels, i_metric] = np.sqrt(np.sum(labels2d[:, ind_labels] * (data2d[:, i_metric, np.newaxis] - metric_mean[ind_labels, i_metric]) ** 2, axis=0) / sum_labels[ind_labels])
 
-    return metric_mean, metric_std
+    return metric_mean.reshape((nb_labels,) + shape_metric), metric_std.reshape((nb_labels,) + shape_metric)
 
 
 def get_clustered_labels(clusters_all_labels, labels, indiv_labels_ids, labels_user, averaging_flag, verbose):
     """
     Cluster labels according to selected options (labels and averaging).
     :ml_clusters: clusters in form: '0:29,30,31'
-    :labels: all labels data
+    :labels: all labels data, (nb_vox,nb_labels) numpy array
     :labels_user: label IDs selected by the user
     :averaging_flag: flag -a (0 or 1)
-    :return: clustered_labels: labels summed by clustered
+    :return: clustered_labels: labels summed by clustered, (nb_vox,nb_clusters) numpy array
     """
 
     nb_clusters = len(clusters_all_labels)
@@ -1141,14 +1204,14 @@ def get_clustered_labels(clusters_all_labels, labels, indiv_labels_ids, labels_u
     sct.printv('  Number of clusters: ' + str(nb_clusters), verbose=verbose)
 
     # sum labels within each cluster
-    clustered_labels = np.empty([nb_clusters], dtype=object)  # labels(nb_labels_total, x, y, z)
+    clustered_labels = np.empty([labels.shape[0], nb_clusters])  # labels(nb_vox, nb_clusters)
     for i_cluster in range(0, nb_clusters):
         indexes_labels_cluster_i = [indiv_labels_ids.index(label_ID) for label_ID in clusters_all_labels[i_cluster]]
-        clustered_labels[i_cluster] = np.sum(labels[indexes_labels_cluster_i])
+        clustered_labels[:, i_cluster] = np.sum(labels[:, indexes_labels_cluster_i], axis=1)
 
     # find matching between labels and clusters in the whole label id list
-    matching_cluster_label_id = np.zeros(len(labels), dtype=int)
-    for i_label in range(0, len(labels)):
+    matching_cluster_label_id = np.zeros(labels.shape[1], dtype=int)
+    for i_label in range(0, labels.shape[1]):
         for i_cluster in range(0, nb_clusters):
             if i_label in clusters_all_labels[i_cluster]:
                 matching_cluster_label_id[i_label] = i_cluster
@@ -1180,11 +1243,14 @@ def fix_label_value(label_to_fix, data, labels, indiv_labels_ids, indiv_labels_n
 
     # remove the value from the data
     label_to_fix_index = indiv_labels_ids.index(label_to_fix_ID)
-    label_to_fix_fract_vol = labels[label_to_fix_index]
-    data = data - label_to_fix_fract_vol * label_to_fix_value
+    label_to_fix_fract_vol = labels[..., label_to_fix_index]
+    if data.ndim == 4:  # several metrics
+        data = data - label_to_fix_fract_vol[..., np.newaxis] * label_to_fix_value
+    else:
+        data = data - label_to_fix_fract_vol * label_to_fix_value
 
     # remove the label to fix from the labels lists
-    labels = np.delete(labels, label_to_fix_index, 0)
+    labels = np.delete(labels, label_to_fix_index, -1)
     del indiv_labels_ids[label_to_fix_index]
     label_to_fix_name = indiv_labels_names[label_to_fix_index]
     del indiv_labels_names[label_to_fix_index]
@@ -1238,8 +1304,9 @@ def remove_label_from_group(list_label_groups, label_ID):
     return list_label_groups
 
 
-def generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_labels_value, slices_list, label_to_fix, label_to_fix_fract_vol):
-    """Produces a map where each label is assigned the metric value estimated previously based on their fractional volumes."""
+def generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_labels_value, bbox, slices_list, label_to_fix, label_to_fix_fract_vol):
+    """Produces a map where each label is assigned the metric value estimated previously based on their fractional volumes.
+    Labels are restricted to the bounding box bbox (tuple of slices along x and y) and to the slices slices_list."""
 
     sct.printv('\nGenerate metric value map based on each label fractional volumes: ' + fname_output_metric_map + '...')
 
@@ -1248,11 +1315,12 @@ def generate_metric_value_map(fname_output_metric_map, input_im, labels, indiv_l
     metric_map.data = np.zeros(input_im.data.shape)
 
     # assign to each label the corresponding estimated metric value
-    for i_label in range(len(labels)):
-        metric_map.data[:, :, slices_list] = metric_map.data[:, :, slices_list] + labels[i_label] * indiv_labels_value[i_label]
+    data_labels = np.dot(labels, np.asarray(indiv_labels_value, dtype=float))
 
     if label_to_fix:
-        metric_map.data[:, :, slices_list] = metric_map.data[:, :, slices_list] + label_to_fix_fract_vol * float(label_to_fix[1])
+        data_labels = data_labels + label_to_fix_fract_vol * float(label_to_fix[1])
+
+    metric_map.data[bbox[0], bbox[1], slices_list] = data_labels
 
     # save metric value map
     metric_map.setFileName(fname_output_metric_map)
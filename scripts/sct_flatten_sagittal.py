@@ -19,13 +19,12 @@ import sys
 import commands
 import nibabel
 import numpy
+from scipy.ndimage import shift
 from shutil import move
 import sct_utils as sct
 from msct_nurbs import NURBS
-from sct_utils import fsloutput
 from sct_image import get_orientation_3d, set_orientation
 from msct_image import Image
-from sct_image import split_data, concat_data
 from msct_parser import Parser
 
 
@@ -127,66 +126,36 @@ def main(fname_anat, fname_centerline, degree_poly, centerline_fitting, interp,
         x_centerline_fit, y_centerline_fit = polynome_centerline(x_centerline, y_centerline, z_centerline)
 
     #==========================================================================================
-    # Split input volume
-    print '\nSplit input volume...'
-    im_anat_orient_split_list = split_data(im_anat_orient, 2)
-    file_anat_split = []
-    for im in im_anat_orient_split_list:
-        file_anat_split.append(im.absolutepath)
-        im.save()
-
-    # initialize variables
-    file_mat_inv_cumul = ['tmp.mat_inv_cumul_Z' + str(z).zfill(4) for z in range(0, nz, 1)]
+    # Compute the displacement of each slice along x, from the fitted centerline (in voxel of the centerline image)
+    print '\nCompute displacement of each slice...'
     z_init = min_z_index
-    displacement_max_z_index = x_centerline_fit[z_init - min_z_index] - x_centerline_fit[max_z_index - min_z_index]
-
-    # write centerline as text file
-    print '\nGenerate fitted transformation matrices...'
-    file_mat_inv_cumul_fit = ['tmp.mat_inv_cumul_fit_Z' + str(z).zfill(4) for z in range(0, nz, 1)]
+    displacement = numpy.zeros(nz)
     for iz in range(min_z_index, max_z_index + 1, 1):
-        # compute inverse cumulative fitted transformation matrix
-        fid = open(file_mat_inv_cumul_fit[iz], 'w')
-        if (x_centerline[iz - min_z_index] == 0 and y_centerline[iz - min_z_index] == 0):
-            displacement = 0
-        else:
-            displacement = x_centerline_fit[z_init - min_z_index] - x_centerline_fit[iz - min_z_index]
-        fid.write('%i %i %i %f\n' % (1, 0, 0, displacement))
-        fid.write('%i %i %i %f\n' % (0, 1, 0, 0))
-        fid.write('%i %i %i %i\n' % (0, 0, 1, 0))
-        fid.write('%i %i %i %i\n' % (0, 0, 0, 1))
-        fid.close()
-
-    # we complete the displacement matrix in z direction
-    for iz in range(0, min_z_index, 1):
-        fid = open(file_mat_inv_cumul_fit[iz], 'w')
-        fid.write('%i %i %i %f\n' % (1, 0, 0, 0))
-        fid.write('%i %i %i %f\n' % (0, 1, 0, 0))
-        fid.write('%i %i %i %i\n' % (0, 0, 1, 0))
-        fid.write('%i %i %i %i\n' % (0, 0, 0, 1))
-        fid.close()
-    for iz in range(max_z_index + 1, nz, 1):
-        fid = open(file_mat_inv_cumul_fit[iz], 'w')
-        fid.write('%i %i %i %f\n' % (1, 0, 0, displacement_max_z_index))
-        fid.write('%i %i %i %f\n' % (0, 1, 0, 0))
-        fid.write('%i %i %i %i\n' % (0, 0, 1, 0))
-        fid.write('%i %i %i %i\n' % (0, 0, 0, 1))
-        fid.close()
-
-    # apply transformations to data
-    print '\nApply fitted transformation matrices...'
-    file_anat_split_fit = ['tmp.anat_orient_fit_Z' + str(z).zfill(4) for z in range(0, nz, 1)]
+        if not (x_centerline[iz - min_z_index] == 0 and y_centerline[iz - min_z_index] == 0):
+            displacement[iz] = x_centerline_fit[z_init - min_z_index] - x_centerline_fit[iz - min_z_index]
+    # we complete the displacement in z direction
+    displacement[max_z_index + 1:] = x_centerline_fit[z_init - min_z_index] - x_centerline_fit[max_z_index - min_z_index]
+
+    # the displacement (a number of voxels) used to be written as is in the translation of a flirt matrix, which flirt
+    # reads in mm in FSL coordinates (x flipped for neurological images). To keep the same result, it is applied as a
+    # translation in mm, converted into a shift in voxel of the anatomical image along x.
+    px_anat = im_anat_orient.dim[4]
+    if numpy.linalg.det(im_anat_orient.hdr.get_best_affine()[:3, :3]) > 0:
+        shift_x = -displacement / px_anat
+    else:
+        shift_x = displacement / px_anat
+
+    # apply displacement to each slice
+    print '\nApply displacement...'
+    order = {'nearestneighbour': 0, 'trilinear': 1, 'sinc': 3}[interp]  # sinc is approximated by cubic spline
+    data_anat = im_anat_orient.data.astype(numpy.float64)
+    data_anat_fit = numpy.zeros(data_anat.shape)
     for iz in range(0, nz, 1):
-        # forward cumulative transformation to data
-        sct.run(fsloutput + 'flirt -in ' + file_anat_split[iz] + ' -ref ' + file_anat_split[iz] + ' -applyxfm -init ' + file_mat_inv_cumul_fit[iz] + ' -out ' + file_anat_split_fit[iz] + ' -interp ' + interp)
-
-    # Merge into 4D volume
-    print '\nMerge into 4D volume...'
-    from glob import glob
-    im_to_concat_list = [Image(fname) for fname in glob('tmp.anat_orient_fit_Z*.nii')]
-    im_concat_out = concat_data(im_to_concat_list, 2)
-    im_concat_out.setFileName('tmp.anat_orient_fit.nii')
+        data_anat_fit[:, :, iz] = shift(data_anat[:, :, iz], (shift_x[iz], 0), order=order, mode='constant')
+
+    im_concat_out = Image(param=data_anat_fit, hdr=im_anat_orient.hdr.copy(), absolutepath='tmp.anat_orient_fit.nii')
+    im_concat_out.changeType('float32')
     im_concat_out.save()
-    # sct.run(fsloutput+'fslmerge -z tmp.anat_orient_fit tmp.anat_orient_fit_z*')
 
     # Reorient data as it was before
     print '\nReorient data back into native orientation...'
@@ -260,7 +229,7 @@ def get_parser():
                       deprecated_by='-s')
     parser.add_option(name='-x',
                       type_value='multiple_choice',
-                      description='Final interpolation.',
+                      description='Final interpolation (sinc is approximated by cubic spline).',
                       mandatory=False,
                       example=['nearestneighbour', 'trilinear', 'sinc'],
                       default_value=str(param_default.interp))
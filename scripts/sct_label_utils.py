@@ -19,11 +19,12 @@
 import sys
 import math
 import numpy as np
-from scipy import ndimage
 import sct_utils as sct
 from msct_parser import Parser
 from msct_image import Image
 
+ndimage = sct.lazy_import('scipy.ndimage')
+
 
 # DEFAULT PARAMETERS
 class Param:
@@ -129,12 +130,8 @@ class ProcessLabels(object):
         This function add a specified value to all non-zero voxels.
         """
         image_output = Image(self.image_input, self.verbose)
-        # image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = image_output.data[int(coord.x), int(coord.y), int(coord.z)] + float(value)
+        ind_nonzero = self.image_input.data > 0
+        image_output.data[ind_nonzero] = image_output.data[ind_nonzero] + float(value)
         return image_output
 
     def create_label(self, add=False):
@@ -153,16 +150,19 @@ class ProcessLabels(object):
         if not add:
             image_output.data *= 0
 
-        # loop across labels
+        # display info
         for i, coord in enumerate(self.coordinates):
-            # display info
             sct.printv('Label #' + str(i) + ': ' + str(coord.x) + ',' + str(coord.y) + ',' + str(coord.z) + ' --> ' +
                        str(coord.value), 1)
-            if len(image_output.data.shape) == 3:
-                image_output.data[int(coord.x), int(coord.y), int(coord.z)] = coord.value
-            elif len(image_output.data.shape) == 2:
-                assert str(coord.z) == '0', "ERROR: 2D coordinates should have a Z value of 0. Z coordinate is :" + str(coord.z)
-                image_output.data[int(coord.x), int(coord.y)] = coord.value
+
+        # write all labels at once
+        coordinates = np.array([[coord.x, coord.y, coord.z] for coord in self.coordinates], dtype=float).reshape(-1, 3).astype(int)
+        values = np.array([coord.value for coord in self.coordinates], dtype=float)
+        if len(image_output.data.shape) == 3:
+            image_output.data[coordinates[:, 0], coordinates[:, 1], coordinates[:, 2]] = values
+        elif len(image_output.data.shape) == 2:
+            assert (coordinates[:, 2] == 0).all(), "ERROR: 2D coordinates should have a Z value of 0. Z coordinates are :" + str(coordinates[:, 2])
+            image_output.data[coordinates[:, 0], coordinates[:, 1]] = values
 
         return image_output
 
@@ -174,7 +174,7 @@ class ProcessLabels(object):
         output_image = Image(self.image_input, self.verbose)
         nx, ny, nz, nt, px, py, pz, pt = Image(self.image_input.absolutepath).dim
 
-        coordinates_input = self.image_input.getNonZeroCoordinates()
+        coordinates_input = get_nonzero_coordinates(self.image_input.data)
         d = self.cross_radius  # cross radius in pixel
         dx = d / px  # cross radius in mm
         dy = d / py
@@ -182,90 +182,78 @@ class ProcessLabels(object):
         # clean output_image
         output_image.data *= 0
 
-        cross_coordinates = self.get_crosses_coordinates(coordinates_input, dx, self.image_ref, self.dilate)
+        cross_coordinates = self.get_crosses_coordinates(coordinates_input, dx, self.image_ref, self.dilate, verbose=self.verbose)
 
-        for coord in cross_coordinates:
-            output_image.data[int(round(coord.x)), int(round(coord.y)), int(round(coord.z))] = coord.value
+        # keep crosses inside the image
+        index_cross = np.floor(cross_coordinates[:, :3] + 0.5).astype(int)
+        inside = np.all((index_cross >= 0) & (index_cross < output_image.data.shape[:3]), axis=1)
+        output_image.data[index_cross[inside, 0], index_cross[inside, 1], index_cross[inside, 2]] = cross_coordinates[inside, 3]
 
         return output_image
 
     @staticmethod
-    def get_crosses_coordinates(coordinates_input, gapxy=15, image_ref=None, dilate=False):
-        from msct_types import Coordinate
+    def get_crosses_coordinates(coordinates_input, gapxy=15, image_ref=None, dilate=False, verbose=1):
+        """
+        Compute a cross of 5 points (center, +/- gapxy along the two in-plane axes) around each label. The value of the
+        points of the cross are label_value * 10 + 1, ..., label_value * 10 + 5.
+        If a reference image is provided (segmentation), the cross is drawn in the plane perpendicular to the centerline.
+        :param coordinates_input: array (n, 4) of labels [x, y, z, value], as returned by get_nonzero_coordinates
+        :return: array (m, 4) of cross coordinates [x, y, z, value], sorted by value
+        """
+        coordinates_input = np.asarray(coordinates_input, dtype=float).reshape(-1, 4)
+        nb_labels = len(coordinates_input)
 
+        # in-plane axes of each cross
+        axis_x = np.tile([1.0, 0.0, 0.0], (nb_labels, 1))
+        axis_y = np.tile([0.0, 1.0, 0.0], (nb_labels, 1))
         # if reference image is provided (segmentation), we draw the cross perpendicular to the centerline
         if image_ref is not None:
             # smooth centerline
             from sct_straighten_spinalcord import smooth_centerline
-            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(self.image_ref, verbose=self.verbose)
-
-        # compute crosses
-        cross_coordinates = []
-        for coord in coordinates_input:
-            if image_ref is None:
-                from sct_straighten_spinalcord import compute_cross
-                cross_coordinates_temp = compute_cross(coord, gapxy)
-            else:
-                from sct_straighten_spinalcord import compute_cross_centerline
-                from numpy import where
-                index_z = where(z_centerline == coord.z)
-                deriv = Coordinate([x_centerline_deriv[index_z][0], y_centerline_deriv[index_z][0], z_centerline_deriv[index_z][0], 0.0])
-                cross_coordinates_temp = compute_cross_centerline(coord, deriv, gapxy)
-
-            for i, coord_cross in enumerate(cross_coordinates_temp):
-                coord_cross.value = coord.value * 10 + i + 1
-
-            # dilate cross to 3x3x3
-            if dilate:
-                additional_coordinates = []
-                for coord_temp in cross_coordinates_temp:
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y, coord_temp.z - 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y + 1.0, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y + 1.0, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y + 1.0, coord_temp.z - 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y - 1.0, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y - 1.0, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x, coord_temp.y - 1.0, coord_temp.z - 1.0, coord_temp.value]))
-
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y, coord_temp.z - 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y + 1.0, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y + 1.0, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y + 1.0, coord_temp.z - 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y - 1.0, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y - 1.0, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x + 1.0, coord_temp.y - 1.0, coord_temp.z - 1.0, coord_temp.value]))
-
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y, coord_temp.z - 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y + 1.0, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y + 1.0, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y + 1.0, coord_temp.z - 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y - 1.0, coord_temp.z, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y - 1.0, coord_temp.z + 1.0, coord_temp.value]))
-                    additional_coordinates.append(Coordinate([coord_temp.x - 1.0, coord_temp.y - 1.0, coord_temp.z - 1.0, coord_temp.value]))
-
-                cross_coordinates_temp.extend(additional_coordinates)
-
-            cross_coordinates.extend(cross_coordinates_temp)
-
-        cross_coordinates = sorted(cross_coordinates, key=lambda obj: obj.value)
+            x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(image_ref, verbose=verbose)
+            index_z = np.searchsorted(np.asarray(z_centerline), coordinates_input[:, 2])
+            index_z = np.clip(index_z, 0, len(z_centerline) - 1)
+            axis_z = np.column_stack([np.asarray(x_centerline_deriv)[index_z], np.asarray(y_centerline_deriv)[index_z], np.asarray(z_centerline_deriv)[index_z]])
+            axis_z /= np.linalg.norm(axis_z, axis=1)[:, np.newaxis]
+            axis_y = axis_y - np.sum(axis_y * axis_z, axis=1)[:, np.newaxis] * axis_z
+            axis_y /= np.linalg.norm(axis_y, axis=1)[:, np.newaxis]
+            axis_x = np.cross(axis_y, axis_z)
+
+        # compute crosses: (n, 5, 3)
+        offsets = np.array([0, 1, -1, 0, 0])[np.newaxis, :, np.newaxis] * axis_x[:, np.newaxis, :] + \
+                  np.array([0, 0, 0, 1, -1])[np.newaxis, :, np.newaxis] * axis_y[:, np.newaxis, :]
+        cross_points = coordinates_input[:, np.newaxis, :3] + gapxy * offsets
+        cross_values = coordinates_input[:, 3:4] * 10 + np.arange(1, 6)[np.newaxis, :]
+
+        # dilate cross to 3x3x3
+        if dilate:
+            neighbors = np.array([[i, j, k] for i in [0, -1, 1] for j in [0, -1, 1] for k in [0, -1, 1]], dtype=float)
+            cross_points = cross_points[:, :, np.newaxis, :] + neighbors[np.newaxis, np.newaxis, :, :]
+            cross_values = np.repeat(cross_values[:, :, np.newaxis], len(neighbors), axis=2)
+
+        cross_coordinates = np.column_stack([cross_points.reshape(-1, 3), cross_values.ravel()])
+        cross_coordinates = cross_coordinates[np.argsort(cross_coordinates[:, 3], kind='mergesort')]
         return cross_coordinates
 
     def plan(self, width, offset=0, gap=1):
         """
         Create a plane of thickness="width" and changes its value with an offset and a gap between labels.
+        Slabs are clipped to the image: a label at z < width covers the slices 0 to z + width - 1.
         """
         image_output = Image(self.image_input, self.verbose)
         image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for coord in coordinates_input:
-            image_output.data[:, :, int(coord.z) - width:int(coord.z) + width] = offset + gap * coord.value
+        coordinates_input = get_nonzero_coordinates(self.image_input.data)
+        if len(coordinates_input) == 0:
+            return image_output
+        nz = image_output.data.shape[2]
+
+        # value of the last label of each slice, then slab of each slice: the last label covering a slice wins
+        z_label, index_label = last_index_per_slice(coordinates_input[:, 2].astype(int))
+        z_range = np.arange(nz)
+        covered = (z_range[:, np.newaxis] >= z_label[np.newaxis, :] - width) & (z_range[:, np.newaxis] < z_label[np.newaxis, :] + width)
+        index_slice = np.where(covered, index_label[np.newaxis, :], -1).max(axis=1)
+        z_plan = np.where(index_slice >= 0)[0]
+        image_output.data[:, :, z_plan] = offset + gap * coordinates_input[index_slice[z_plan], 3]
 
         return image_output
 
@@ -277,25 +265,14 @@ class ProcessLabels(object):
         image_output = Image(self.image_ref, self.verbose)
         image_output.data *= 0
 
-        image_input_neg = Image(self.image_input, self.verbose).copy()
-        image_input_pos = Image(self.image_input, self.verbose).copy()
-        image_input_neg.data *= 0
-        image_input_pos.data *= 0
-        X, Y, Z = (self.image_input.data < 0).nonzero()
-        for i in range(len(X)):
-            image_input_neg.data[X[i], Y[i], Z[i]] = -self.image_input.data[X[i], Y[i], Z[i]]  # in order to apply getNonZeroCoordinates
-        X_pos, Y_pos, Z_pos = (self.image_input.data > 0).nonzero()
-        for i in range(len(X_pos)):
-            image_input_pos.data[X_pos[i], Y_pos[i], Z_pos[i]] = self.image_input.data[X_pos[i], Y_pos[i], Z_pos[i]]
-
-        coordinates_input_neg = image_input_neg.getNonZeroCoordinates()
-        coordinates_input_pos = image_input_pos.getNonZeroCoordinates()
+        coordinates_input_neg = get_nonzero_coordinates(-self.image_input.data)
+        coordinates_input_pos = get_nonzero_coordinates(self.image_input.data)
 
+        # positive labels are written after negative ones
         image_output.changeType('float32')
-        for coord in coordinates_input_neg:
-            image_output.data[:, :, int(coord.z)] = -coord.value  # PB: takes the int value of coord.value
-        for coord in coordinates_input_pos:
-            image_output.data[:, :, int(coord.z)] = coord.value
+        for coordinates, sign in [(coordinates_input_neg, -1), (coordinates_input_pos, 1)]:
+            z_label, index_label = last_index_per_slice(coordinates[:, 2].astype(int))
+            image_output.data[:, :, z_label] = sign * coordinates[index_label, 3]
 
         return image_output
 
@@ -314,22 +291,18 @@ class ProcessLabels(object):
         output_image = self.image_input.copy()
         output_image.data *= 0
 
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.image_input.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
+        # 1. Separate all non-null voxels into groups by value
+        data = self.image_input.data
+        values, groups = np.unique(data[data > 0], return_inverse=True)
+        data_groups = np.zeros(data.shape, dtype=int)
+        data_groups[data > 0] = groups + 1
 
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        for value, list_coord in groups.iteritems():
-            center_of_mass = sum(list_coord) / float(len(list_coord))
-            sct.printv("Value = " + str(center_of_mass.value) + " : (" + str(center_of_mass.x) + ", " + str(center_of_mass.y) + ", " + str(center_of_mass.z) + ") --> ( " + str(round(center_of_mass.x)) + ", " + str(round(center_of_mass.y)) + ", " + str(round(center_of_mass.z)) + ")", verbose=self.verbose)
-            output_image.data[int(round(center_of_mass.x)), int(round(center_of_mass.y)), int(round(center_of_mass.z))] = center_of_mass.value
+        # 2. Compute the center of mass of each group of voxels and write them into the output image
+        centers_of_mass = np.array(ndimage.center_of_mass((data > 0).astype(float), labels=data_groups, index=range(1, len(values) + 1))).reshape(-1, data.ndim)
+        index_centers = np.floor(centers_of_mass + 0.5).astype(int)
+        for value, center_of_mass, index_center in zip(values, centers_of_mass, index_centers):
+            sct.printv("Value = " + str(value) + " : (" + ", ".join([str(c) for c in center_of_mass]) + ") --> ( " + ", ".join([str(float(c)) for c in index_center]) + ")", verbose=self.verbose)
+        output_image.data[tuple(index_centers.T)] = values
 
         return output_image
 
@@ -340,11 +313,12 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates(sorting='z', reverse_coord=True)
+        coordinates_input = get_nonzero_coordinates(self.image_input.data)
 
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = i + 1
+        # sort along the inverse z direction (voxels on the same slice keep their order)
+        order = np.lexsort((np.arange(len(coordinates_input)), -coordinates_input[:, 2]))
+        coordinates_input = coordinates_input[order].astype(int)
+        image_output.data[coordinates_input[:, 0], coordinates_input[:, 1], coordinates_input[:, 2]] = np.arange(1, len(coordinates_input) + 1)
 
         return image_output
 
@@ -717,6 +691,32 @@ class ProcessLabels(object):
         return im_output
 
 
+# UTILS
+# ==========================================================================================
+def get_nonzero_coordinates(data):
+    """
+    Get the coordinates and values of all strictly positive voxels of a 3D (or 2D) array, in C order.
+    :param data: numpy array
+    :return: array (n, 4) of [x, y, z, value]. For 2D data, z is 0.
+    """
+    data = np.asarray(data)
+    if data.ndim == 2:
+        data = data[:, :, np.newaxis]
+    X, Y, Z = (data > 0).nonzero()
+    return np.column_stack([X, Y, Z, data[X, Y, Z]]).astype(float)
+
+
+def last_index_per_slice(z):
+    """
+    For each slice index present in z, get the index of its last occurrence in z.
+    :param z: array of slice indexes
+    :return: slices, indexes
+    """
+    z = np.asarray(z)
+    z_unique, index_reversed = np.unique(z[::-1], return_index=True)
+    return z_unique, len(z) - 1 - index_reversed
+
+
 # PARSER
 # ==========================================================================================
 def get_parser():
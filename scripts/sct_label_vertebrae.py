@@ -20,7 +20,7 @@ import sys
 import os
 import shutil
 import numpy as np
-from sct_maths import mutual_information
+from sct_maths import mutual_information_batch
 from msct_parser import Parser
 from msct_image import Image
 import sct_image
@@ -746,10 +746,11 @@ def compute_corr_3d(src, target, x, xshift, xsize, y, yshift, ysize, z, zshift,
     # initializations
     I_corr = np.zeros(len(zrange))
     allzeros = 0
-    # current_z = 0
-    ind_I = 0
+    # stack of subject patterns for all z in range, on which mutual information is computed at once
+    data_chunk2d = []
+    ind_valid = []
     # loop across range of z defined by src
-    for iz in zrange:
+    for ind_I, iz in enumerate(zrange):
         # if pattern extends towards the top part of the image, then crop and pad with zeros
         if z + iz + zsize + 1 > nz:
             # print 'iz='+str(iz)+': padding on top'
@@ -778,11 +779,12 @@ def compute_corr_3d(src, target, x, xshift, xsize, y, yshift, ysize, z, zshift,
         data_chunk1d = data_chunk3d.ravel()
         # check if data_chunk1d contains at least one non-zero value
         if (data_chunk1d.size == pattern1d.size) and np.any(data_chunk1d):
-            I_corr[ind_I] = mutual_information(data_chunk1d, pattern1d, nbins=16, normalized=False)
+            data_chunk2d.append(data_chunk1d)
+            ind_valid.append(ind_I)
         else:
             allzeros = 1
-        ind_I = ind_I + 1
-    # ind_y = ind_y + 1
+    if ind_valid:
+        I_corr[ind_valid] = mutual_information_batch(np.array(data_chunk2d), pattern1d, nbins=16)
     if allzeros:
         sct.printv('.. WARNING: Data contained zero. We probably hit the edge of the image.', verbose)
 
@@ -616,6 +616,60 @@ def mutual_information(x, y, nbins=32, normalized=False):
     return mi
 
 
+def mutual_information_batch(x, y, nbins=32):
+    """
+    Compute mutual information between each row of x and y, in one pass. Same result as calling
+    mutual_information(x[i], y, nbins, normalized=False) for each row i.
+    :param x: 2D numpy.array (n, m) : n flatten data from an image
+    :param y: 1D numpy.array (m) : flatten data from an image
+    :param nbins: number of bins to compute the contingency matrices
+    :return: 1D numpy.array (n) of non negative values : mutual information of each row of x with y
+    """
+    x = np.atleast_2d(x)
+    n = x.shape[0]
+    # bin index of each value, as in numpy.histogram2d
+    bin_x = histogram_bin_index(x, nbins)
+    bin_y = histogram_bin_index(np.asarray(y).reshape(1, -1), nbins)
+    # contingency matrices of all rows
+    ind_contingency = (np.arange(n)[:, np.newaxis] * nbins + bin_x) * nbins + bin_y
+    c_xy = np.bincount(ind_contingency.ravel(), minlength=n * nbins * nbins).reshape(n, nbins, nbins).astype(float)
+    # mutual information from contingency matrices, as in sklearn.metrics.mutual_info_score
+    contingency_sum = c_xy.sum(axis=(1, 2))[:, np.newaxis, np.newaxis]
+    pi = c_xy.sum(axis=2)[:, :, np.newaxis]
+    pj = c_xy.sum(axis=1)[:, np.newaxis, :]
+    nnz = c_xy != 0
+    c_xy[~nnz] = 1  # value ignored, avoids log(0)
+    outer = pi * pj
+    outer[~nnz] = 1
+    contingency_nm = c_xy / contingency_sum
+    mi = contingency_nm * (np.log(c_xy) - np.log(contingency_sum)) + contingency_nm * (-np.log(outer) + 2 * np.log(contingency_sum))
+    mi[~nnz] = 0
+    return mi.sum(axis=(1, 2))
+
+
+def histogram_bin_index(data, nbins):
+    """
+    Compute the bin index of each value, for a histogram with nbins equal bins between the min and max of each row.
+    Bins follow numpy.histogram2d conventions: [edge_i, edge_i+1[, except the last bin which includes the max value.
+    :param data: 2D numpy.array (n, m)
+    :param nbins: number of bins
+    :return: 2D numpy.array of int (n, m), values between 0 and nbins - 1
+    """
+    data_min, data_max = data.min(axis=1).astype(float), data.max(axis=1).astype(float)
+    # if a row is constant, its range is extended by 0.5 on each side
+    constant = data_min == data_max
+    data_min[constant] -= 0.5
+    data_max[constant] += 0.5
+    edges = data_min[:, np.newaxis] + np.arange(nbins + 1) * ((data_max - data_min) / nbins)[:, np.newaxis]
+    edges[:, -1] = data_max
+    # first guess, then correct for rounding errors by comparing to the edges
+    rows = np.arange(data.shape[0])[:, np.newaxis]
+    ind = np.clip(((data - data_min[:, np.newaxis]) / (data_max - data_min)[:, np.newaxis] * nbins).astype(int), 0, nbins - 1)
+    ind -= (data < edges[rows, ind]) & (ind > 0)
+    ind += (data >= edges[rows, ind + 1]) & (ind < nbins - 1)
+    return ind
+
+
 def correlation(x, y, type='pearson'):
     """
     Compute pearson or spearman correlation coeff
@@ -55,11 +55,12 @@ if "SCT_MPI_MODE" in os.environ:
     from distribute2mpi import MpiPool as Pool
 else:
     from multiprocessing import Pool
-import pandas as pd
 import sct_utils as sct
 import msct_parser
 import glob
 
+pd = sct.lazy_import('pandas')
+
 # get path of the toolbox
 # TODO: put it back below when working again (julien 2016-04-04)
 # <<<
@@ -21,7 +21,6 @@ import shutil
 from random import randint
 import time
 import numpy as np
-import scipy
 import sct_utils as sct
 from msct_nurbs import NURBS
 from sct_image import set_orientation
@@ -29,10 +28,13 @@ from sct_straighten_spinalcord import smooth_centerline
 from msct_image import Image
 from msct_parser import Parser
 import msct_shape
-import pandas as pd
 from msct_types import Centerline
 from spinalcordtoolbox.centerline import optic
 
+# heavy dependencies, imported on first use
+scipy = sct.lazy_import('scipy')
+pd = sct.lazy_import('pandas')
+
 
 class Param:
     def __init__(self):
@@ -615,7 +617,6 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
 # ==========================================================================================
 def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, use_phys_coord=True):
 
-    from math import degrees
     import pandas as pd
     import pickle
 
@@ -681,31 +682,26 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     # Compute CSA
     sct.printv('\nCompute CSA...', verbose)
 
-    # Empty arrays in which CSA for each z slice will be stored
-    csa = np.zeros(max_z_index - min_z_index + 1)
-    angles = np.zeros(max_z_index - min_z_index + 1)
-
-    for iz in xrange(min_z_index, max_z_index + 1):
-        if angle_correction:
-            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
-            try:
-                # normalize the tangent vector to the centerline (i.e. its derivative)
-                tangent_vect = normalize(np.array([x_centerline_deriv_rescorr[iz - min_z_index], y_centerline_deriv_rescorr[iz - min_z_index], z_centerline_deriv_rescorr[iz - min_z_index]]))
-
-            except IndexError:
-                sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
-
-            # compute the angle between the normal vector of the plane and the vector z
-            angle = np.arccos(np.vdot(tangent_vect, axis_Z))
-        else:
-            angle = 0.0
+    if angle_correction:
+        # normalize the tangent vectors to the centerline (i.e. its derivative) for all slices at once
+        tangent_vect = np.array([x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr], dtype=float).T[:max_z_index - min_z_index + 1]
+        tangent_vect /= np.linalg.norm(tangent_vect, axis=1)[:, np.newaxis]
+        # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
+        if len(tangent_vect) < max_z_index - min_z_index + 1:
+            sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
+            # the last available tangent vector is used for the missing slices
+            tangent_vect = np.concatenate((tangent_vect, np.tile(tangent_vect[-1], (max_z_index - min_z_index + 1 - len(tangent_vect), 1))))
+        # compute the angle between the normal vector of the plane and the vector z
+        angles = np.arccos(np.dot(tangent_vect, axis_Z))
+    else:
+        angles = np.zeros(max_z_index - min_z_index + 1)
 
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = np.sum(data_seg[:, :, iz])
+    # compute the number of voxels per slice, assuming the segmentation is coded for partial volume effect between 0 and 1.
+    number_voxels = np.sum(data_seg[:, :, min_z_index:max_z_index + 1], axis=(0, 1))
 
-        # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz - min_z_index] = number_voxels * px * py * np.cos(angle)
-        angles[iz - min_z_index] = degrees(angle)
+    # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
+    csa = number_voxels * px * py * np.cos(angles)
+    angles = np.degrees(angles)
 
     sct.printv('\nSmooth CSA across slices...', verbose)
     if smoothing_param:
@@ -731,18 +727,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
 
     # output volume of csa values
     sct.printv('\nCreate volume of CSA values...', verbose)
-    data_csa = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_csa[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_csa[i[0], i[1], iz] = csa[iz - min_z_index]
-    # replace data
-    im_seg.data = data_csa
+    im_seg.data = fill_segmentation_per_slice(data_seg, csa, min_z_index)
     # set original orientation
     # TODO: FIND ANOTHER WAY!!
     # im_seg.change_orientation(orientation) --> DOES NOT WORK!
@@ -752,23 +737,9 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     # save volume
     im_seg.save()
 
-    # output volume of csa values
+    # output volume of angle values
     sct.printv('\nCreate volume of angle values...', verbose)
-    data_angle = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_angle[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_angle[i[0], i[1], iz] = angles[iz - min_z_index]
-    # replace data
-    im_seg.data = data_angle
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
+    im_seg.data = fill_segmentation_per_slice(data_seg, angles, min_z_index)
     # set file name -- use .gz because faster to write
     im_seg.setFileName('angle_volume_RPI.nii.gz')
     im_seg.changeType('float32')
@@ -854,22 +825,16 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
             slices_list = range(int(slices_lim[0]), int(slices_lim[-1]) + 1)
             sct.printv('Average CSA across slices ' + str(slices_lim[0]) + ' to ' + str(slices_lim[-1]) + '...', type='info')
 
-            CSA_for_selected_slices = []
-            angles_for_selected_slices = []
-            # Read the file csa_per_slice.txt and get the CSA for the selected slices
-            with open(output_folder + 'csa_per_slice.txt') as openfile:
-                for line in openfile:
-                    if line[0] != '#':
-                        line_split = line.strip().split(',')
-                        if int(line_split[0]) in slices_list:
-                            CSA_for_selected_slices.append(float(line_split[1]))
-                            angles_for_selected_slices.append(float(line_split[2]))
+            # get the CSA and angle for the selected slices from the per-slice results
+            ind_selected_slices = np.in1d(np.arange(min_z_index, max_z_index + 1), slices_list)
+            CSA_for_selected_slices = csa[ind_selected_slices]
+            angles_for_selected_slices = angles[ind_selected_slices]
 
             # average the CSA and angle
-            mean_CSA = np.mean(np.asarray(CSA_for_selected_slices))
-            std_CSA = np.std(np.asarray(CSA_for_selected_slices))
-            mean_angle = np.mean(np.asarray(angles_for_selected_slices))
-            std_angle = np.std(np.asarray(angles_for_selected_slices))
+            mean_CSA = np.mean(CSA_for_selected_slices)
+            std_CSA = np.std(CSA_for_selected_slices)
+            mean_angle = np.mean(angles_for_selected_slices)
+            std_angle = np.std(angles_for_selected_slices)
 
         sct.printv('Mean CSA: ' + str(mean_CSA) + ' +/- ' + str(std_CSA) + ' mm^2', type='info')
         sct.printv('Mean angle: ' + str(mean_angle) + ' +/- ' + str(std_angle) + ' degrees', type='info')
@@ -906,6 +871,21 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
         sct.printv('Output result files of the volume in between the selected slices: \n\t\t' + output_folder + 'csa_volume.txt\n\t\t' + output_folder + 'csa_volume.xls\n\t\t' + output_folder + 'csa_volume.pickle', param.verbose, 'info')
 
 
+def fill_segmentation_per_slice(data_seg, values, min_z_index):
+    """
+    Create a volume in which each voxel of the segmentation is replaced by the value of its slice.
+    :param data_seg: 3D segmentation data (RPI)
+    :param values: array of values, one per slice, starting at slice min_z_index
+    :param min_z_index: index of the first slice of the segmentation
+    :return: 3D float32 array
+    """
+    data_out = data_seg.astype(np.float32)
+    z_range = slice(min_z_index, min_z_index + len(values))
+    data_slices = data_out[:, :, z_range]
+    data_out[:, :, z_range] = np.where(data_slices > 0, np.asarray(values, dtype=np.float32)[np.newaxis, np.newaxis, :], data_slices)
+    return data_out
+
+
 def label_vert(fname_seg, fname_label, verbose=1):
     """
     Label segmentation using vertebral labeling information
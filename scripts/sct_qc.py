@@ -18,6 +18,7 @@ from msct_parser import Parser
 from sct_utils import printv
 
 import spinalcordtoolbox.reports as reports
+import spinalcordtoolbox.reports.qc as qc
 
 
 def get_parser():
@@ -51,6 +52,11 @@ if __name__ == "__main__":
     arguments = parser.parse(sys.argv[1:])
     qc_path = arguments['-folder']
 
+    # render the QC entries recorded by tools run asynchronously and not processed yet
+    nb_jobs = qc.process_queue(os.path.realpath(qc_path))
+    if nb_jobs:
+        printv('Rendered %d pending QC entries' % nb_jobs)
+
     json_file = os.path.join(qc_path, 'qc_results.json')
 
     if not os.path.isfile(json_file):
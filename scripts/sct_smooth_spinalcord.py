@@ -15,20 +15,11 @@
 # TODO: maybe no need to convert RPI at the beginning because strainghten spinal cord already does it!
 
 
-import getopt
-import os
 import sys
 import time
 import sct_utils as sct
-from sct_image import set_orientation
-from shutil import move
-# from numpy import append, insert, nonzero, transpose, array
-# from nibabel import load, Nifti1Image, save
-# from scipy import ndimage
-# from copy import copy
 import numpy as np
-import shutil
-from sct_convert import convert
+from msct_image import Image
 from msct_parser import Parser
 
 
@@ -40,7 +31,8 @@ def get_parser():
     parser.usage.set_description('Smooth the spinal cord along its centerline. Steps are:\n'
                                  '1) Spinal cord is straightened (using centerline),\n'
                                  '2) a Gaussian kernel is applied in the superior-inferior direction,\n'
-                                 '3) then cord is de-straightened as originally.\n')
+                                 '3) then cord is de-straightened as originally.\n'
+                                 'The straightening is done in memory by sampling the image in the planes orthogonal to the centerline.\n')
     parser.add_option(name="-i",
                       type_value="file",
                       description="Image to smooth",
@@ -65,10 +57,10 @@ def get_parser():
     parser.usage.addSection('MISC')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
-                      description='Remove temporary files.',
+                      description='Remove temporary files. No temporary file is created anymore: this option has no effect.',
                       mandatory=False,
-                      default_value='1',
-                      example=['0', '1'])
+                      example=['0', '1'],
+                      deprecated=True)
     parser.add_option(name="-v",
                       type_value='multiple_choice',
                       description="verbose: 0 = nothing, 1 = classic, 2 = expended",
@@ -86,7 +78,6 @@ def main(args=None):
     # fname_anat = ''
     # fname_centerline = ''
     sigma = 3  # default value of the standard deviation for the Gaussian smoothing (in terms of number of voxels)
-    # remove_temp_files = param.remove_temp_files
     # verbose = param.verbose
     start_time = time.time()
 
@@ -97,8 +88,6 @@ def main(args=None):
     fname_centerline = arguments['-s']
     if '-smooth' in arguments:
         sigma = arguments['-smooth']
-    if '-r' in arguments:
-        remove_temp_files = int(arguments['-r'])
     if '-v' in arguments:
         verbose = int(arguments['-v'])
 
@@ -110,7 +99,6 @@ def main(args=None):
     print '  Verbose ........................... ' + str(verbose)
 
     # Check that input is 3D:
-    from msct_image import Image
     nx, ny, nz, nt, px, py, pz, pt = Image(fname_anat).dim
     dim = 4  # by default, will be adjusted later
     if nt == 1:
@@ -124,79 +112,33 @@ def main(args=None):
 
     # Extract path/file/extension
     path_anat, file_anat, ext_anat = sct.extract_fname(fname_anat)
-    path_centerline, file_centerline, ext_centerline = sct.extract_fname(fname_centerline)
-
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', verbose)
-    path_tmp = sct.slash_at_the_end('tmp.' + time.strftime("%y%m%d%H%M%S"), 1)
-    sct.run('mkdir ' + path_tmp, verbose)
-
-    # Copying input data to tmp folder
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-    sct.run('cp ' + fname_anat + ' ' + path_tmp + 'anat' + ext_anat, verbose)
-    sct.run('cp ' + fname_centerline + ' ' + path_tmp + 'centerline' + ext_centerline, verbose)
-
-    # go to tmp folder
-    os.chdir(path_tmp)
-
-    # convert to nii format
-    convert('anat' + ext_anat, 'anat.nii')
-    convert('centerline' + ext_centerline, 'centerline.nii')
-
-    # Change orientation of the input image into RPI
-    print '\nOrient input volume to RPI orientation...'
-    fname_anat_rpi = set_orientation('anat.nii', 'RPI', filename=True)
-    move(fname_anat_rpi, 'anat_rpi.nii')
-    # Change orientation of the input image into RPI
-    print '\nOrient centerline to RPI orientation...'
-    fname_centerline_rpi = set_orientation('centerline.nii', 'RPI', filename=True)
-    move(fname_centerline_rpi, 'centerline_rpi.nii')
-
-    # Straighten the spinal cord
-    # straighten segmentation
-    sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
-    # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-    if os.path.isfile('../warp_curve2straight.nii.gz') and os.path.isfile('../warp_straight2curve.nii.gz') and os.path.isfile('../straight_ref.nii.gz'):
-        # if they exist, copy them into current folder
-        sct.printv('WARNING: Straightening was already run previously. Copying warping fields...', verbose, 'warning')
-        shutil.copy('../warp_curve2straight.nii.gz', 'warp_curve2straight.nii.gz')
-        shutil.copy('../warp_straight2curve.nii.gz', 'warp_straight2curve.nii.gz')
-        shutil.copy('../straight_ref.nii.gz', 'straight_ref.nii.gz')
-        # apply straightening
-        sct.run('sct_apply_transfo -i anat_rpi.nii -w warp_curve2straight.nii.gz -d straight_ref.nii.gz -o anat_rpi_straight.nii -x spline', verbose)
-    else:
-        sct.run('sct_straighten_spinalcord -i anat_rpi.nii -s centerline_rpi.nii -qc 0 -x spline', verbose)
-
-    # Smooth the straightened image along z
-    print '\nSmooth the straightened image along z...'
-    sct.run('sct_maths -i anat_rpi_straight.nii -smooth 0,0,' + str(sigma) + ' -o anat_rpi_straight_smooth.nii', verbose)
-
-    # Apply the reversed warping field to get back the curved spinal cord
-    print '\nApply the reversed warping field to get back the curved spinal cord...'
-    sct.run('sct_apply_transfo -i anat_rpi_straight_smooth.nii -o anat_rpi_straight_smooth_curved.nii -d anat.nii -w warp_straight2curve.nii.gz -x spline', verbose)
+
+    # Change orientation of the input image into RPI (in memory, the header is not changed)
+    sct.printv('\nOrient input volume and centerline to RPI orientation...', verbose)
+    im_anat = Image(fname_anat)
+    im_centerline = Image(fname_centerline)
+    orientation_input = im_anat.orientation
+    im_anat_rpi = Image(param=im_anat.data.reshape(im_anat.dim[0:3]), hdr=im_anat.hdr, orientation=im_anat.orientation, dim=im_anat.dim)
+    im_anat_rpi.change_orientation('RPI')
+    im_centerline_rpi = Image(param=im_centerline.data.reshape(im_centerline.dim[0:3]), hdr=im_centerline.hdr, orientation=im_centerline.orientation, dim=im_centerline.dim)
+    im_centerline_rpi.change_orientation('RPI')
+
+    # Smooth the image along the centerline
+    sct.printv('\nSmooth the image along the spinal cord centerline...', verbose)
+    data_smooth = smooth_along_centerline(im_anat_rpi.data, im_centerline_rpi.data, im_anat_rpi.dim[4:7], sigma, verbose=verbose)
 
     # replace zeroed voxels by original image (issue #937)
     sct.printv('\nReplace zeroed voxels by original image...', verbose)
-    nii_smooth = Image('anat_rpi_straight_smooth_curved.nii')
-    data_smooth = nii_smooth.data
-    data_input = Image('anat.nii').data
     indzero = np.where(data_smooth == 0)
-    data_smooth[indzero] = data_input[indzero]
-    nii_smooth.data = data_smooth
-    nii_smooth.setFileName('anat_rpi_straight_smooth_curved_nonzero.nii')
-    nii_smooth.save()
-
-    # come back to parent folder
-    os.chdir('..')
+    data_smooth[indzero] = im_anat_rpi.data[indzero]
 
     # Generate output file
-    print '\nGenerate output file...'
-    sct.generate_output_file(path_tmp + '/anat_rpi_straight_smooth_curved_nonzero.nii', file_anat + '_smooth' + ext_anat)
-
-    # Remove temporary files
-    if remove_temp_files == 1:
-        print('\nRemove temporary files...')
-        sct.run('rm -rf ' + path_tmp)
+    sct.printv('\nGenerate output file...', verbose)
+    im_smooth = Image(param=data_smooth, hdr=im_anat.hdr.copy(), orientation='RPI', dim=im_anat_rpi.dim, absolutepath=file_anat + '_smooth' + ext_anat)
+    im_smooth.change_orientation(orientation_input)
+    im_smooth.changeType('float32')
+    im_smooth.save()
+    sct.printv('  File created: ' + im_smooth.absolutepath, verbose)
 
     # Display elapsed time
     elapsed_time = time.time() - start_time
@@ -207,6 +149,115 @@ def main(args=None):
     sct.printv('fslview ' + file_anat + ' ' + file_anat + '_smooth &\n', verbose, 'info')
 
 
+# SMOOTH ALONG CENTERLINE
+# ==========================================================================================
+def smooth_along_centerline(data, data_centerline, pixdim, sigma, algo_fitting='nurbs', precision=2.0, threshold_distance=10, interpolation_order=3, interp_factor=1, nb_voxels_per_block=1000000, verbose=1):
+    """
+    Smooth a volume along the spinal cord with a Gaussian kernel of standard deviation sigma (in mm).
+    The image is sampled in the planes orthogonal to the fitted centerline (straight space), smoothed along the
+    centerline and sampled back at each voxel, without generating warping fields.
+    :param data: 3D array in RPI orientation
+    :param data_centerline: 3D array in RPI orientation containing the centerline or the segmentation
+    :param pixdim: voxel size (px, py, pz) in mm
+    :param sigma: standard deviation of the Gaussian kernel in mm
+    :param threshold_distance: voxels further than this distance (in mm) from their nearest plane are not smoothed
+    :param interp_factor: oversampling factor of the straight space with respect to the voxel size
+    :param nb_voxels_per_block: bound on the number of voxels processed at once (straight space is processed by blocks)
+    :return: smoothed data. Voxels outside the straight space are set to 0.
+    """
+    from scipy.ndimage import map_coordinates, spline_filter
+    from scipy.ndimage.filters import gaussian_filter1d
+    from sct_straighten_spinalcord import smooth_centerline
+    from msct_types import Centerline
+
+    nx, ny, nz = data.shape
+    px, py, pz = [float(p) for p in pixdim]
+    pixdim = np.array([px, py, pz])
+
+    # fit centerline (voxel coordinates)
+    number_of_points = int(precision * (float(nz) / pz))
+    if number_of_points < 100:
+        number_of_points *= 50
+    if number_of_points == 0:
+        number_of_points = 50
+    im_centerline = Image(param=data_centerline, dim=(nx, ny, nz, 1, px, py, pz, 1))
+    x_fit, y_fit, z_fit, x_deriv, y_deriv, z_deriv = smooth_centerline(im_centerline, algo_fitting=algo_fitting, verbose=verbose, nurbs_pts_number=number_of_points, all_slices=False, remove_outliers=True)
+
+    # resample centerline along its length, with the step of the straight space (mm coordinates)
+    step = pixdim / float(interp_factor)
+    points = np.array([x_fit, y_fit, z_fit], dtype=float).T * pixdim
+    length_points = np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(points, axis=0), axis=1))])
+    position = np.arange(0.0, length_points[-1] + step[2] / 2.0, step[2])
+    points = np.array([np.interp(position, length_points, points[:, i]) for i in range(3)]).T
+    derivatives = np.gradient(points, axis=0)
+    centerline = Centerline(points[:, 0], points[:, 1], points[:, 2], derivatives[:, 0], derivatives[:, 1], derivatives[:, 2])
+    ns = centerline.number_of_points
+    sct.printv('.. Length of centerline: ' + str(round(length_points[-1], 2)) + ' mm (' + str(ns) + ' planes)', verbose)
+
+    # position of each voxel in the straight space: in-plane coordinates (u, v) and position along centerline (s)
+    data_filtered = spline_filter(np.asarray(data, dtype=float), order=interpolation_order) if interpolation_order > 1 else np.asarray(data, dtype=float)
+    nb_slices_per_block = max(1, nb_voxels_per_block / (nx * ny))
+    xx, yy = np.mgrid[0:nx, 0:ny]
+    coord_straight = np.zeros((nx, ny, nz, 3), dtype=np.float32)
+    for z_start in range(0, nz, nb_slices_per_block):
+        z_block = np.arange(z_start, min(z_start + nb_slices_per_block, nz))
+        coordinates = np.column_stack([np.repeat(xx[:, :, np.newaxis], len(z_block), axis=2).ravel(),
+                                       np.repeat(yy[:, :, np.newaxis], len(z_block), axis=2).ravel(),
+                                       np.tile(z_block, nx * ny)]) * pixdim
+        indexes = centerline.find_nearest_indexes(coordinates)
+        coord_in_planes = centerline.get_in_plans_coordinates(coordinates, indexes)
+        coord_in_planes[:, 2] += indexes * step[2]
+        coord_in_planes[np.abs(coord_in_planes[:, 2] - indexes * step[2]) > threshold_distance] = np.nan
+        coord_straight[:, :, z_block, :] = coord_in_planes.reshape(nx, ny, len(z_block), 3)
+
+    # straight space covering all voxels
+    valid = np.isfinite(coord_straight[:, :, :, 0]) & (coord_straight[:, :, :, 2] >= 0) & (coord_straight[:, :, :, 2] <= (ns - 1) * step[2])
+    if not valid.any():
+        sct.printv('WARNING: no voxel could be mapped to the straight space. Image is not smoothed.', verbose, 'warning')
+        return np.zeros(data.shape)
+    coord_straight = coord_straight[valid]
+    u_min, v_min = coord_straight[:, 0].min(), coord_straight[:, 1].min()
+    coord_straight = (coord_straight - [u_min, v_min, 0]) / step
+    nu = int(np.ceil(coord_straight[:, 0].max())) + 1
+    nv = int(np.ceil(coord_straight[:, 1].max())) + 1
+    sct.printv('.. Straight space: ' + str(nu) + ' x ' + str(nv) + ' x ' + str(ns), verbose)
+
+    # the straight space is processed by blocks along u, with a margin for the interpolation
+    margin = 1 if interpolation_order <= 1 else 6
+    nb_u_per_block = max(1, nb_voxels_per_block / (nv * ns))
+    data_smooth_valid = np.zeros(len(coord_straight))
+    for u_start in range(0, nu, nb_u_per_block):
+        u_end = min(u_start + nb_u_per_block, nu)
+        u_low, u_high = max(0, u_start - margin), min(nu, u_end + margin)
+        nu_block = u_high - u_low
+
+        # sample the image in the planes of the centerline
+        uu, vv = np.mgrid[u_low:u_high, 0:nv]
+        coord_in_plane = np.column_stack([u_min + uu.ravel() * step[0], v_min + vv.ravel() * step[1], np.zeros(nu_block * nv)])
+        data_straight = np.zeros((nu_block, nv, ns), dtype=np.float32)
+        nb_planes_per_block = max(1, nb_voxels_per_block / (nu_block * nv))
+        for s_start in range(0, ns, nb_planes_per_block):
+            s_block = np.arange(s_start, min(s_start + nb_planes_per_block, ns))
+            indexes = np.repeat(s_block, nu_block * nv)
+            coordinates = centerline.get_inverse_plans_coordinates(np.tile(coord_in_plane, (len(s_block), 1)), indexes) / pixdim
+            data_straight[:, :, s_block] = map_coordinates(data_filtered, coordinates.T, order=interpolation_order, mode='constant', cval=0.0, prefilter=False).reshape(len(s_block), nu_block, nv).transpose(1, 2, 0)
+
+        # smooth along the centerline
+        data_straight = gaussian_filter1d(data_straight, sigma / step[2], axis=2, truncate=4.0)
+        if interpolation_order > 1:
+            data_straight = spline_filter(data_straight, order=interpolation_order)
+
+        # sample back the smoothed straight space at each voxel of the block
+        ind_block = np.where((coord_straight[:, 0] >= u_start) & ((coord_straight[:, 0] < u_end) | (u_end == nu)))[0]
+        coordinates = coord_straight[ind_block] - [u_low, 0, 0]
+        data_smooth_valid[ind_block] = map_coordinates(data_straight, coordinates.T, order=interpolation_order, mode='nearest', prefilter=False)
+
+    data_smooth = np.zeros(data.shape)
+    data_smooth[valid] = data_smooth_valid
+
+    return data_smooth
+
+
 # START PROGRAM
 # ==========================================================================================
 if __name__ == "__main__":
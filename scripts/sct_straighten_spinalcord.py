@@ -18,14 +18,14 @@ import time
 import commands
 import sys
 from msct_parser import Parser
-from nibabel import Nifti1Image, save
-from scipy import ndimage
 from sct_apply_transfo import Transform
 import sct_utils as sct
 from msct_smooth import smoothing_window, evaluate_derivative_3D
 from math import sqrt
 import numpy as np
 
+ndimage = sct.lazy_import('scipy.ndimage')
+
 
 def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='hanning', window_length=80, verbose=0, nurbs_pts_number=1000, all_slices=True, phys_coordinates=False, remove_outliers=False):
     """
@@ -687,6 +687,7 @@ class SpinalCordStraightener(object):
             hdr_warp_s.set_data_dtype('float32')
             hdr_warp.set_intent('vector', (), '')
             hdr_warp.set_data_dtype('float32')
+            from nibabel import Nifti1Image, save
             if self.curved2straight:
                 img = Nifti1Image(data_warp_curved2straight, None, hdr_warp_s)
                 save(img, 'tmp.curve2straight.nii.gz')
@@ -10,8 +10,10 @@
 
 import sys
 import time
+import traceback
 
 import os
+from multiprocessing import Pool, cpu_count
 from msct_parser import Parser
 
 # get path of the toolbox
@@ -52,6 +54,7 @@ class param:
         self.function_to_test = None
         # self.function_to_avoid = None
         self.remove_tmp_file = 0
+        self.nb_cpu = 1
         self.verbose = 1
         # self.url_git = 'https://github.com/neuropoly/sct_testing_data.git'
         self.path_tmp = ""
@@ -75,6 +78,10 @@ def main(args=None):
         param.function_to_test = arguments['-f']
     if '-r' in arguments:
         param.remove_tmp_file = int(arguments['-r'])
+    if '-cpu-nb' in arguments:
+        param.nb_cpu = int(arguments['-cpu-nb'])
+    if param.nb_cpu == 0:
+        param.nb_cpu = cpu_count()
 
     # path_data = param.path_data
     function_to_test = param.function_to_test
@@ -92,7 +99,7 @@ def main(args=None):
     sct.printv('\nPath to testing data: ' + param.path_data, param.verbose)
 
     # create temp folder that will have all results and go in it
-    param.path_tmp = sct.tmp_create()
+    param.path_tmp = sct.slash_at_the_end(os.path.abspath(sct.tmp_create()), 1)
     os.chdir(param.path_tmp)
 
     # get list of all scripts to test
@@ -100,12 +107,19 @@ def main(args=None):
     if function_to_test:
         if not function_to_test in functions:
             sct.printv('Function "%s" is not part of the list of testing functions' % function_to_test, type='warning')
-        # loop across all functions and test them
-        status = [test_function(f) for f in functions if function_to_test == f]
+        functions = [f for f in functions if function_to_test == f]
+
+    # loop across all functions and test them
+    if param.nb_cpu > 1 and len(functions) > 1:
+        results = test_functions_parallel(functions, param.nb_cpu)
     else:
-        status = [test_function(f) for f in functions]
+        results = [test_function(f) for f in functions]
+    status = [r[1] for r in results]
     print 'status: ' + str(status)
 
+    # display summary of all tests
+    print_summary(results)
+
     # display elapsed time
     elapsed_time = time.time() - start_time
     print 'Finished! Elapsed time: ' + str(int(round(elapsed_time))) + 's\n'
@@ -234,33 +248,48 @@ def write_to_log_file(fname_log, string, mode='w', prepend=False):
     f.close()
 
 
-# test function
+# run test function in its own result folder
 # ==========================================================================================
-def test_function(script_name):
-    # if script_name == 'test_debug':
-    #     return test_debug()  # JULIEN
-    # else:
-    # build script name
-    fname_log = '../' + script_name + ".log"
-    tmp_script_name = script_name
-    result_folder = "results_" + script_name
-    script_name = "test_" + script_name
+def run_function(script_name):
+    """
+    Run one test module in an isolated result folder and write its log file.
+    Paths are absolute so that several tests can run concurrently in separate processes.
+    :param script_name: name of the tested script, without the "test_" prefix
+    :return: tuple (script_name, status, output, duration)
+    """
+    fname_log = os.path.join(param.path_tmp, script_name + '.log')
+    result_folder = os.path.join(param.path_tmp, 'results_' + script_name)
 
     sct.create_folder(result_folder)
     os.chdir(result_folder)
 
-    # display script name
-    print_line('Checking ' + script_name)
-    # import function as a module
-    script_tested = importlib.import_module(script_name)
-    # test function
-    result_test = script_tested.test(param.path_data)
-    # test functions can return 2 or 3 variables, depending if there is results.
-    # In this script, we look only at the first two variables.
-    status, output = result_test[0], result_test[1]
+    start_time = time.time()
+    try:
+        # import function as a module
+        script_tested = importlib.import_module('test_' + script_name)
+        # test function
+        result_test = script_tested.test(param.path_data)
+        # test functions can return 2 or 3 variables, depending if there is results.
+        # In this script, we look only at the first two variables.
+        status, output = result_test[0], result_test[1]
+    except (Exception, SystemExit):
+        # sct.run() and sct.printv(..., 'error') call sys.exit(): mark the test as failed instead of
+        # aborting the run (or killing the worker process, which would hang the pool)
+        status, output = 1, traceback.format_exc()
+    finally:
+        # go back to parent folder
+        os.chdir(param.path_tmp)
+    duration = time.time() - start_time
+
     # write log file
     write_to_log_file(fname_log, output, 'w')
-    # manage status
+
+    return script_name, status, output, duration
+
+
+# display status of a test
+# ==========================================================================================
+def print_status(status, output):
     if status == 0:
         print_ok()
     else:
@@ -269,11 +298,62 @@ def test_function(script_name):
         else:
             print_fail()
         print output
-    # go back to parent folder
-    os.chdir('..')
 
-    # return
-    return status
+
+# test function
+# ==========================================================================================
+def test_function(script_name):
+    # display script name
+    print_line('Checking test_' + script_name)
+    result = run_function(script_name)
+    print_status(result[1], result[2])
+    return result
+
+
+# test functions in parallel
+# ==========================================================================================
+def test_functions_parallel(functions, nb_cpu):
+    """
+    Run test modules concurrently. Each test runs in its own process and result folder.
+    Status lines are displayed as tests complete; results are returned in the order of functions.
+    """
+    sct.printv('\nRunning ' + str(len(functions)) + ' tests on ' + str(nb_cpu) + ' CPUs...', param.verbose)
+    # All scripts that are using multithreading with ITK must not use it when using multiprocessing
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = "1"
+
+    pool = Pool(nb_cpu)
+    results = {}
+    try:
+        for result in pool.imap_unordered(run_function, functions):
+            print_line('Checking test_' + result[0])
+            print_status(result[1], result[2])
+            results[result[0]] = result
+        pool.close()
+    except KeyboardInterrupt:
+        print "\nWarning: Caught KeyboardInterrupt, terminating workers"
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return [results[f] for f in functions]
+
+
+# display summary of all tests
+# ==========================================================================================
+def print_summary(results):
+    print '\nSummary:'
+    for script_name, status, output, duration in results:
+        if status == 0:
+            status_str = 'OK'
+        elif status == 99:
+            status_str = 'WARNING'
+        else:
+            status_str = 'FAIL'
+        print_line('test_' + script_name)
+        print status_str + ' (' + str(int(round(duration))) + 's)'
+    nb_failed = len([r for r in results if r[1] not in [0, 99]])
+    print str(len(results) - nb_failed) + '/' + str(len(results)) + ' passed'
 
 
 def get_parser():
@@ -302,6 +382,12 @@ def get_parser():
                       mandatory=False,
                       default_value='1',
                       example=['0', '1'])
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for testing. 0: use all the available cores. 1: run tests serially.",
+                      mandatory=False,
+                      default_value=param.nb_cpu,
+                      example='4')
     return parser
 
 
@@ -667,6 +667,44 @@ def check_if_same_space(fname_1, fname_2):
     return all(around(q1, dec) == around(q2, dec))
 
 
+#=======================================================================================================================
+# lazy_import
+#=======================================================================================================================
+class LazyModule(object):
+    """Proxy of a module that is only imported when one of its attributes is accessed.
+
+    Heavy dependencies (scipy, matplotlib, pandas, sklearn...) can be bound at module level without being
+    imported at startup, so that CLIs only pay the import cost on the code paths that need them.
+    """
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            import importlib
+            self.__dict__['_lazy_module'] = importlib.import_module(self._lazy_name)
+        return self._lazy_module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __repr__(self):
+        return '<lazy module ' + repr(self._lazy_name) + '>'
+
+
+def lazy_import(name):
+    """Return module `name` if it is already imported, a LazyModule proxy otherwise.
+    Example: plt = lazy_import('matplotlib.pyplot')
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
+
+
 def printv(string, verbose=1, type='normal'):
     """enables to print color coded messages, depending on verbose status """
 
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import contextlib
+import fcntl
 import json
 import logging
 import os
+import struct
 import subprocess
+import sys
+import uuid
+import zlib
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -21,6 +27,111 @@ logging.basicConfig()
 logger = logging.getLogger(__file__)
 
 
+def hex_to_rgba(hex_color):
+    """Converts a '#rrggbb' string into a uint8 RGBA tuple"""
+    hex_color = hex_color.lstrip('#')
+    return tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4)) + (255,)
+
+
+def gray_lut(nb_colors=256):
+    """Lookup table equivalent to matplotlib's `gray` colormap"""
+    lut = np.empty((nb_colors, 4), dtype=np.uint8)
+    lut[:, :3] = np.round(np.linspace(0, 255, nb_colors))[:, None]
+    lut[:, 3] = 255
+    return lut
+
+
+def autumn_lut(nb_colors=256):
+    """Lookup table equivalent to matplotlib's `autumn` colormap (red to yellow)"""
+    lut = np.zeros((nb_colors, 4), dtype=np.uint8)
+    lut[:, 0] = 255
+    lut[:, 1] = np.round(np.linspace(0, 255, nb_colors))
+    lut[:, 3] = 255
+    return lut
+
+
+def listed_lut(colors):
+    """Lookup table made of a list of '#rrggbb' colors"""
+    return np.array([hex_to_rgba(c) for c in colors], dtype=np.uint8)
+
+
+def apply_lut(values, lut, vmin, vmax, mask=None):
+    """Maps a 2D array onto RGBA colors with a lookup table
+
+    The value range [vmin, vmax] is split into `len(lut)` bins, like matplotlib does for a colormap with
+    `len(lut)` entries. Values out of range take the first or last color.
+
+    Parameters
+    ----------
+    values : ndarray
+        2D array to map
+    lut : ndarray
+        (n, 4) uint8 lookup table
+    vmin, vmax : float
+        values mapped onto the first and last color
+    mask : ndarray of bool
+        pixels to leave fully transparent
+
+    Returns
+    -------
+    ndarray
+        (height, width, 4) uint8 array
+    """
+    nb_colors = len(lut)
+    if vmax > vmin:
+        index = np.floor((np.asarray(values, dtype=np.float64) - vmin) * (nb_colors / float(vmax - vmin)))
+        index = np.clip(np.nan_to_num(index), 0, nb_colors - 1).astype(np.intp)
+    else:
+        index = np.zeros(np.shape(values), dtype=np.intp)
+    rgba = lut[index]
+    if mask is not None:
+        rgba[mask] = 0
+    return rgba
+
+
+def apply_aspect(rgba, aspect):
+    """Stretches an image so its pixels are displayed with the physical `aspect` ratio (height / width)
+
+    Nearest neighbour resampling is used, which is what `interpolation='none'` gives in matplotlib.
+    The image is only enlarged, rows when aspect > 1 and columns otherwise.
+    """
+    aspect = float(aspect)
+    axis, factor = (0, aspect) if aspect >= 1 else (1, 1 / aspect)
+    size = rgba.shape[axis]
+    new_size = int(round(size * factor))
+    if new_size == size:
+        return rgba
+    index = np.minimum(((np.arange(new_size) + 0.5) / factor).astype(np.intp), size - 1)
+    return np.take(rgba, index, axis=axis)
+
+
+def write_png(img_path, rgba, compression=6):
+    """Writes a (height, width, 4) uint8 array into a RGBA png file
+
+    Parameters
+    ----------
+    img_path : str
+        path of the output file
+    rgba : ndarray
+        uint8 image
+    compression : int
+        zlib compression level
+    """
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    height, width = rgba.shape[:2]
+    # each scanline starts with its filter type (0: none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = np.ascontiguousarray(rgba, dtype=np.uint8).reshape(height, width * 4)
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    with open(img_path, 'wb') as png:
+        png.write(b'\x89PNG\r\n\x1a\n')
+        png.write(chunk(b'IHDR', header))
+        png.write(chunk(b'IDAT', zlib.compress(raw.tostring(), compression)))
+        png.write(chunk(b'IEND', b''))
+
+
 class QcImage(object):
     """
     Class used to create a .png file from a 2d image produced by the class "Slice"
@@ -53,8 +164,12 @@ class QcImage(object):
                      "#7d0434", "#fb1849", "#14aab4",
                      "#a22abd", "#d58240", "#ac2aff"]
     _seg_colormap = plt.cm.autumn
+    # actions that can be rendered without matplotlib, and the method building their RGBA overlay
+    _array_renderers = {'listed_seg': 'listed_seg_rgba',
+                        'no_seg_seg': 'no_seg_seg_rgba',
+                        'sequential_seg': 'sequential_seg_rgba'}
 
-    def __init__(self, qc_report, interpolation, action_list):
+    def __init__(self, qc_report, interpolation, action_list, backend='array', asynchronous=None):
         """
 
         Parameters
@@ -65,10 +180,21 @@ class QcImage(object):
             Type of interpolation used in matplotlib
         action_list : list of functions
             List of functions that generates a specific type of images
+        backend : str
+            'array' builds the images as uint8 RGBA arrays with lookup tables and writes them directly,
+            'matplotlib' draws them as figures. Actions that annotate the image (e.g. label_vertebrae)
+            always use matplotlib.
+        asynchronous : bool
+            If True, the mosaics are only recorded in the QC job queue and a worker process renders them
+            and updates the report. Defaults to the environment variable SCT_QC_ASYNC (0 or 1).
         """
         self.qc_report = qc_report
         self.interpolation = interpolation
         self.action_list = action_list
+        self.backend = backend
+        if asynchronous is None:
+            asynchronous = os.environ.get('SCT_QC_ASYNC', '0') == '1'
+        self.asynchronous = asynchronous
 
     """
     action_list contain the list of images that has to be generated.
@@ -121,6 +247,24 @@ class QcImage(object):
                     ax.text(y, x, label, color='black', weight='heavy', clip_on=True)
                     ax.text(y, x, label, color=color, clip_on=True)
 
+    def listed_seg_rgba(self, mask):
+        values = np.rint(mask)
+        return apply_lut(values, listed_lut(self._labels_color), 0, len(self._labels_color), mask=mask < 1)
+
+    def no_seg_seg_rgba(self, mask):
+        return self._autoscaled_rgba(np.rint(mask), gray_lut())
+
+    def sequential_seg_rgba(self, mask):
+        return self._autoscaled_rgba(np.rint(mask), autumn_lut())
+
+    @staticmethod
+    def _autoscaled_rgba(values, lut):
+        """Maps the non-zero values on the full lookup table, zeros are transparent"""
+        mask = values == 0
+        if mask.all():
+            return apply_lut(values, lut, 0, 0, mask=mask)
+        return apply_lut(values, lut, values[~mask].min(), values[~mask].max(), mask=mask)
+
     def colorbar(self):
         fig = plt.figure(figsize=(9, 1.5))
         ax = fig.add_axes([0.05, 0.80, 0.9, 0.15])
@@ -151,29 +295,76 @@ class QcImage(object):
 
             """
             self.qc_report.slice_name = sct_slice.get_name()
-            aspect_img, self.aspect_mask = sct_slice.aspect()
-            self.qc_report.make_content_path()
+            aspect_img, aspect_mask = sct_slice.aspect()
             logger.info('QC: %s with %s slice', func.__name__, sct_slice.get_name())
 
             img, mask = func(sct_slice, *args)
 
-            plt.figure(1)
-            fig = plt.imshow(img, cmap=plt.cm.gray, interpolation=self.interpolation, aspect=float(aspect_img))
-            fig.axes.get_xaxis().set_visible(False)
-            fig.axes.get_yaxis().set_visible(False)
-            self._save(self.qc_report.qc_params.abs_bkg_img_path())
+            if self.asynchronous:
+                enqueue_job(self, img, mask, aspect_img, aspect_mask)
+                start_worker(self.qc_report.qc_params.root_folder)
+            else:
+                self.render(img, mask, aspect_img, aspect_mask)
 
-            for action in self.action_list:
-                logger.debug('Action List %s', action.__name__)
-                plt.clf()
-                plt.figure(1)
-                action(self, mask)
-                self._save(self.qc_report.qc_params.abs_overlay_img_path())
-            plt.close()
+        return wrapped_f
 
-            self.qc_report.update_description_file(img.shape)
+    def render(self, img, mask, aspect_img, aspect_mask):
+        """Writes the background and overlay images and adds them to the description file
 
-        return wrapped_f
+        Parameters
+        ----------
+        img : ndarray
+            2D background image
+        mask : ndarray
+            2D overlay
+        aspect_img, aspect_mask : float
+            physical aspect ratio of the pixels of the background and of the overlay
+        """
+        self.aspect_mask = aspect_mask
+        self.qc_report.make_content_path()
+
+        renderers = [self._array_renderers.get(action.__name__) for action in self.action_list]
+        if self.backend == 'array' and None not in renderers:
+            self._render_arrays(img, mask, aspect_img, renderers)
+        else:
+            self._render_figures(img, mask, aspect_img)
+
+        self.qc_report.update_description_file(img.shape)
+
+    def _render_arrays(self, img, mask, aspect_img, renderers):
+        """Builds the background and overlay images as RGBA arrays and writes them as png
+
+        Overlays of successive actions are drawn on top of each other.
+        """
+        img = np.asarray(img, dtype=np.float64)
+        finite = np.isfinite(img)
+        vmin, vmax = (img[finite].min(), img[finite].max()) if finite.any() else (0, 0)
+        bkg = apply_lut(img, gray_lut(), vmin, vmax)
+        write_png(self.qc_report.qc_params.abs_bkg_img_path(), apply_aspect(bkg, aspect_img))
+
+        overlay = np.zeros(np.shape(mask) + (4,), dtype=np.uint8)
+        for renderer in renderers:
+            logger.debug('Action List %s', renderer)
+            layer = getattr(self, renderer)(mask)
+            drawn = layer[..., 3] > 0
+            overlay[drawn] = layer[drawn]
+        write_png(self.qc_report.qc_params.abs_overlay_img_path(), apply_aspect(overlay, self.aspect_mask))
+
+    def _render_figures(self, img, mask, aspect_img):
+        """Draws the background and overlay images with matplotlib, needed for annotated figures"""
+        plt.figure(1)
+        fig = plt.imshow(img, cmap=plt.cm.gray, interpolation=self.interpolation, aspect=float(aspect_img))
+        fig.axes.get_xaxis().set_visible(False)
+        fig.axes.get_yaxis().set_visible(False)
+        self._save(self.qc_report.qc_params.abs_bkg_img_path())
+
+        for action in self.action_list:
+            logger.debug('Action List %s', action.__name__)
+            plt.clf()
+            plt.figure(1)
+            action(self, mask)
+            self._save(self.qc_report.qc_params.abs_overlay_img_path())
+        plt.close()
 
     def _save(self, img_path, format='png', bbox_inches='tight', pad_inches=0.00):
         """ Save the current figure into an image.
@@ -315,8 +506,150 @@ class QcReport(object):
             'moddate': datetime.datetime.now().isoformat(' ')
         }
         logger.debug('Description file: %s', self.qc_params.qc_results)
-        results = []
-        if os.path.isfile(self.qc_params.qc_results):
-            results = json.load(open(self.qc_params.qc_results, 'r'))
-        results.append(output)
-        json.dump(results, open(self.qc_params.qc_results, "w"), indent=2)
+        # several processes can update the same report: read, append and replace under an exclusive lock
+        with locked(self.qc_params.qc_results + '.lock'):
+            results = []
+            if os.path.isfile(self.qc_params.qc_results):
+                with open(self.qc_params.qc_results, 'r') as results_file:
+                    results = json.load(results_file)
+            results.append(output)
+            tmp_path = '%s.%d.tmp' % (self.qc_params.qc_results, os.getpid())
+            with open(tmp_path, 'w') as results_file:
+                json.dump(results, results_file, indent=2)
+            os.rename(tmp_path, self.qc_params.qc_results)
+
+
+@contextlib.contextmanager
+def locked(lock_path):
+    """Holds an exclusive lock on `lock_path` (created if needed) for the duration of the block"""
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def queue_folder(root_folder):
+    """Folder of the QC report where the pending rendering jobs are recorded"""
+    return os.path.join(root_folder, '.queue')
+
+
+def enqueue_job(qc_image, img, mask, aspect_img, aspect_mask):
+    """Records the data needed to render a QC entry in the job queue of the report
+
+    A job is a compressed .npz file containing the background and overlay mosaics and the metadata of the
+    entry as JSON. It is written under a temporary name and renamed, so workers never see a partial job.
+
+    Parameters
+    ----------
+    qc_image : QcImage
+        decorator holding the report, the actions and the rendering options
+    img, mask : ndarray
+        2D background image and overlay
+    aspect_img, aspect_mask : float
+        physical aspect ratio of the pixels of the background and of the overlay
+
+    Returns
+    -------
+    str
+        path of the job file
+    """
+    qc_params = qc_image.qc_report.qc_params
+    folder = queue_folder(qc_params.root_folder)
+    try:
+        os.makedirs(folder)
+    except OSError as err:
+        if not os.path.isdir(folder):
+            raise err
+
+    meta = {
+        'params': qc_params.__dict__,
+        'usage': qc_image.qc_report.usage,
+        'slice_name': qc_image.qc_report.slice_name,
+        'interpolation': qc_image.interpolation,
+        'actions': [action.__name__ for action in qc_image.action_list],
+        'backend': qc_image.backend,
+        'aspect_img': float(aspect_img),
+        'aspect_mask': float(aspect_mask),
+    }
+    name = '%s_%s' % (qc_params.mod_date, uuid.uuid4().hex)
+    job_path = os.path.join(folder, name + '.npz')
+    tmp_path = os.path.join(folder, name + '.tmp')
+    with open(tmp_path, 'wb') as job_file:
+        np.savez_compressed(job_file, img=img, mask=mask, meta=np.array(json.dumps(meta)))
+    os.rename(tmp_path, job_path)
+    logger.debug('QC job recorded %s', job_path)
+    return job_path
+
+
+def render_job(job_path):
+    """Renders a recorded QC job and adds it to the description file of its report"""
+    with np.load(job_path) as job:
+        img, mask = job['img'], job['mask']
+        meta = json.loads(str(job['meta']))
+
+    qc_params = Params.__new__(Params)
+    qc_params.__dict__.update(meta['params'])
+    report = QcReport(qc_params, meta['usage'])
+    report.slice_name = meta['slice_name']
+    qc_image = QcImage(report, meta['interpolation'], [getattr(QcImage, name) for name in meta['actions']],
+                       backend=meta['backend'], asynchronous=False)
+    qc_image.render(img, mask, meta['aspect_img'], meta['aspect_mask'])
+
+
+def process_queue(root_folder):
+    """Renders all the pending jobs of a QC report
+
+    Several workers can process the same queue: a job is claimed by renaming it, which only one of them
+    can do. Jobs that fail are kept with the suffix '.failed'.
+
+    Parameters
+    ----------
+    root_folder : str
+        The absolute path of the QC root
+
+    Returns
+    -------
+    int
+        number of jobs rendered by this worker
+    """
+    folder = queue_folder(root_folder)
+    if not os.path.isdir(folder):
+        return 0
+    nb_jobs = 0
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.npz'):
+            continue
+        job_path = os.path.join(folder, name)
+        claimed_path = '%s.%d' % (job_path, os.getpid())
+        try:
+            os.rename(job_path, claimed_path)
+        except OSError:
+            # claimed by another worker
+            continue
+        try:
+            render_job(claimed_path)
+        except Exception as err:
+            logger.error('QC job %s failed: %s', name, err)
+            os.rename(claimed_path, job_path + '.failed')
+            continue
+        os.remove(claimed_path)
+        nb_jobs += 1
+    return nb_jobs
+
+
+def start_worker(root_folder):
+    """Starts a detached process rendering the pending jobs of a QC report"""
+    import spinalcordtoolbox
+    env = os.environ.copy()
+    pardir = os.path.dirname(os.path.dirname(os.path.abspath(spinalcordtoolbox.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join([pardir] + [p for p in [env.get('PYTHONPATH')] if p])
+    with open(os.devnull, 'wb') as devnull:
+        return subprocess.Popen([sys.executable, '-m', 'spinalcordtoolbox.reports.qc', root_folder],
+                                env=env, stdout=devnull, stderr=devnull, close_fds=True)
+
+
+if __name__ == '__main__':
+    # QC worker: python -m spinalcordtoolbox.reports.qc <qc_folder>
+    process_queue(os.path.abspath(sys.argv[1]))
@@ -6,7 +6,6 @@ import logging
 import math
 
 import numpy as np
-from scipy import ndimage
 
 
 logger = logging.getLogger(__name__)
@@ -47,6 +46,10 @@ image_seg : msct_image.Image
     def axial_slice(data, i):
         return data[i, :, :]
 
+    @staticmethod
+    def axial_slices(data):
+        return data
+
     @staticmethod
     def axial_dim(image):
         nx, ny, nz, nt, px, py, pz, pt = image.dim
@@ -61,6 +64,10 @@ image_seg : msct_image.Image
     def sagittal_slice(data, i):
         return data[:, :, int(i)]
 
+    @staticmethod
+    def sagittal_slices(data):
+        return np.moveaxis(data, 2, 0)
+
     @staticmethod
     def sagittal_dim(image):
         nx, ny, nz, nt, px, py, pz, pt = image.dim
@@ -75,6 +82,10 @@ image_seg : msct_image.Image
     def coronal_slice(data, i):
         return data[:, i, :]
 
+    @staticmethod
+    def coronal_slices(data):
+        return np.moveaxis(data, 1, 0)
+
     @staticmethod
     def coronal_dim(image):
         nx, ny, nz, nt, px, py, pz, pt = image.dim
@@ -161,12 +172,39 @@ image_seg : msct_image.Image
         matrix[start_row:end_row, start_col:end_col] = patch
         return matrix
 
+    @staticmethod
+    def crop_windows(centers, width, length):
+        """Computes the crop windows of all the slices at once
+
+        Same rules as `crop`: the half size is reduced to fit the matrix and the windows are shifted
+        so they do not start before the first index.
+
+        Parameters
+        ----------
+        centers : ndarray of int
+            The center of the crop area of each slice
+        width : int
+            The width from the center
+        length : int
+            The size of the matrix along this axis
+
+        Returns
+        -------
+        tuple of ndarray
+            (nb_slices, 2 * width) indexes of the window of each slice, clipped to the matrix, and
+            boolean array telling which indexes are inside the matrix
+        """
+        width = min(width, length // 2)
+        start = np.maximum(centers, width) - width
+        index = start[:, None] + np.arange(width * 2)
+        inside = index < length
+        return np.minimum(index, length - 1), inside
+
     @staticmethod
     def nan_fill(array):
-        """TODO """
-        array[np.isnan(array)] = np.interp(np.isnan(array).ravel().nonzero()[0],
-                                           (-np.isnan(array)).ravel().nonzero()[0],
-                                           array[-np.isnan(array)])
+        """Fills NaNs by linear interpolation of the valid values"""
+        nans = np.isnan(array)
+        array[nans] = np.interp(nans.ravel().nonzero()[0], (~nans).ravel().nonzero()[0], array[~nans])
         return array
 
     @abc.abstractmethod
@@ -190,6 +228,21 @@ image_seg : msct_image.Image
         """
         return
 
+    @abc.abstractmethod
+    def get_slices(self, data):
+        """Abstract method to obtain all the slices of a 3d matrix as a view
+
+        Parameters
+        ----------
+        data: numpy.ndarray
+
+        Returns
+        -------
+        numpy.ndarray
+            3D view of the data where the first axis is the slice index
+        """
+        return
+
     @abc.abstractmethod
     def get_dim(self, image):
         """Abstract method to obtain the depth of the 3d matrix.
@@ -216,11 +269,11 @@ image_seg : msct_image.Image
         tuple of numpy.ndarray of int
             centers of mass in the x and y axis.
         """
-        axial_dim = self.axial_dim(image)
-        centers_x = np.zeros(axial_dim)
-        centers_y = np.zeros(axial_dim)
-        for i in range(axial_dim):
-            centers_x[i], centers_y[i] = ndimage.measurements.center_of_mass(self.axial_slice(image.data, i))
+        data = self.axial_slices(image.data)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = data.sum(axis=(1, 2), dtype=np.float64)
+            centers_x = np.dot(data.sum(axis=2, dtype=np.float64), np.arange(data.shape[1])) / total
+            centers_y = np.dot(data.sum(axis=1, dtype=np.float64), np.arange(data.shape[2])) / total
         try:
             Slice.nan_fill(centers_x)
             Slice.nan_fill(centers_y)
@@ -247,30 +300,56 @@ image_seg : msct_image.Image
             and matrix of the transformed 3D RMI to output containing the mosaics
             of slices' "pixels"
         """
-        dim = self.get_dim(self.image)
+        dim = int(self.get_dim(self.image))
+        size = int(size)
         if nb_column == 0:
             nb_column = 600 // (size * 2)
 
-        nb_row = math.ceil(dim // nb_column) + 1
-
-        length, width = self.get_slice(self.image.data, 1).shape
+        nb_row = int(math.ceil(dim // nb_column) + 1)
 
-        matrix_sz = (int(size * 2 * nb_row), int(size * 2 * nb_column))
-        matrix0 = np.ones(matrix_sz)
-        matrix1 = np.zeros(matrix_sz)
         centers_x, centers_y = self.get_center()
+        centers_x = np.asarray(centers_x[:dim]).astype(int)
+        centers_y = np.asarray(centers_y[:dim]).astype(int)
 
-        for i in range(dim):
-            x = int(centers_x[i])
-            y = int(centers_y[i])
-
-            matrix0 = self.add_slice(matrix0, i, nb_column, size,
-                                     self.crop(self.get_slice(self.image.data, i), x, y, size, size))
-            matrix1 = self.add_slice(matrix1, i, nb_column, size,
-                                     self.crop(self.get_slice(self.image_seg.data, i), x, y, size, size))
+        matrix0 = self._assemble_mosaic(self.image.data, centers_x, centers_y, nb_row, nb_column, size, 1)
+        matrix1 = self._assemble_mosaic(self.image_seg.data, centers_x, centers_y, nb_row, nb_column, size, 0)
 
         return matrix0, matrix1
 
+    def _assemble_mosaic(self, data, centers_x, centers_y, nb_row, nb_column, size, fill):
+        """Gathers the crop of every slice and tiles them in a (nb_row, nb_column) canvas
+
+        Parameters
+        ----------
+        data : ndarray
+            3D data of the image
+        centers_x, centers_y : ndarray of int
+            center of the crop area of each slice
+        nb_row, nb_column : int
+            layout of the mosaic
+        size : int
+            half size of a mosaic cell
+        fill : float
+            value of the canvas where there is no data
+
+        Returns
+        -------
+        ndarray
+            the mosaic canvas
+        """
+        dim = len(centers_x)
+        slices = self.get_slices(data)
+        rows, rows_inside = self.crop_windows(centers_x, size, slices.shape[1])
+        cols, cols_inside = self.crop_windows(centers_y, size, slices.shape[2])
+
+        cells = np.full((nb_row * nb_column, size * 2, size * 2), fill, dtype=np.float64)
+        patches = slices[np.arange(dim)[:, None, None], rows[:, :, None], cols[:, None, :]]
+        patches[~(rows_inside[:, :, None] & cols_inside[:, None, :])] = fill
+        cells[:dim, :rows.shape[1], :cols.shape[1]] = patches
+
+        cells = cells.reshape(nb_row, nb_column, size * 2, size * 2)
+        return cells.transpose(0, 2, 1, 3).reshape(nb_row * size * 2, nb_column * size * 2)
+
     def single(self):
         """Obtain the matrices of the single slices
 
@@ -283,12 +362,13 @@ image_seg : msct_image.Image
         assert self.image.data.shape == self.image_seg.data.shape
 
         dim = self.get_dim(self.image)
-        matrix0 = self.get_slice(self.image.data, dim / 2)
-        matrix1 = self.get_slice(self.image_seg.data, dim / 2)
-        index = self.get_center_spit()
-        for j in range(len(index)):
-            matrix0[j] = self.get_slice(self.image.data, int(round(index[j])))[j]
-            matrix1[j] = self.get_slice(self.image_seg.data, int(round(index[j])))[j]
+        matrix0 = np.array(self.get_slice(self.image.data, int(dim / 2)))
+        matrix1 = np.array(self.get_slice(self.image_seg.data, int(dim / 2)))
+        # row j of the output is row j of the slice going through the spinal cord at this row
+        index = np.floor(np.asarray(self.get_center_spit()) + 0.5).astype(int)
+        rows = np.arange(len(index))
+        matrix0[rows] = self.get_slices(self.image.data)[index, rows]
+        matrix1[rows] = self.get_slices(self.image_seg.data)[index, rows]
 
         return matrix0, matrix1
 
@@ -307,6 +387,9 @@ class Axial(Slice):
     def get_slice(self, data, i):
         return self.axial_slice(data, i)
 
+    def get_slices(self, data):
+        return self.axial_slices(data)
+
     def get_dim(self, image):
         return self.axial_dim(image)
 
@@ -365,6 +448,9 @@ class Sagittal(Slice):
     def get_slice(self, data, i):
         return self.sagittal_slice(data, i)
 
+    def get_slices(self, data):
+        return self.sagittal_slices(data)
+
     def get_dim(self, image):
         return self.sagittal_dim(image)
 
@@ -427,6 +513,9 @@ class Coronal(Slice):
     def get_slice(self, data, i):
         return self.coronal_slice(data, i)
 
+    def get_slices(self, data):
+        return self.coronal_slices(data)
+
     def get_dim(self, image):
         return self.coronal_dim(image)
 
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark the startup time of SCT command-line scripts.
+#
+# For each script, in a fresh interpreter, measure the time to import the module and the
+# time to run "script -h", and list the heavy dependencies loaded by the import alone.
+# Scripts are invoked again and again by sct.run(), so this is a fixed cost paid at each call.
+#
+# Usage:
+#   python benchmark_startup.py                          # all sct_*.py scripts
+#   python benchmark_startup.py -n 10 sct_image sct_maths
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import getopt
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+
+path_scripts = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+heavy_modules = ['numpy', 'scipy', 'nibabel', 'matplotlib', 'pandas', 'sklearn', 'skimage', 'dipy', 'nipy', 'PIL']
+
+# executed in a fresh interpreter: import the script and report the import time and the heavy modules loaded
+import_snippet = """
+import json, sys, time
+sys.path.insert(0, %r)
+start = time.time()
+__import__(%r)
+duration = time.time() - start
+print(json.dumps([duration, [m for m in %r if m in sys.modules]]))
+"""
+
+
+def usage():
+    print 'USAGE: python ' + os.path.basename(__file__) + ' [-n number_of_runs] [script_name ...]'
+    sys.exit(2)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def benchmark_script(script_name, nb_runs):
+    """
+    Measure the startup of one script.
+    :param script_name: name of the script, without extension. Example: sct_image
+    :param nb_runs: number of measures, the median is returned
+    :return: import time (s), "-h" time (s), list of heavy modules loaded by the import
+    """
+    import_times, help_times = [], []
+    modules = []
+    for i in range(nb_runs):
+        output = subprocess.check_output([sys.executable, '-c', import_snippet % (path_scripts, script_name, heavy_modules)],
+                                         stderr=open(os.devnull, 'w'))
+        duration, modules = json.loads(output.strip().splitlines()[-1])
+        import_times.append(duration)
+
+        start = time.time()
+        subprocess.call([sys.executable, os.path.join(path_scripts, script_name + '.py'), '-h'],
+                        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        help_times.append(time.time() - start)
+    return median(import_times), median(help_times), modules
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:')
+    except getopt.GetoptError:
+        usage()
+    nb_runs = 3
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+        elif opt == '-n':
+            nb_runs = int(arg)
+
+    if args:
+        list_scripts = args
+    else:
+        list_scripts = sorted(os.path.basename(f)[:-3] for f in glob.glob(os.path.join(path_scripts, 'sct_*.py')))
+
+    print '%-40s %10s %10s  %s' % ('script', 'import (s)', '-h (s)', 'heavy modules loaded at import')
+    results = []
+    for script_name in list_scripts:
+        try:
+            time_import, time_help, modules = benchmark_script(script_name, nb_runs)
+        except (subprocess.CalledProcessError, ValueError):
+            print '%-40s %10s' % (script_name, 'FAILED')
+            continue
+        results.append((script_name, time_import, time_help))
+        print '%-40s %10.3f %10.3f  %s' % (script_name, time_import, time_help, ' '.join(modules))
+
+    if results:
+        print '\nMedian "-h" time over %d scripts: %.3f s' % (len(results), median([r[2] for r in results]))
+
+
+if __name__ == "__main__":
+    main()
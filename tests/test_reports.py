@@ -147,3 +147,44 @@ def test_register_to_template(t2_image, t2_seg_image):
 #
 #     test(qcslice.Axial(t2_image, t2_seg_image), param.nb_column, param.threshold)
 #     assert_qc_assets('/tmp/qc')
+
+
+def test_write_png(tmpdir):
+    import matplotlib.image as mpimg
+    import numpy as np
+
+    rgba = (np.random.rand(7, 5, 4) * 255).astype(np.uint8)
+    fname = str(tmpdir.join('test.png'))
+    qc.write_png(fname, rgba)
+    assert (np.round(mpimg.imread(fname) * 255).astype(np.uint8) == rgba).all()
+
+
+def test_apply_lut():
+    import numpy as np
+
+    values = np.array([[0, 1, 2], [3, 4, 200]])
+    lut = qc.listed_lut(qc.QcImage._labels_color)
+    rgba = qc.apply_lut(values, lut, 0, len(lut), mask=values < 1)
+    assert rgba.shape == (2, 3, 4)
+    assert (rgba[0, 0] == 0).all()
+    assert tuple(rgba[0, 1]) == qc.hex_to_rgba(qc.QcImage._labels_color[1])
+    assert tuple(rgba[1, 2]) == qc.hex_to_rgba(qc.QcImage._labels_color[-1])
+    assert qc.apply_aspect(rgba, 2).shape == (4, 3, 4)
+
+
+def test_process_queue(tmpdir):
+    import numpy as np
+
+    param = qc.Params('sub/t2/t2.nii.gz', 'sct_propseg', ['-a'], 'Axial', str(tmpdir))
+    report = qc.QcReport(param, 'Test queue')
+    report.slice_name = 'Axial'
+    qc_image = qc.QcImage(report, 'none', [qc.QcImage.listed_seg, ])
+    mask = np.zeros((30, 40))
+    mask[10:20, 10:20] = 1
+    qc.enqueue_job(qc_image, np.random.rand(30, 40), mask, 1, 1)
+
+    assert qc.process_queue(str(tmpdir)) == 1
+    assert os.listdir(qc.queue_folder(str(tmpdir))) == []
+    assert os.path.isfile(param.abs_overlay_img_path())
+    with open(param.qc_results) as results:
+        assert json.load(results)[0]['command'] == 'sct_propseg'